@@ -1,4 +1,5 @@
 from pacman import GameState, Directions
+from distanceCalculator import getMazeGraph
 import random
 import numpy as np
 from time import sleep
@@ -12,124 +13,94 @@ def getWeights():
         return np.zeros(NFEATURES)
 
 def nearestFood(state:GameState):
-    pos = state.getPacmanPosition()
-    node = (pos[0], pos[1])
-
-    explored = []
-    exploring = [node]
-    distances = [0]
-
-    while exploring:
-        current = exploring.pop(0)
-        d = distances.pop(0)
-
-        if state.hasFood(current[0], current[1]): return d
-
-        explored.append(current)
-        
-        for new in [
-            (current[0], current[1]+1),
-            (current[0]+1, current[1]),
-            (current[0], current[1]-1),
-            (current[0]-1, current[1])
-        ]:
-            if new[0] >= state.getWalls().width or new[0]<0 or new[1] < 0 or new[1] >= state.getWalls().height:
-                continue
-
-
-            if state.hasWall(new[0], new[1]) or new in explored: continue
-
-            exploring.append(new)
-            distances.append(d+1)
-    
-    return 1
+    graph = getMazeGraph(state.data.layout)
+    distance = graph.nearestDistance(state.getPacmanPosition(), state.data.getFoodPositions())
+    if distance is None: return 1
+    return distance
 
 def getDistance(state:GameState, pos, target):
-    explored = []
-    exploring = [pos]
-    distances = [0]
-
-    while exploring:
-        current = exploring.pop(0)
-        d = distances.pop(0)
-
-        if current == target: return d
-
-        explored.append(current)
-        
-        for new in [
-            (current[0], current[1]+1),
-            (current[0]+1, current[1]),
-            (current[0], current[1]-1),
-            (current[0]-1, current[1])
-        ]:
-            if new[0] >= state.getWalls().width or new[0]<0 or new[1] < 0 or new[1] >= state.getWalls().height:
-                continue
-
-
-            if state.hasWall(new[0], new[1]) or new in explored: continue
-
-            exploring.append(new)
-            distances.append(d+1)
-    
-    return 1
+    distance = getMazeGraph(state.data.layout).distance(pos, target)
+    if distance is None: return 1
+    return distance
 
 def numGhosts1n2steps(state:GameState):
-    pos = state.getPacmanPosition()
-    node = (pos[0], pos[1])
-
-    explored = []
-    exploring = [node]
-    distances = [0]
-    found = [0, 0]
-
-    while exploring:
-        current = exploring.pop(0)
-        d = distances.pop(0)
-
-        if d >= 3: break
-
-        for ghost in state.getGhostStates():
-            if ghost.scaredTimer > 0: continue
-            if current == ghost.getPosition(): found[d-1] += 1
-
-        explored.append(current)
-        
-        for new in [
-            (current[0], current[1]+1),
-            (current[0]+1, current[1]),
-            (current[0], current[1]-1),
-            (current[0]-1, current[1])
-        ]:
-            if new[0] >= state.getWalls().width or new[0]<0 or new[1] < 0 or new[1] >= state.getWalls().height:
-                continue
-
-
-            if state.hasWall(new[0], new[1]) or new in explored: continue
-
-            exploring.append(new)
-            distances.append(d+1)
-
-    return found
+    """
+    Counts the active ghosts one and two steps away from Pacman, the way the
+    weights in weights.txt were trained: a ghost two steps away counts once
+    for every cell next to Pacman it can be reached through (twice on the
+    diagonal of an open 2x2 area), and a ghost on Pacman's own cell counts
+    as two steps away.
+    """
+    graph = getMazeGraph(state.data.layout)
+    ghosts = {}
+    for ghost in state.getGhostStates():
+        if ghost.scaredTimer <= 0:
+            position = ghost.getPosition()
+            ghosts[position] = ghosts.get(position, 0) + 1
+    start = graph.cellId(state.getPacmanPosition())
+    if start < 0: return [0, 0]
+    cells, neighbors = graph.cells, graph.neighbors
+
+    oneStep = 0
+    twoSteps = ghosts.get(cells[start], 0)
+    for near in neighbors[start]:
+        oneStep += ghosts.get(cells[near], 0)
+        for far in neighbors[near]:
+            if far != start and far not in neighbors[start]:
+                twoSteps += ghosts.get(cells[far], 0)
+    return [oneStep, twoSteps]
 
 def getFeatures(state:GameState, action:Directions, nFoods):
-    nextState = state.generateSuccessor(0, action)
+    return getFeatureMatrix(state, [action], nFoods)[1][0]
+
+def getFeatureMatrix(state:GameState, actions, nFoods):
+    """
+    Expands state once per action and returns (successors, features), where
+    features is a (len(actions), NFEATURES) matrix whose i-th row holds the
+    features of taking actions[i] in state.
+    """
     maxDist = state.data.layout.width + state.data.layout.height
+    numFood = state.getNumFood()
+    score = state.getScore()
 
-    features = [1,]
-    features.append(nearestFood(nextState) / maxDist)
-    features.append(5.0 * nextState.getNumFood() / nFoods)
-    features.append(state.getNumFood() - nextState.getNumFood())
-
-    numGhosts1step, numGhost2step = numGhosts1n2steps(nextState)
-    features.append(1 - numGhosts1step)
-    features.append(1 - numGhost2step)
-    features.append((nextState.getScore() - state.getScore() + 500) / 500)
-    #features.append(nearestGhost(nextState))
-
-    return np.array(features)
+    successors = []
+    features = np.empty((len(actions), NFEATURES))
+    for i, action in enumerate(actions):
+        nextState = state.generateSuccessor(0, action)
+        successors.append(nextState)
+        nextNumFood = nextState.getNumFood()
+        numGhosts1step, numGhost2step = numGhosts1n2steps(nextState)
+
+        row = features[i]
+        row[0] = 1
+        row[1] = nearestFood(nextState) / maxDist
+        row[2] = 5.0 * nextNumFood / nFoods
+        row[3] = numFood - nextNumFood
+        row[4] = 1 - numGhosts1step
+        row[5] = 1 - numGhost2step
+        row[6] = (nextState.getScore() - score + 500) / 500
+        #features.append(nearestGhost(nextState))
+
+    return successors, features
+
+def legalMoves(state:GameState):
+    legal = state.getLegalPacmanActions()
+    if Directions.STOP in legal: legal.remove(Directions.STOP)
+    return legal
+
+def bestAction(actions, qValues):
+    """
+    Returns (q, action) for the highest Q-value, preferring the last of equal
+    values like the original per-action loops did.
+    """
+    if len(actions) == 0: return (0, Directions.STOP)
+    best = len(actions) - 1 - int(np.argmax(qValues[::-1]))
+    return (qValues[best], actions[best])
 
 class RLAgent_final():
+    # Only reads the states it is given, so --fast can skip the copies
+    copyObservations = False
+
     def __init__(self, **args):
         self.numTraining= args.get('numTraining',0)
         self.discount = 1.0
@@ -141,17 +112,39 @@ class RLAgent_final():
         self._weights = getWeights()
         self._initialState = None
         self._nFoods = 0
+        self._featureCache = {}
         self.score_episodes_list=[]
 
     def registerInitialState(self, state):
         self._initialState = state
         self._nFoods = state.getNumFood()
+        self._featureCache = {}
+
+    def _expand(self, state:GameState):
+        """
+        Returns (actions, successors, features) for state, computing them only
+        the first time state is seen during the current turn.
+        """
+        cached = self._featureCache.get(id(state))
+        if cached is None or cached[0] is not state:
+            actions = legalMoves(state)
+            successors, features = getFeatureMatrix(state, actions, self._nFoods)
+            cached = (state, actions, successors, features)
+            self._featureCache[id(state)] = cached
+        return cached[1:]
+
+    def _row(self, state:GameState, action:Directions):
+        actions, successors, features = self._expand(state)
+        if action in actions:
+            i = actions.index(action)
+            return successors[i], features[i]
+        return state.generateSuccessor(0, action), getFeatures(state, action, self._nFoods)
 
     def Q(self, state:GameState, action:Directions):
-        return np.inner(getFeatures(state, action, self._nFoods), self.weights)
+        return np.inner(self._row(state, action)[1], self.weights)
     
     def _Q(self, state:GameState, action:Directions):
-        return np.inner(getFeatures(state, action, self._nFoods), self._weights)
+        return np.inner(self._row(state, action)[1], self._weights)
     def stopEpisode(self):
         self.num_episodes += 1
         if self.num_episodes >= self.numTraining:
@@ -161,53 +154,32 @@ class RLAgent_final():
     def reward(self, state:GameState, action:Directions):
         score = 0
 
-        nextState = state.generateSuccessor(0, action)
+        nextState = self._row(state, action)[0]
 
         score += nextState.getScore() - state.getScore()
     
         return score - 5.0 * state.getNumFood() / self._nFoods
 
     def Qstar(self, state:GameState):
-        legal = state.getLegalPacmanActions()
-        if Directions.STOP in legal: legal.remove(Directions.STOP)
-
-        if len(legal) == 0: return (0, Directions.STOP)
-
-        best = (-np.inf, None)
-        for action in legal:
-            q = self.Q(state, action)
-            if q >= best[0]: best = (q, action)
-
-        return best
+        actions, _, features = self._expand(state)
+        return bestAction(actions, features @ self.weights)
 
     def _Qstar(self, state:GameState):
-        legal = state.getLegalPacmanActions()
-        if Directions.STOP in legal: legal.remove(Directions.STOP)
-
-        if len(legal) == 0: return (0, Directions.STOP)
-
-        best = (-np.inf, None)
-        for action in legal:
-            q = self._Q(state, action)
-            #print(action, getFeatures(state, action))
-            if q >= best[0]: best = (q, action)
-
-        #print()
-        #sleep(1)
-
-        return best
+        actions, _, features = self._expand(state)
+        return bestAction(actions, features @ self._weights)
 
     def _update(self, state:GameState, action:Directions, extra = 0):
-        nextState = state.generateSuccessor(0, action)
+        nextState, features = self._row(state, action)
         sample = self.reward(state, action) + self.discount * self.Qstar(nextState)[0]
 
-        self._weights += self.learning_rate * (extra + sample - self._Q(state, action)) * getFeatures(state, action, self._nFoods)
+        self._weights += self.learning_rate * (extra + sample - np.inner(features, self._weights)) * features
 
     def getAction(self, state:GameState):
         legal = state.getLegalPacmanActions()
         if Directions.STOP in legal: legal.remove(Directions.STOP)
 
         self.epsilon *= self.discount
+        self._featureCache = {}
 
         if random.random() < self.epsilon: return random.choice(legal)
     
@@ -235,6 +207,8 @@ class RLAgent_final():
         np.savetxt("weights_final.txt", self.weights)
 
 class TestAgent:
+    copyObservations = False
+
     def __init__(self, *args, **kwargs):
         self.weights = getWeights()
 
@@ -242,17 +216,9 @@ class TestAgent:
         return np.inner(getFeatures(state, action, self._nFoods), self.weights)
 
     def Qstar(self, state:GameState):
-        legal = state.getLegalPacmanActions()
-        if Directions.STOP in legal: legal.remove(Directions.STOP)
-
-        if len(legal) == 0: return (0, Directions.STOP)
-
-        best = (-np.inf, None)
-        for action in legal:
-            q = self.Q(state, action)
-            if q >= best[0]: best = (q, action)
-
-        return best
+        legal = legalMoves(state)
+        _, features = getFeatureMatrix(state, legal, self._nFoods)
+        return bestAction(legal, features @ self.weights)
 
     def getAction(self, state:GameState):
         legal = state.getLegalPacmanActions()
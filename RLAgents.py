@@ -13,6 +13,7 @@ def scoreEvaluation(state:GameState, action):
     return state.generateSuccessor(0, action).getScore()
 
 class RLAgent():
+    copyObservations = False
 
     def __init__(self, learning_rate = 0.000001, epsilon=0.3, discount=0.7,**args):
         #super()
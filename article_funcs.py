@@ -1,10 +1,8 @@
 from pacman import GameState, Actions
-from distanceCalculator import Distancer
+from distanceCalculator import getDistancer
 import util
 def distancer(state:GameState):
-    distance_calculator = Distancer(state.data.layout)
-    distance_calculator.getMazeDistances()
-    return distance_calculator
+    return getDistancer(state.data.layout)
 def distToNextPill(state:GameState):
     distance = distancer(state)
     pacman_pos= state.getPacmanPosition()
@@ -0,0 +1,231 @@
+# auditReplays.py
+# ---------------
+# Re-simulates recorded games in a process pool to check their results and
+# collect per-game statistics.
+
+"""
+Headless replay auditing.
+
+Every replay found in the given files, directories and zip archives (such as
+the results/<date>.zip files of competition.py) is played again from its
+moves, without a display or delays, and checked against what was recorded:
+the final score and the checkpoints along the way.  Each game becomes one
+JSON line of statistics:
+
+    replay, game, moves, complete, crashed, recordedScore, score, verified,
+    desync (first checkpoint that did not match, or null)
+    error (why the replay could not be audited, or null)
+
+and, for capture games, per team (red and blue):
+
+    returned (list of [move, food returned so far] at every change),
+    deaths, firstScore (move of the first food returned, or null)
+
+USAGE:      python auditReplays.py [options] PATH [PATH ...]
+EXAMPLES:   python auditReplays.py results/2020-01-31.12-00-00.zip
+            python auditReplays.py -j 8 -o audit.jsonl results/
+
+Only replays in the format of replay.py are audited; older pickled replays
+have no recorded result and are skipped.  A replay that cannot be read or
+played again (damaged, or missing metadata) gets a line with its error and
+counts as unverifiable.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import zipfile
+
+import replay
+from game import Actions
+
+
+def findReplays(paths):
+    """
+    Yields a (path, member) pair for every replay in paths, where member is
+    the name inside a zip archive or None.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    for found in findReplays([os.path.join(root, name)]):
+                        yield found
+        elif zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                for member in archive.namelist():
+                    with archive.open(member) as f:
+                        if f.read(len(replay.MAGIC)) == replay.MAGIC:
+                            yield path, member
+        elif replay.isReplay(path):
+            yield path, None
+
+
+def readReplay(path, member=None):
+    if member is None:
+        return replay.ReplayReader(path)
+    with zipfile.ZipFile(path) as archive:
+        return replay.ReplayReader('%s:%s' % (path, member), archive.read(member))
+
+
+def initialState(recorded):
+    """
+    The state a recorded game started from.
+    """
+    info = recorded.metadata
+    if info['game'] == 'capture':
+        import capture
+        state = capture.GameState()
+        state.initialize(recorded.layout, info['numAgents'])
+        state.data.timeleft = info['length']
+    else:
+        import pacman
+        state = pacman.GameState()
+        state.initialize(recorded.layout, info['numAgents'] - 1)
+    return state
+
+
+class TeamStats:
+    """
+    Follows the food returned and the deaths of one capture team.
+    """
+    def __init__(self, indices):
+        self.indices = indices
+        self.returned = [[0, 0]]
+        self.deaths = 0
+        self.firstScore = None
+
+    def update(self, move, state):
+        returned = sum(state.data.agentStates[i].numReturned for i in self.indices)
+        if returned != self.returned[-1][1]:
+            self.returned.append([move, returned])
+            if self.firstScore is None: self.firstScore = move
+
+    def asDict(self):
+        return {'returned': self.returned, 'deaths': self.deaths, 'firstScore': self.firstScore}
+
+
+def auditReplay(job):
+    """
+    Plays one replay again and returns its statistics, or a row with the
+    error that stopped it.
+    """
+    path, member = job
+    name = path if member is None else '%s:%s' % (path, member)
+    try:
+        return _auditReplay(name, path, member)
+    except Exception as e:
+        return {'replay': name, 'game': None, 'moves': None, 'complete': False,
+                'crashed': None, 'recordedScore': None, 'score': None,
+                'verified': None, 'desync': None,
+                'error': '%s: %s' % (type(e).__name__, e)}
+
+
+def _auditReplay(name, path, member):
+    recorded = readReplay(path, member)
+    state = initialState(recorded)
+    isCapture = recorded.metadata['game'] == 'capture'
+    if isCapture:
+        teams = {'red': TeamStats(state.getRedTeamIndices()),
+                 'blue': TeamStats(state.getBlueTeamIndices())}
+    checkpoints = dict(recorded.checkpoints)
+    initial = state
+    desync = None
+
+    for move, (agentIndex, action) in enumerate(recorded.actions, 1):
+        previous = [agentState.getPosition() for agentState in state.data.agentStates]
+        state = state.generateSuccessor(agentIndex, action)
+        if isCapture:
+            # Only the moving agent changes position, by one step, unless it
+            # is eaten; everybody else moves only when they are eaten.
+            dx, dy = Actions.directionToVector(action)
+            for team in teams.values():
+                for i in team.indices:
+                    x, y = previous[i]
+                    expected = (x + dx, y + dy) if i == agentIndex else (x, y)
+                    if state.data.agentStates[i].getPosition() != expected:
+                        team.deaths += 1
+                team.update(move, state)
+        if move in checkpoints and desync is None:
+            if recorded.restore(initial, (move, checkpoints[move])) != state:
+                desync = move
+
+    result = recorded.result
+    crashed = result.get('crashed', False)
+    verified = None
+    if recorded.complete and 'score' in result and not crashed:
+        verified = result['score'] == state.data.score and desync is None
+    stats = {
+        'replay': name,
+        'game': recorded.metadata['game'],
+        'moves': len(recorded.actions),
+        'complete': recorded.complete,
+        'crashed': crashed,
+        'recordedScore': result.get('score'),
+        'score': state.data.score,
+        'verified': verified,
+        'desync': desync,
+        'error': None,
+    }
+    if isCapture:
+        for color, team in teams.items():
+            stats[color] = team.asDict()
+    return stats
+
+
+def auditReplays(paths, output=None, processes=None):
+    """
+    Audits every replay in paths, writing one JSON line per game to output
+    if given.  Returns the statistics of the games that failed verification.
+    """
+    jobs = list(findReplays(paths))
+    start = time.time()
+    counts = {True: 0, False: 0, None: 0}
+    errors = 0
+    failed = []
+    out = open(output, 'w') if output else None
+    try:
+        with multiprocessing.Pool(processes) as pool:
+            for stats in pool.imap_unordered(auditReplay, jobs, chunksize=8):
+                counts[stats['verified']] += 1
+                if stats['error'] is not None:
+                    errors += 1
+                    print('ERROR %s: %s' % (stats['replay'], stats['error']), file=sys.stderr)
+                if stats['verified'] is False:
+                    failed.append(stats)
+                    print('MISMATCH %s: recorded %s, replayed %s, desync at move %s'
+                          % (stats['replay'], stats['recordedScore'], stats['score'], stats['desync']),
+                          file=sys.stderr)
+                if out is not None:
+                    out.write(json.dumps(stats) + '\n')
+    finally:
+        if out is not None: out.close()
+
+    elapsed = time.time() - start
+    print('Audited %d replays in %.2fs: %d verified, %d mismatched, %d unverifiable '
+          '(crashed, incomplete or unreadable: %d errors)'
+          % (len(jobs), elapsed, counts[True], counts[False], counts[None], errors))
+    return failed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='a replay file, a directory or a zip archive of replays')
+    parser.add_argument('-o', '--output', default=None,
+                        help='where to write the per-game statistics (JSON lines)')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='number of worker processes (default: all cores)')
+    options = parser.parse_args(argv)
+
+    failed = auditReplays(options.paths, options.output, options.processes)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
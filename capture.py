@@ -55,11 +55,14 @@ from game import Actions
 from util import nearestPoint
 from util import manhattanDistance
 from game import Grid
+from game import BitGrid
 from game import Configuration
 from game import Agent
 from game import reconstituteGrid
-import sys, util, types, time, random, imp
+import sys, os, util, types, time, random, imp, contextlib
 import keyboardAgents
+import replay
+import profiler
 
 # If you change these, you won't affect the server, so you can't cheat
 KILL_POINTS = 0
@@ -67,7 +70,7 @@ SONAR_NOISE_RANGE = 13 # Must be odd
 SONAR_NOISE_VALUES = [i - (SONAR_NOISE_RANGE - 1)/2 for i in range(SONAR_NOISE_RANGE)]
 SIGHT_RANGE = 5 # Manhattan distance
 MIN_FOOD = 2
-TOTAL_FOOD = 
+TOTAL_FOOD = 60
 
 DUMP_FOOD_ON_DEATH = True # if we have the gameplay element that dumps dots on death
 
@@ -113,7 +116,7 @@ class GameState:
     # Find appropriate rules for the agent
     AgentRules.applyAction( state, action, agentIndex )
     AgentRules.checkDeath(state, agentIndex)
-    AgentRules.decrementTimer(state.data.agentStates[agentIndex])
+    AgentRules.decrementTimer(state.data.getWritableAgentState(agentIndex))
 
     # Book keeping
     state.data._agentMoved = agentIndex
@@ -265,7 +268,17 @@ class GameState:
     return state
 
   def makeObservation(self, index):
-    state = self.deepCopy()
+    # A view of this state rather than a deep copy: the food grid is shared,
+    # since rules never modify it in place and accessors only hand out
+    # copies, but the agent states and walls the agent can reach are its own
+    state = GameState(self)
+    state.data.agentStates = state.data.copyAgentStates(state.data.agentStates)
+    state.data._writableAgents = -1
+    state.data.layout = self.data.layout.deepCopy()
+    state.data._agentMoved = self.data._agentMoved
+    state.data._foodEaten = self.data._foodEaten
+    state.data._foodAdded = self.data._foodAdded
+    state.data._capsuleEaten = self.data._capsuleEaten
 
     # Adds the sonar signal
     pos = state.getAgentPosition(index)
@@ -330,6 +343,15 @@ class GameState:
 
 def halfGrid(grid, red):
   halfway = grid.width // 2
+  if isinstance(grid, BitGrid):
+    # Columns are contiguous runs of bits, so a half is a single mask
+    halfgrid = grid.copy()
+    redMask = (1 << (halfway * grid.height)) - 1
+    if red: halfgrid.bits = grid.bits & redMask
+    else:   halfgrid.bits = grid.bits & ~redMask
+    halfgrid._hash = None
+    return halfgrid
+
   halfgrid = Grid(grid.width, grid.height, False)
   if red:    xrange = range(halfway)
   else:       xrange = range(halfway, grid.width)
@@ -376,8 +398,8 @@ class CaptureRules:
     game.state.data.timeleft = length
     if 'drawCenterLine' in dir(display):
       display.drawCenterLine()
-    self._initBlueFood = initState.getBlueFood().count()
-    self._initRedFood = initState.getRedFood().count()
+    self._initRedFood = initState.data.getNumFood(0)
+    self._initBlueFood = initState.data.getNumFood(1)
     return game
 
   def process(self, state, game):
@@ -414,8 +436,8 @@ class CaptureRules:
             print ('The %s team wins by %d points.' % (winner, abs(state.data.score)))
 
   def getProgress(self, game):
-    blue = 1.0 - (game.state.getBlueFood().count() / float(self._initBlueFood))
-    red = 1.0 - (game.state.getRedFood().count() / float(self._initRedFood))
+    blue = 1.0 - (game.state.data.getNumFood(1) / float(self._initBlueFood))
+    red = 1.0 - (game.state.data.getNumFood(0) / float(self._initRedFood))
     moves = len(self.moveHistory) / float(game.length)
 
     # return the most likely progress indicator, clamped to [0, 1]
@@ -455,7 +477,7 @@ class AgentRules:
     """
     agentState = state.getAgentState(agentIndex)
     conf = agentState.configuration
-    possibleActions = Actions.getPossibleActions( conf, state.data.layout.walls )
+    possibleActions = state.data.layout.getMoveTable().getPossibleActions( conf )
     return AgentRules.filterForAllowedActions( agentState, possibleActions)
   getLegalActions = staticmethod( getLegalActions )
 
@@ -473,7 +495,7 @@ class AgentRules:
       raise Exception("Illegal action " + str(action))
 
     # Update Configuration
-    agentState = state.data.agentStates[agentIndex]
+    agentState = state.data.getWritableAgentState(agentIndex)
     speed = 1.0
     # if agentState.isPacman: speed = 0.5
     vector = Actions.directionToVector( action, speed )
@@ -528,16 +550,15 @@ class AgentRules:
         teamIndicesFunc = state.getRedTeamIndices
 
       # go increase the variable for the pacman who ate this
-      agents = [state.data.agentStates[agentIndex] for agentIndex in teamIndicesFunc()]
-      for agent in agents:
-        if agent.getPosition() == position:
-          agent.numCarrying += 1
+      for agentIndex in teamIndicesFunc():
+        if state.data.agentStates[agentIndex].getPosition() == position:
+          state.data.getWritableAgentState(agentIndex).numCarrying += 1
           break # the above should only be true for one agent...
 
       # do all the score and food grid maintainenace 
       #state.data.scoreChange += score
       state.data.food = state.data.food.copy()
-      state.data.food[x][y] = False
+      state.data.setFood(position, False)
       state.data._foodEaten = position
       #if (isRed and state.getBlueFood().count() == MIN_FOOD) or (not isRed and state.getRedFood().count() == MIN_FOOD):
       #  state.data._win = True
@@ -553,14 +574,16 @@ class AgentRules:
       if isRed: otherTeam = state.getBlueTeamIndices()
       else: otherTeam = state.getRedTeamIndices()
       for index in otherTeam:
-        state.data.agentStates[index].scaredTimer = SCARED_TIME
+        state.data.getWritableAgentState(index).scaredTimer = SCARED_TIME
 
   consume = staticmethod( consume )
 
   def decrementTimer(state):
     timer = state.scaredTimer
     if timer == 1:
-      state.configuration.pos = nearestPoint( state.configuration.pos )
+      # Configurations may be shared with earlier states, so replace it
+      conf = state.configuration
+      state.configuration = Configuration( nearestPoint( conf.pos ), conf.direction )
     state.scaredTimer = max( 0, timer - 1 )
   decrementTimer = staticmethod( decrementTimer )
 
@@ -651,7 +674,7 @@ class AgentRules:
       x = int(x)
       y = int(y)
       if (allGood(state, x, y)):
-        state.data.food[x][y] = True
+        state.data.setFood((x, y), True)
         foodAdded.append((x, y))
         numToDump -= 1
 
@@ -694,6 +717,7 @@ class AgentRules:
             if state.isOnRedTeam(agentIndex):
               score = -score
             state.data.scoreChange += score
+            otherAgentState = state.data.getWritableAgentState(index)
             otherAgentState.isPacman = False
             otherAgentState.configuration = otherAgentState.start
             otherAgentState.scaredTimer = 0
@@ -706,6 +730,7 @@ class AgentRules:
         if manhattanDistance( pacPos, agentState.getPosition() ) <= COLLISION_TOLERANCE:
           #award points to the other team for killing Pacmen
           if agentState.scaredTimer <= 0:
+            otherAgentState = state.data.getWritableAgentState(index)
             AgentRules.dumpFoodFromDeath(state, otherAgentState, agentIndex)
 
             score = KILL_POINTS
@@ -761,6 +786,8 @@ def readCommand( argv ):
                   - starts a two-player interactive game where the arrow keys control agent 0, and all other agents are baseline agents
               (3) python capture.py -r baselineTeam -b myTeam
                   - starts a fully automated game where the red team is a baseline team and blue team is myTeam
+              (4) python capture.py -r baselineTeam -b myTeam --batch -n 200 -l RANDOM --batch-output results.jsonl
+                  - plays 200 games on random mazes on all cores and writes one JSON result per game
   """
   parser = OptionParser(usageStr)
 
@@ -815,6 +842,22 @@ def readCommand( argv ):
                     help=default('How many episodes are training (suppresses output)'), default=0)
   parser.add_option('-c', '--catchExceptions', action='store_true', default=False,
                     help='Catch exceptions and enforce time limits')
+  parser.add_option('--profile', dest='profile', default=None, metavar='FILE',
+                    help='Times every phase of the games (agents, successors, observations, display, rules, distances) and writes a JSON report to FILE')
+  parser.add_option('--profile-stats', dest='profileStats', default=None, metavar='FILE',
+                    help='With --profile, also writes a cProfile dump of the run (readable with pstats) to FILE')
+  parser.add_option('--batch', action='store_true', default=False,
+                    help='Plays the games headless in a process pool, each with its own seed (and maze with -l RANDOM), and reports structured results')
+  parser.add_option('-j', '--processes', type='int', default=None,
+                    help='Number of worker processes in --batch mode (default: all cores)')
+  parser.add_option('--seed', type='int', default=0,
+                    help=default('Seed the per-game seeds of --batch mode are derived from'))
+  parser.add_option('--batch-output', dest='batchOutput', default=None, metavar='FILE',
+                    help='Writes the result of every --batch game to FILE (JSON lines)')
+  parser.add_option('--stop-confidence', dest='stopConfidence', type='float', default=None, metavar='LEVEL',
+                    help='In --batch mode, stops as soon as the win rate difference is significant at LEVEL (e.g. 0.95)')
+  parser.add_option('--games-per-look', dest='gamesPerLook', type='int', default=None,
+                    help='Games played between two checks of --stop-confidence (default: 4 per worker)')
 
   options, otherjunk = parser.parse_args(argv)
   assert len(otherjunk) == 0, "Unrecognized options: " + str(otherjunk)
@@ -856,8 +899,7 @@ def readCommand( argv ):
   # Special case: recorded games don't use the runGames method or args structure
   if options.replay != None:
     print('Replaying recorded game %s.' % options.replay)
-    import pickle
-    recorded = pickle.load(open(options.replay,'rb'),encoding="bytes")
+    recorded = loadRecordedGame(options.replay)
     recorded['display'] = args['display']
     recorded['delay'] = options.delay_step
     recorded['redTeamName'] = options.red
@@ -870,8 +912,7 @@ def readCommand( argv ):
   # Special case: recorded games don't use the runGames method or args structure
   if options.replayq != None:
     print('Replaying recorded game %s.' % options.replay)
-    import pickle
-    recorded = pickle.load(open(options.replayq,'rb'),encoding="bytes")
+    recorded = loadRecordedGame(options.replayq)
     recorded['display'] = args['display']
     recorded['delay'] = 0.0
     recorded['redTeamName'] = options.red
@@ -886,6 +927,13 @@ def readCommand( argv ):
   if options.numTraining > 0:
     redArgs['numTraining'] = options.numTraining
     blueArgs['numTraining'] = options.numTraining
+
+  # Special case: batches play in worker processes that load the teams themselves
+  if options.batch:
+    runBatch(options.red, options.blue, redArgs, blueArgs, options.layout, options.numGames,
+             options.time, options.seed, options.processes, options.batchOutput,
+             options.stopConfidence, options.gamesPerLook)
+    sys.exit(0)
   nokeyboard = options.textgraphics or options.quiet or options.numTraining > 0
   print ('\nRed team %s with %s:' % (options.red, redArgs))
   redAgents = loadAgents(True, options.red, nokeyboard, redArgs)
@@ -917,9 +965,9 @@ def readCommand( argv ):
   layouts = []
   for i in range(options.numGames):
     if options.layout == 'RANDOM':
-      l = layout.Layout(randomLayout().split('\n'))
+      l = layout.getRandomLayout(None)
     elif options.layout.startswith('RANDOM'):
-      l = layout.Layout(randomLayout(int(options.layout[6:])).split('\n'))
+      l = layout.getRandomLayout(int(options.layout[6:]))
     elif options.layout.lower().find('capture') == -1:
       raise Exception( 'You must use a capture layout with capture.py')
     else:
@@ -935,6 +983,8 @@ def readCommand( argv ):
   args['record'] = options.record
   args['catchExceptions'] = options.catchExceptions
   args['delay_step'] = options.delay_step
+  if options.profile or options.profileStats:
+    args['profiler'] = profiler.GameProfiler(options.profile, options.profileStats)
   return args
 
 def randomLayout(seed = None):
@@ -985,6 +1035,21 @@ def loadAgents(isRed, factory, textgraphics, cmdLineArgs):
   indices = [2*i + indexAddend for i in range(2)]
   return createTeamFunc(indices[0], indices[1], isRed, **args)
 
+def loadRecordedGame(filename):
+  """
+  Reads a game saved with --record: a replay file, or a pickle written by
+  older versions.
+  """
+  if replay.isReplay(filename):
+    recorded = replay.ReplayReader(filename)
+    info = recorded.metadata
+    return {'layout': recorded.layout, 'agents': [Agent() for i in range(info['numAgents'])],
+            'actions': recorded.actions, 'length': info['length'],
+            'redTeamName': info['redTeamName'], 'blueTeamName': info['blueTeamName']}
+  import pickle
+  with open(filename, 'rb') as f:
+    return pickle.load(f, encoding="bytes")
+
 def replayGame( layout, agents, actions, display, length, redTeamName, blueTeamName, waitEnd=True, delay=1):
     rules = CaptureRules()
     game = rules.newGame( layout, agents, display, length, False, False )
@@ -1036,10 +1101,11 @@ def replayGame( layout, agents, actions, display, length, redTeamName, blueTeamN
     display.finish()
 
 
-def runGames( layouts, agents, display, length, numGames, record, numTraining, redTeamName, blueTeamName, muteAgents=False, catchExceptions=False, delay_step=0):
+def runGames( layouts, agents, display, length, numGames, record, numTraining, redTeamName, blueTeamName, muteAgents=False, catchExceptions=False, delay_step=0, profiler=None):
 
   rules = CaptureRules()
   games = []
+  if profiler is not None: profiler.start()
 
   if numTraining > 0:
     print ('Playing %d training games' % numTraining)
@@ -1055,21 +1121,28 @@ def runGames( layouts, agents, display, length, numGames, record, numTraining, r
     else:
         gameDisplay = display
         rules.quiet = False
+    if profiler is not None: start = time.perf_counter()
     g = rules.newGame( layout, agents, gameDisplay, length, muteAgents, catchExceptions )
-    g.run(delay=delay_step)
+    if profiler is not None:
+      profiler.add('setup', time.perf_counter() - start)
+      g.profiler = profiler
+    if record:
+      # The replay is written move by move while the game is played
+      info = {'game': 'capture', 'numAgents': len(agents), 'length': length,
+              'redTeamName': redTeamName, 'blueTeamName': blueTeamName}
+      g.recorder = replay.ReplayWriter('replay-%d' % i, layout, info)
+    try:
+      g.run(delay=delay_step)
+    finally:
+      if g.recorder is not None: g.recorder.close(g)
+    if profiler is not None: profiler.addGame(g)
     if not beQuiet: games.append(g)
 
     g.record = None
     if record:
-      import time, pickle, game
-      #fname = ('recorded-game-%d' % (i + 1)) +  '-'.join([str(t) for t in time.localtime()[1:6]])
-      #f = file(fname, 'w')
-      components = {'layout': layout, 'agents': [game.Agent() for a in agents], 'actions': g.moveHistory, 'length': length, 'redTeamName': redTeamName, 'blueTeamName':blueTeamName }
-      #f.close()
       print("recorded")
-      g.record = pickle.dumps(components)
-      with open('replay-%d'%i,'wb') as f:
-        f.write(g.record)
+      with open('replay-%d' % i, 'rb') as f:
+        g.record = f.read()
 
   if numGames > 1:
     scores = [game.state.data.score for game in games]
@@ -1080,8 +1153,171 @@ def runGames( layouts, agents, display, length, numGames, record, numTraining, r
     print ('Red Win Rate:  %d/%d (%.2f)' % ([s > 0 for s in scores].count(True), len(scores), redWinRate))
     print ('Blue Win Rate: %d/%d (%.2f)' % ([s < 0 for s in scores].count(True), len(scores), blueWinRate))
     print ('Record:       ', ', '.join([('Blue', 'Tie', 'Red')[max(0, min(2, 1 + s))] for s in scores]))
+  if profiler is not None: profiler.finish()
   return games
 
+def batchSeeds(seed, numGames):
+  """
+  The seeds of the games of a batch.  Game i always gets the same seed for
+  a given base seed, whichever worker plays it and in whatever order.
+  """
+  return [random.Random('%d:%d' % (seed, i)).randint(0, 99999999) for i in range(numGames)]
+
+def batchLayout(layoutName, gameSeed):
+  """
+  The layout of a batch game: a maze generated from the game's own seed for
+  RANDOM, the maze of the given seed for RANDOM<seed>, or a layout file.
+  """
+  import layout
+  if layoutName == 'RANDOM':
+    return layout.getRandomLayout(gameSeed)
+  if layoutName.startswith('RANDOM'):
+    return layout.getRandomLayout(int(layoutName[6:]))
+  if layoutName.lower().find('capture') == -1:
+    raise Exception( 'You must use a capture layout with capture.py')
+  l = layout.getLayout( layoutName )
+  if l == None: raise Exception("The layout " + layoutName + " cannot be found")
+  return l
+
+def playBatchGame(job):
+  """
+  Plays one game of a batch in a worker process and returns its result.
+  Every game gets a fresh worker (see runBatch) and the teams are created
+  after seeding random with the game's seed, so nothing carries over from
+  the games played before.  Everything the game prints is discarded;
+  crashes still go to stderr.
+  """
+  gameIndex, gameSeed, settings = job
+  import textDisplay
+  start = time.perf_counter()
+  layoutName = settings['layout']
+  if layoutName == 'RANDOM': layoutName = 'RANDOM%d' % gameSeed
+  result = {'game': gameIndex, 'seed': gameSeed, 'layout': layoutName}
+
+  with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+    layout = batchLayout(settings['layout'], gameSeed)
+    random.seed(gameSeed)
+    try:
+      redAgents = loadAgents(True, settings['red'], True, dict(settings['redArgs']))
+      blueAgents = loadAgents(False, settings['blue'], True, dict(settings['blueArgs']))
+      if None in redAgents or None in blueAgents:
+        raise Exception('A team could not be loaded')
+      agents = sum([list(el) for el in zip(redAgents, blueAgents)],[])
+
+      rules = CaptureRules()
+      rules.quiet = True
+      g = rules.newGame( layout, agents, textDisplay.NullGraphics(), settings['length'], True, True )
+    except Exception:
+      # A team whose createTeam fails loses this game, not the whole batch
+      traceback.print_exc()
+      result.update(score=None, winner=None, crashed=True, timeout=False, moves=0,
+                    agentTimes=None, wallTime=time.perf_counter() - start)
+      return result
+    g.run()
+
+  score = g.state.data.score
+  result.update(score=score, winner='Red' if score > 0 else 'Blue' if score < 0 else 'Tie',
+                crashed=g.agentCrashed and not g.agentTimeout, timeout=g.agentTimeout,
+                moves=len(g.moveHistory), agentTimes=[latencies.total for latencies in g.agentLatencies],
+                wallTime=time.perf_counter() - start)
+  return result
+
+def winRateDifference(results, confidence):
+  """
+  Estimates Red's win rate minus Blue's from batch results, as a tuple of
+  the estimate and the bounds of its confidence interval (normal
+  approximation).  Each game counts +1 for a Red win, -1 for a Blue win and
+  0 for a tie; games without a winner are left out.  The variance includes
+  one pseudo-win for each side, so that a streak of identical results does
+  not give an interval of width zero.
+  """
+  from statistics import NormalDist
+  outcomes = [{'Red': 1, 'Blue': -1, 'Tie': 0}[result['winner']]
+              for result in results if result['winner'] is not None]
+  if not outcomes: return 0.0, -1.0, 1.0
+  n = len(outcomes)
+  mean = sum(outcomes) / float(n)
+  padded = outcomes + [1, -1]
+  paddedMean = sum(padded) / float(len(padded))
+  variance = sum((x - paddedMean) ** 2 for x in padded) / (len(padded) - 1)
+  z = NormalDist().inv_cdf(0.5 + confidence / 2.0)
+  margin = z * (variance / n) ** 0.5
+  return mean, max(-1.0, mean - margin), min(1.0, mean + margin)
+
+def runBatch( red, blue, redArgs, blueArgs, layoutName, numGames, length, seed=0, processes=None, output=None,
+              stopConfidence=None, gamesPerLook=None ):
+  """
+  Plays numGames games between the teams in red and blue (team files, like
+  -r and -b) in a pool of processes, without display and with exceptions
+  caught and time limits enforced.  Returns the result of every game, in
+  game order, as dictionaries with the keys
+
+    game, seed, layout, score, winner ('Red', 'Blue' or 'Tie'), crashed,
+    timeout, moves, agentTimes (seconds each agent spent on its moves),
+    wallTime
+
+  and writes them to output as JSON lines, as the games finish, if given.
+  A team that fails to load or to create its agents counts as a crash,
+  with no score or winner.
+
+  With stopConfidence (e.g. 0.95) the games are played gamesPerLook at a
+  time, and the batch stops early once the confidence interval of the win
+  rate difference (see winRateDifference) excludes zero.  Every look at the
+  results spends an equal share of the error rate (a Bonferroni
+  correction), so stopping early keeps the overall level.  Looks happen
+  only after whole groups of games, so the games played do not depend on
+  the number of workers.
+  """
+  import json, multiprocessing
+  settings = {'red': red, 'blue': blue, 'redArgs': redArgs, 'blueArgs': blueArgs,
+              'layout': layoutName, 'length': length}
+  jobs = [(i, gameSeed, settings) for i, gameSeed in enumerate(batchSeeds(seed, numGames))]
+  if stopConfidence is None or not jobs:
+    groups = [jobs]
+  else:
+    if gamesPerLook is None: gamesPerLook = 4 * (processes or multiprocessing.cpu_count())
+    groups = [jobs[i:i + gamesPerLook] for i in range(0, len(jobs), gamesPerLook)]
+    lookConfidence = 1.0 - (1.0 - stopConfidence) / len(groups)
+  start = time.time()
+  results = []
+  interval = None
+  out = open(output, 'w') if output else None
+  try:
+    # One game per worker: team modules and module-level caches a game
+    # leaves behind must not reach the next one
+    with multiprocessing.Pool(processes, maxtasksperchild=1) as pool:
+      for group in groups:
+        for result in pool.imap_unordered(playBatchGame, group):
+          results.append(result)
+          if out is not None:
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+        if stopConfidence is not None:
+          interval = winRateDifference(results, lookConfidence)
+          if interval[1] > 0 or interval[2] < 0: break
+  finally:
+    if out is not None: out.close()
+  results.sort(key=lambda result: result['game'])
+
+  elapsed = time.time() - start
+  scores = [result['score'] for result in results if result['score'] is not None]
+  winners = [result['winner'] for result in results]
+  print('Played %d games in %.2fs (%.1f games/sec)' % (len(results), elapsed, len(results) / max(elapsed, 1e-9)))
+  if scores:
+    print('Average Score: %s' % (sum(scores) / float(len(scores))))
+  print('Red wins %d, Blue wins %d, Ties %d, Crashes %d, Timeouts %d' % (
+    winners.count('Red'), winners.count('Blue'), winners.count('Tie'),
+    sum(result['crashed'] for result in results), sum(result['timeout'] for result in results)))
+  if interval is not None:
+    estimate, low, high = interval
+    if low > 0 or high < 0:
+      verdict = '%s is stronger' % ('Red' if low > 0 else 'Blue')
+    else:
+      verdict = 'no significant difference'
+    print('Win rate difference (Red - Blue): %.3f, %g%% interval [%.3f, %.3f] (corrected for %d looks) after %d of %d games: %s' % (
+      estimate, stopConfidence * 100, low, high, len(groups), len(results), numGames, verdict))
+  return results
+
 def save_score(game):
     with open('score', 'w') as f:
         print(game.state.data.score, file=f)
@@ -1103,5 +1339,3 @@ if __name__ == '__main__':
 
   save_score(games[0])
   print('\nTotal Time Game: %s'% round(time.time() - start_time, 0))
-  # import profile
-  # profile.run('runGames( **options )', 'profile')
@@ -17,6 +17,7 @@
 """
 
 from game import Agent
+from game import readOnlyObservation
 import distanceCalculator
 from util import nearestPoint
 import util
@@ -99,10 +100,11 @@ class CaptureAgent(Agent):
     self.distancer.getDistance(p1, p2)
     """
     self.red = gameState.isOnRedTeam(self.index)
-    self.distancer = distanceCalculator.Distancer(gameState.data.layout)
 
-    # comment this out to forgo maze distance computation and use manhattan distances
-    self.distancer.getMazeDistances()
+    # All agents share one Distancer per layout, with maze distances ready.
+    # Use distanceCalculator.Distancer(gameState.data.layout) without calling
+    # getMazeDistances() to forgo them and use manhattan distances instead.
+    self.distancer = distanceCalculator.getDistancer(gameState.data.layout)
 
     import __main__
     if '_display' in dir(__main__):
@@ -118,6 +120,7 @@ class CaptureAgent(Agent):
     """
     self.agentsOnTeam = agentsOnTeam
 
+  @readOnlyObservation
   def observationFunction(self, gameState):
     " Changing this won't affect pacclient.py, but will affect capture.py "
     return gameState.makeObservation(self.index)
@@ -1,17 +1,21 @@
 import capture
 import layout
+import sandbox
 import textDisplay
 
 import argparse
 import collections
 import datetime
 import email.utils
+import hashlib
 import inspect
 import itertools
+import json
 import logging
 import math
 import mimetypes
 import multiprocessing
+import multiprocessing.connection
 import os
 import pickle
 import random
@@ -31,6 +35,22 @@ DEFAULT_SECRETS = os.path.join(os.path.dirname(__file__), 'hva.secrets')
 
 LOG_FILENAME = "log.txt"
 
+# Append-only record of finished games, kept in each results folder.
+JOURNAL_FILENAME = "journal.jsonl"
+# The live standings, next to report.html
+STANDINGS_FILENAME = "standings.json"
+
+# Average game times per team, used to schedule the longest matches first.
+MATCH_TIMES_FILENAME = os.path.join("results", "match_times.json")
+
+# Validation outcomes of submissions by content hash, reused between runs.
+VALIDATION_CACHE_FILENAME = os.path.join("results", "validation_cache.json")
+
+# The framework code a submission is validated against, next to this file;
+# a change to any of it makes earlier validation outcomes stale.
+FRAMEWORK_FILES = ("competition.py", "capture.py", "captureAgents.py", "game.py",
+        "util.py", "distanceCalculator.py", "layout.py")
+
 logging.basicConfig(filename=LOG_FILENAME,
         filemode="w+",
         format="%(asctime)s %(module)s %(levelname)s %(message)s",
@@ -209,6 +229,16 @@ def check_is_file(value):
     return value
 
 
+def check_is_dir(value):
+    """
+    argparse helper function to make sure value is a path to an existing
+    directory.
+    """
+    if not os.path.isdir(value):
+        raise argparse.ArgumentTypeError("{} is not a directory".format(value))
+    return value
+
+
 def test_mail_settings(secrets_file=DEFAULT_SECRETS):
     """
     Attempts to send a test email.
@@ -357,6 +387,47 @@ def parse_arguments():
             type=check_is_file, default=DEFAULT_SECRETS,
             help="File containing the 'secret' infomation.")
 
+    parser.add_argument("--sandbox", dest="sandbox",
+            action="store_true", default=False,
+            help="""Run each team's agents in a separate process with its own
+            CPU and memory limits (POSIX only).""")
+    parser.add_argument("--sandbox-memory", dest="sandbox_memory",
+            type=check_positive, default=2048, metavar="MB",
+            help="Address space limit of a sandboxed team in megabytes.")
+
+    parser.add_argument("--format", dest="tournament_format",
+            choices=TOURNAMENT_FORMATS, default="round-robin",
+            help="""Tournament format: a full round robin, a Swiss
+            tournament (teams with similar records meet each round), or a
+            rated tournament (Glicko ratings, updated after every game, pick
+            the most informative pairings and rank the teams).""")
+    parser.add_argument("--rounds", dest="rounds",
+            type=check_positive, default=None,
+            help="""Number of rounds of a Swiss or rated tournament (default:
+            log2 of the number of teams plus one for Swiss, twice that many
+            for rated).""")
+
+    parser.add_argument("--validation-timeout", dest="validation_timeout",
+            type=check_positive, default=60, metavar="SECONDS",
+            help="""Disqualify a submission whose createTeam calls take longer
+            than SECONDS to validate.""")
+    parser.add_argument("--match-timeout", dest="match_timeout",
+            type=check_positive, default=None, metavar="SECONDS",
+            help="""Count a match that takes longer than SECONDS as an error
+            for both teams (default: every agent using its whole time budget
+            in every game).""")
+    parser.add_argument("--report-interval", dest="report_interval",
+            type=check_positive, default=10, metavar="SECONDS",
+            help="""The report and standings.json in the results directory are
+            updated while matches are played, at most every SECONDS.""")
+
+    parser.add_argument("--resume", dest="resume",
+            type=check_is_dir, default=None, metavar="RESULTS_DIR",
+            help="""Continue an interrupted competition whose results are in
+            RESULTS_DIR (e.g., results/2020-01-31.12-00-00): the scoreboard
+            is rebuilt from its journal and only missing matches are
+            played. Use the same layout and number of games as before.""")
+
     parser.add_argument("--testmail", dest="test_mail",
                         action="store_true", default=False,
                         help="Only test mail server settings.")
@@ -391,6 +462,10 @@ def parse_arguments():
     agent_args = capture.parseAgentArgs(args.agentArgs)
     args.agentArgs = agent_args
 
+    if args.sandbox and not sandbox.AVAILABLE:
+        logging.warning("Sandboxes need os.fork, playing agents in-process")
+        args.sandbox = False
+
     args.delay_step = 0
     return args
 
@@ -421,7 +496,7 @@ def update_arguments(args, red_name, red_agents, blue_name, blue_agents):
     for _ in range(args.numGames):
         if args.layout_type[0] == "random":
             seed = args.layout_type[1]
-            l = layout.Layout(capture.randomLayout(seed).split('\n'))
+            l = layout.getRandomLayout(seed)
         else:
             l = args.layout_type[1]
         layouts.append(l)
@@ -496,6 +571,7 @@ class StudentError:
     CreateTeamRuntime = "createTeam ran into a RuntimeException."
     CreateTeamNoReturn = "createTeam returned nothing or None."
     createTeamWrongReturn = "createTeam did not return an indexable collection of 2 objects."
+    CreateTeamTimeout = "createTeam did not finish within the time limit."
 
 
 class Record:
@@ -617,12 +693,86 @@ class Record:
                 points=points)
 
 
+class Rating:
+    """
+    A Glicko rating: a team's estimated strength mu, on the Elo scale, and
+    the rating deviation rd, which tells how uncertain that estimate is.
+
+    Both change after every game (see update), so ratings can follow
+    results as they stream in instead of waiting for a whole round.
+    """
+    INITIAL_MU = 1500.0
+    INITIAL_RD = 350.0
+    # Keeps ratings able to move after many games
+    MIN_RD = 30.0
+    Q = math.log(10) / 400
+
+    def __init__(self, mu=INITIAL_MU, rd=INITIAL_RD):
+        self.mu = mu
+        self.rd = rd
+
+    @classmethod
+    def _g(cls, rd):
+        return 1 / math.sqrt(1 + 3 * (cls.Q * rd / math.pi) ** 2)
+
+    def expected(self, other):
+        """
+        The expected score (1 for a win, 0.5 for a tie) of self against
+        other.
+        """
+        return 1 / (1 + 10 ** (-self._g(other.rd) * (self.mu - other.mu) / 400))
+
+    def update(self, other, score):
+        """
+        Updates the rating after a game against other, with other's rating
+        from before the game.
+        """
+        g = self._g(other.rd)
+        expected = self.expected(other)
+        d2 = 1 / (self.Q ** 2 * g ** 2 * expected * (1 - expected))
+        precision = 1 / self.rd ** 2 + 1 / d2
+        self.mu += self.Q / precision * g * (score - expected)
+        self.rd = max(self.MIN_RD, math.sqrt(1 / precision))
+
+    def conservative(self):
+        """
+        A rating the team is very likely to have at least, used for ranking.
+        """
+        return self.mu - 2 * self.rd
+
+    def copy(self):
+        return Rating(self.mu, self.rd)
+
+    def __repr__(self):
+        return "Rating(mu={:.1f}, rd={:.1f})".format(self.mu, self.rd)
+
+
+TOURNAMENT_FORMATS = ("round-robin", "swiss", "rated")
+
+
+def default_rounds(tournament_format, num_teams):
+    """
+    Number of rounds of a Swiss or rated tournament when --rounds is not
+    given: enough for the ranking to settle while keeping the number of
+    matches in O(n log n).
+    """
+    rounds = max(1, math.ceil(math.log2(max(2, num_teams))))
+    if tournament_format == "swiss":
+        return rounds + 1
+    return 2 * rounds
+
+
 class Scoreboard:
-    def __init__(self):
+    def __init__(self, tournament_format="round-robin"):
+        self.tournament_format = tournament_format
         self.disqualified_teams = {}
         self._participating_teams = {}
         self.records = collections.defaultdict(
                 lambda: collections.defaultdict(Record))
+        # Every team's records added up, kept as results arrive
+        self.totals = collections.OrderedDict()
+        self.ratings = collections.defaultdict(Rating)
+        self.byes = set()
         self._lock = multiprocessing.Lock()
 
     def disqualify(self, teams):
@@ -653,16 +803,42 @@ class Scoreboard:
         with self._lock:
             self.records[leftTeam][rightTeam].update(points, leftResult)
             self.records[rightTeam][leftTeam].update(-points, rightResult)
+            for team, team_points, result in ((leftTeam, points, leftResult),
+                    (rightTeam, -points, rightResult)):
+                self.totals.setdefault(team, Record()).update(team_points, result)
+            left = self.ratings[leftTeam]
+            right = self.ratings[rightTeam]
+            before = left.copy()
+            score = 1.0 if points > 0 else 0.0 if points < 0 else 0.5
+            left.update(right, score)
+            right.update(before, 1.0 - score)
 
     def ranking(self):
         """
-        Returns a list of team names, sorted by highest-ranking teams first.
+        Returns a list of (team name, total Record) pairs, sorted by
+        highest-ranking teams first.  Rated tournaments rank by the
+        conservative rating, the others by the records.
         """
-        totals = []
-        for team in self.records.keys():
-            totals.append((team, sum(self.records[team].values(), Record())))
+        totals = list(self.totals.items())
+        if self.tournament_format == "rated":
+            return sorted(totals, key=lambda x: self.ratings[x[0]].conservative(),
+                    reverse=True)
+        if self.tournament_format == "swiss":
+            # Ties are broken by the Buchholz score: the total score of the
+            # opponents met, since not everybody met the same opponents
+            scores = {team: record.score() for team, record in totals}
+            buchholz = {team: sum(scores.get(rival, 0) for rival in self.records[team])
+                    for team in scores}
+            return sorted(totals, key=lambda x: (x[1].score(), buchholz[x[0]],
+                x[1].points), reverse=True)
         return sorted(totals, key=lambda x: x[1], reverse=True)
 
+    def games_played(self, team, rival):
+        record = self.records.get(team, {}).get(rival)
+        if record is None:
+            return 0
+        return record.win + record.tie + record.lost + record.error
+
     def make_pairings(self):
         """
         Generate all game pairings of all participants.
@@ -670,17 +846,83 @@ class Scoreboard:
         Each team plays against each other team a single time.  The team's home
         side is randomized.
 
-        The returned value is a multiprocessing.Queue.
+        The returned value is a list of ((red_name, red_factory),
+        (blue_name, blue_factory)) pairings.
         """
         def _shuffled(x):
             y = list(x)
             random.shuffle(y)
             return y
         combinations = itertools.combinations(self._participating_teams.items(), 2)
-        queue = multiprocessing.Queue()
-        for match in combinations:
-            queue.put(_shuffled(match))
-        return queue
+        return [_shuffled(match) for match in combinations]
+
+    def _take_bye(self, teams):
+        """
+        With an odd number of teams, removes the lowest placed team in teams
+        that has not had a bye yet; it sits out this round.
+        """
+        if len(teams) % 2 == 0:
+            return teams
+        candidates = [team for team in teams if team not in self.byes] or teams
+        bye = candidates[-1]
+        self.byes.add(bye)
+        logging.info("{} has a bye this round".format(bye))
+        return [team for team in teams if team != bye]
+
+    def _pair(self, teams, opponent_key):
+        """
+        Pairs teams greedily in the given order: each unpaired team plays the
+        unpaired team that minimises opponent_key(team, rival).  Returns the
+        pairings like make_pairings.
+        """
+        factories = self._participating_teams
+        unpaired = list(teams)
+        matches = []
+        while len(unpaired) > 1:
+            team = unpaired.pop(0)
+            rival = min(unpaired, key=lambda rival: opponent_key(team, rival))
+            unpaired.remove(rival)
+            match = [(team, factories[team]), (rival, factories[rival])]
+            random.shuffle(match)
+            matches.append(match)
+        return matches
+
+    def make_swiss_pairings(self):
+        """
+        Generates one round of a Swiss tournament.
+
+        Teams are ordered by their records so far, and every team plays the
+        closest placed team it has played least often, so strong teams meet
+        strong teams and each round is only n / 2 matches.
+        """
+        totals = dict(self.ranking())
+        order = sorted(self._participating_teams,
+                key=lambda team: (totals.get(team, Record()).score(),
+                    totals.get(team, Record()).points), reverse=True)
+        order = self._take_bye(order)
+        place = {team: i for i, team in enumerate(order)}
+        return self._pair(order, lambda team, rival: (
+            self.games_played(team, rival), place[rival]))
+
+    def make_rated_pairings(self):
+        """
+        Generates one round of a rated tournament.
+
+        The teams whose ratings are least certain choose their opponent
+        first, and play the team with the closest rating among those they
+        have played least often: those games tell the most about the
+        ranking.
+        """
+        ratings = self.ratings
+        order = sorted(self._participating_teams,
+                key=lambda team: (-ratings[team].rd, team))
+        by_rating = sorted(order, key=lambda team: ratings[team].mu, reverse=True)
+        # The bye goes to a low rated team, as in a Swiss tournament
+        sitting_out = set(by_rating) - set(self._take_bye(by_rating))
+        order = [team for team in order if team not in sitting_out]
+        return self._pair(order, lambda team, rival: (
+            self.games_played(team, rival),
+            abs(ratings[team].mu - ratings[rival].mu)))
 
     @property
     def participants(self):
@@ -695,39 +937,132 @@ class Scoreboard:
             self._participating_teams.keys())))
 
 
-def generate_html_report(scoreboard, report_file, courseName, timestamp_start, timestamp_finish, layout, **args):
+REPORT_STYLE = """
+.disqualified {
+  color: red;
+}
+td, th {
+  text-align: center;
+}
+
+th[scope="row"] {
+  text-align: right;
+}
+
+.win {
+  background-color: lightgreen;
+}
+.tie {
+  background-color: lavender;
+}
+.lost {
+  background-color: lightblue;
+}
+.error {
+  background-color: lightsalmon;
+}
+.points {
+  background-color: lightgoldenrodyellow;
+}
+
+td[colspan] {
+  background-color: lightgrey;
+}
+
+caption {
+  font-style: italic;
+}
+"""
+
+
+class HtmlReport:
     """
-    Make an HTML document that will represent the score in scoreboard.
+    The HTML report of a competition and its JSON standings feed, kept up to
+    date while the matches are played.
+
+    Each row of the results per matchup is rendered once and kept; add_results
+    marks the rows of the teams that just played, and a write renders only
+    those again before joining the rows.  The ranking comes from the totals
+    the scoreboard keeps, so a write never walks every pair of teams.
+    Writes replace the files atomically, so a browser never shows half a
+    report, and live writes come at most every `interval` seconds.  The log
+    file is only added to the final report (see finish).
     """
-    fmt = {}
-    fmt['courseName'] = courseName
-    fmt['timestamp_start'] = timestamp_start
-    fmt['timestamp_finish'] = timestamp_finish
-    fmt['layout'] = layout
-    fmt['argv'] = sys.argv
-
-    fmt['title'] = "{} Capture the Flag results of {:%d-%m-%Y}".format(courseName, timestamp_start)
-    fmt['duration'] = timestamp_finish - timestamp_start
-    fmt['Result'] = Result
-    fmt['disqualified_teams'] = ""
-    for team, error in scoreboard.disqualified_teams.items():
-        fmt['disqualified_teams'] += "<li><strong>{}</strong>: {}</li>".format(
-                team, error)
-
-    if len(fmt['disqualified_teams']):
-        fmt['disqualified_teams'] = """
-<p class="disqualified">The following teams are disqualified by initial inspection:
-</p>
-  <ul class="disqualified">
-    {}
-  </ul>""".format(fmt['disqualified_teams'])
+    def __init__(self, scoreboard, report_file, standings_file, courseName,
+            timestamp_start, layout, interval=10):
+        self.scoreboard = scoreboard
+        self.report_file = report_file
+        self.standings_file = standings_file
+        self.courseName = courseName
+        self.timestamp_start = timestamp_start
+        self.layout = layout
+        self.interval = interval
+        self.num_games = 0
+        self._last_write = None
+        self._rows = {}
+        self._dirty = set(scoreboard.participants)
+
+    def add_results(self, results):
+        """
+        Takes a batch of (red_name, blue_name, ...) game results that were
+        already added to the scoreboard, and writes the files if the last
+        write is old enough.
+        """
+        for red_name, blue_name in (result[:2] for result in results):
+            self._dirty.update((red_name, blue_name))
+        self.num_games += len(results)
+        if self._last_write is None or time.time() - self._last_write >= self.interval:
+            self.write()
+
+    def finish(self, timestamp_finish):
+        """
+        Writes the final report, with the log file, and the final standings.
+        Every row is rendered again, so the final report never depends on
+        all results having come through add_results.
+        """
+        self._dirty.update(self.scoreboard.participants)
+        self.write(timestamp_finish)
 
-    fmt['game_outcomes'] = ''
-    if scoreboard.participants:
-        fmt['ranking'] = ""
+    def write(self, timestamp_finish=None):
+        self._last_write = time.time()
+        _write_atomically(self.report_file, self.render(timestamp_finish))
+        if self.standings_file:
+            standings = self.standings(timestamp_finish)
+            _write_atomically(self.standings_file, json.dumps(standings, indent=1))
+
+    def standings(self, timestamp_finish=None):
+        """
+        The ranking as a JSON-serializable dictionary.
+        """
+        scoreboard = self.scoreboard
+        rows = []
+        for i, (team, record) in enumerate(scoreboard.ranking()):
+            row = {'position': i + 1, 'team': team, 'score': record.score(),
+                    'points': record.points, 'win': record.win, 'tie': record.tie,
+                    'lost': record.lost, 'error': record.error}
+            if scoreboard.tournament_format == "rated":
+                rating = scoreboard.ratings[team]
+                row['rating'] = {'mu': rating.mu, 'rd': rating.rd}
+            rows.append(row)
+        return {
+            'updated': datetime.datetime.now().isoformat(),
+            'started': self.timestamp_start.isoformat(),
+            'finished': timestamp_finish.isoformat() if timestamp_finish else None,
+            'format': scoreboard.tournament_format,
+            'games': self.num_games,
+            'disqualified': scoreboard.disqualified_teams,
+            'standings': rows,
+        }
+
+    def _ranking_rows(self):
+        scoreboard = self.scoreboard
+        rows = []
         for i, (n, r) in enumerate(scoreboard.ranking()):
             s = r.score()
-            fmt['ranking'] += """    <tr>
+            if scoreboard.tournament_format == "rated":
+                rating = scoreboard.ratings[n]
+                s = "{} (rating {:.0f} &plusmn; {:.0f})".format(s, rating.mu, 2 * rating.rd)
+            rows.append("""    <tr>
           <td>{i}</td>
           <td>{n}</td>
           <td class="points">{r.points}</td>
@@ -737,22 +1072,75 @@ def generate_html_report(scoreboard, report_file, courseName, timestamp_start, t
           <td class="error">{r.error}</td>
           <td class="score">{s}</td>
         </tr>
-    """.format(i=i+1, n=n, r=r, s=s)
+    """.format(i=i+1, n=n, r=r, s=s))
+        return "".join(rows)
+
+    def _matchup_row(self, team, participants):
+        records = self.scoreboard.records.get(team, {})
+        cells = ['    <tr>\n', '      <th scope="row">{}</th>\n'.format(team)]
+        for rival in participants:
+            if rival == team:
+                cells.append('      <td colspan="5">&mdash;</td>\n')
+            else:
+                cells.append("""
+          <td class="points">{r.points}</td>
+          <td class="win">{r.win}</td>
+          <td class="tie">{r.tie}</td>
+          <td class="lost">{r.lost}</td>
+          <td class="error">{r.error}</td>\n""".format(r=records.get(rival) or Record()))
+        cells.append('    </tr>\n')
+        return "".join(cells)
+
+    def render(self, timestamp_finish=None):
+        """
+        Returns the report as an HTML document.  It is final, with the
+        duration and the log file, when timestamp_finish is given.
+        """
+        scoreboard = self.scoreboard
+        fmt = {}
+        fmt['courseName'] = self.courseName
+        fmt['timestamp_start'] = self.timestamp_start
+        fmt['layout'] = self.layout
+        fmt['argv'] = sys.argv
+        fmt['style'] = REPORT_STYLE
+
+        fmt['title'] = "{} Capture the Flag results of {:%d-%m-%Y}".format(self.courseName, self.timestamp_start)
+        if timestamp_finish is None:
+            fmt['progress'] = """is still running: these are the results of the
+{} games played up to {:%d-%m-%Y, %H:%M:%S}.""".format(self.num_games, datetime.datetime.now())
+            fmt['refresh'] = '<meta http-equiv="refresh" content="{}">\n'.format(max(1, int(self.interval)))
+        else:
+            fmt['progress'] = """ended at
+{:%d-%m-%Y, %H:%M:%S}.
+Running all simulations took {} time.""".format(timestamp_finish, timestamp_finish - self.timestamp_start)
+            fmt['refresh'] = ''
+        fmt['Result'] = Result
+        fmt['disqualified_teams'] = "".join("<li><strong>{}</strong>: {}</li>".format(
+                team, error) for team, error in scoreboard.disqualified_teams.items())
+
+        if len(fmt['disqualified_teams']):
+            fmt['disqualified_teams'] = """
+<p class="disqualified">The following teams are disqualified by initial inspection:
+</p>
+  <ul class="disqualified">
+    {}
+  </ul>""".format(fmt['disqualified_teams'])
 
+        fmt['game_outcomes'] = ''
+        fmt['ranking_note'] = ''
+        if scoreboard.tournament_format == "rated":
+            fmt['ranking_note'] = """<p>This was a rated tournament, in which not every
+team meets every other team: teams are ranked by their rating minus twice its
+uncertainty, which is shown next to their competition score.</p>"""
         participants = scoreboard.participants
-        header = ''
-        subheader = len(participants) * """
-          <th scope="col" class="points">Points</th>
-          <th scope="col" class="win">Win</th>
-          <th scope="col" class="tie">Tie</th>
-          <th scope="col" class="lost">Lost</th>
-          <th scope="col" class="error">Error</th>
-    """
-        fmt['game_outcomes'] = """
+        if participants:
+            fmt['ranking'] = self._ranking_rows()
+            fmt['game_outcomes'] = """
 <h2>Team ranking</h2>
 The team ranking is based on a total competition score.  Each result type is
 worth a number of points, as can be seen in the table below.  In case of equal
 competition scores, teams with more points collected will be ranked higher.
+{ranking_note}
 <table>
   <thead>
     <tr>
@@ -800,27 +1188,26 @@ competition scores, teams with more points collected will be ranked higher.
 </table>
 """.format(**fmt)
 
-
-    if len(scoreboard.participants) > 1:
-        results = ''
-
-        for team in participants:
-            header += '    <th scope="colgroup" colspan="5">{}</th>\n'.format(team)
-            results += '    <tr>\n'
-            results += '      <th scope="row">{}</th>\n'.format(team)
-            for rival in participants:
-                if rival == team:
-                    results += '      <td colspan="5">&mdash;</td>\n'
-                else:
-                    r = """
-          <td class="points">{r.points}</td>
-          <td class="win">{r.win}</td>
-          <td class="tie">{r.tie}</td>
-          <td class="lost">{r.lost}</td>
-          <td class="error">{r.error}</td>\n"""
-                    results += r.format(r=scoreboard.records[team][rival])
-            results += '    </tr>\n'
-        fmt['results'] = """
+        if len(participants) > 1:
+            if set(self._rows) != set(participants):
+                # The columns changed, so every row has to be rendered again
+                self._rows = {}
+                self._dirty = set(participants)
+            for team in self._dirty:
+                if team in participants:
+                    self._rows[team] = self._matchup_row(team, participants)
+            self._dirty = set()
+            header = "".join('    <th scope="colgroup" colspan="5">{}</th>\n'.format(team)
+                    for team in participants)
+            subheader = len(participants) * """
+          <th scope="col" class="points">Points</th>
+          <th scope="col" class="win">Win</th>
+          <th scope="col" class="tie">Tie</th>
+          <th scope="col" class="lost">Lost</th>
+          <th scope="col" class="error">Error</th>
+    """
+            results = "".join(self._rows[team] for team in participants)
+            fmt['results'] = """
         <tr>
           <td rowspan="2"></td>
           {header}
@@ -829,7 +1216,7 @@ competition scores, teams with more points collected will be ranked higher.
     {subheader}
         </tr>
     {results}""".format(header=header, subheader=subheader, results=results)
-        fmt['game_outcomes'] += """
+            fmt['game_outcomes'] += """
 
 <h2>Results per matchup</h2>
 <table>
@@ -837,54 +1224,19 @@ competition scores, teams with more points collected will be ranked higher.
 {results}
 </table>""".format(**fmt)
 
-    log_contents = "".join(open(LOG_FILENAME, 'r').readlines())
-    # TODO: Track down where all NUL characters come from in the log
-    log_contents = log_contents.replace("\0", "")
-    fmt['log'] = """<h2>Log file</h2>
+        fmt['log'] = ''
+        if timestamp_finish is not None:
+            log_contents = "".join(open(LOG_FILENAME, 'r').readlines())
+            # TODO: Track down where all NUL characters come from in the log
+            log_contents = log_contents.replace("\0", "")
+            fmt['log'] = """<h2>Log file</h2>
     <pre>{}</pre>""".format(log_contents)
 
-
-    with open(report_file, 'w') as f:
-        f.write("""<!doctype html>
+        return """<!doctype html>
 <html lang="en">
 <head>
 <meta charset="utf-8">
-<style>
-.disqualified {{
-  color: red;
-}}
-td, th {{
-  text-align: center;
-}}
-
-th[scope="row"] {{
-  text-align: right;
-}}
-
-.win {{
-  background-color: lightgreen;
-}}
-.tie {{
-  background-color: lavender;
-}}
-.lost {{
-  background-color: lightblue;
-}}
-.error {{
-  background-color: lightsalmon;
-}}
-.points {{
-  background-color: lightgoldenrodyellow;
-}}
-
-td[colspan] {{
-  background-color: lightgrey;
-}}
-
-caption {{
-  font-style: italic;
-}}
-</style>
+{refresh}<style>{style}</style>
 <title>{title}</title>
 <meta name="generator" content="Julian and Patricks awesome competition script!">
 
@@ -894,9 +1246,7 @@ caption {{
 
 <p>These are the results for a run of the Capture the Flag
 competition, part of the course {courseName}. The simulation
-started at {timestamp_start:%d-%m-%Y, %H:%M:%S}, and ended at
-{timestamp_finish:%d-%m-%Y, %H:%M:%S}.
-Running all simulations took {duration} time.  It was played on
+started at {timestamp_start:%d-%m-%Y, %H:%M:%S}, and {progress}  It was played on
 the <strong>{layout}</strong> map.</p>
 
 {disqualified_teams}
@@ -907,7 +1257,22 @@ the <strong>{layout}</strong> map.</p>
 -->
 {log}
 </body>
-</html>""".format(**fmt))
+</html>""".format(**fmt)
+
+
+def _write_atomically(filename, text):
+    tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        f.write(text)
+    os.replace(tmp_filename, filename)
+
+
+def generate_html_report(scoreboard, report_file, courseName, timestamp_start, timestamp_finish, layout, **args):
+    """
+    Make an HTML document that will represent the score in scoreboard.
+    """
+    report = HtmlReport(scoreboard, report_file, None, courseName, timestamp_start, layout)
+    report.finish(timestamp_finish)
 
 
 def download_student_data(secrets):
@@ -979,7 +1344,182 @@ def get_student_modules(module):
     return submodules
 
 
-def analyse_student_modules(student_modules):
+def framework_digest():
+    """
+    A content hash of the FRAMEWORK_FILES.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha1()
+    for name in FRAMEWORK_FILES:
+        with open(os.path.join(directory, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def submission_digest(student_module):
+    """
+    A content hash of a student module: its file or, for a package, every
+    file in it (data files included, compiled ones left out), by relative
+    path and content.
+    """
+    paths = [(os.path.basename(student_module.__file__), student_module.__file__)]
+    if hasattr(student_module, "__path__"):
+        paths = []
+        for directory in student_module.__path__:
+            for root, dirs, files in os.walk(directory):
+                dirs[:] = sorted(name for name in dirs if name != "__pycache__")
+                paths.extend((os.path.relpath(os.path.join(root, name), directory),
+                        os.path.join(root, name)) for name in sorted(files)
+                        if not name.endswith(".pyc"))
+    digest = hashlib.sha1()
+    for name, path in paths:
+        digest.update(name.encode() + b'\0')
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def validate_team(student_module):
+    """
+    Checks a student module's createTeam function, and returns the
+    StudentError describing why it is disqualified, or None.
+    """
+    if not hasattr(student_module, "createTeam"):
+        return StudentError.NoCreateTeam
+    error = None
+    createTeam = getattr(student_module, "createTeam")
+    team_red = None
+    team_blue = None
+    try:
+        with silence_stdout():
+            team_red = createTeam(0, 1, True)
+            team_blue = createTeam(2, 3, False)
+    except:
+        arg_spec = inspect.getfullargspec(createTeam)
+        all_args = len(arg_spec.args)
+        nondefault_args = all_args - len(arg_spec.defaults or ())
+        if all_args < 3:
+            error = StudentError.CreateTeamTooFewArgs
+        elif nondefault_args > 3:
+            error = StudentError.CreateTeamTooManyNondefaults
+        else:
+            error = StudentError.CreateTeamRuntime
+
+    if None in (team_red, team_blue) and error is not None:
+        error = StudentError.CreateTeamNoReturn
+    else:
+        try:
+            if len(team_red) != 2 or len(team_blue) != 2:
+                raise TypeError(StudentError.createTeamWrongReturn)
+        except:
+            error = StudentError.createTeamWrongReturn
+    return error
+
+
+def _validate_in_child(module_name, connection):
+    status = 1
+    try:
+        # Forked children find the student modules the parent already imported
+        student_module = sys.modules.get(module_name)
+        if student_module is None:
+            import importlib
+            student_module = importlib.import_module(module_name)
+        connection.send(validate_team(student_module))
+        connection.close()
+        status = 0
+    finally:
+        # Exit at once: a thread createTeam started must not keep the
+        # child, and the parent joining it, waiting
+        os._exit(status)
+
+
+class ValidationCache:
+    """
+    Validation outcomes of earlier runs, by framework_digest and
+    submission_digest, so that unchanged submissions are not validated
+    again.  Timeouts are not kept,
+    as they may come from a busy machine rather than from the submission.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._errors = {}
+        if filename and os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    self._errors = json.load(f)
+            except (OSError, ValueError):
+                logging.warning("Ignoring unreadable validation cache {}".format(filename))
+
+    def __contains__(self, digest):
+        return digest in self._errors
+
+    def get(self, digest):
+        return self._errors[digest]
+
+    def put(self, digest, error):
+        if error != StudentError.CreateTeamTimeout:
+            self._errors[digest] = error
+
+    def save(self):
+        if not self.filename:
+            return
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.filename, 'w') as f:
+            json.dump(self._errors, f, indent=1, sort_keys=True)
+
+
+def validate_submissions(student_modules, threads=1, timeout=None):
+    """
+    Runs validate_team on every module, each in its own child process with
+    at most `threads` running at once.  A child still running after
+    `timeout` seconds is killed and its module disqualified, so a hanging
+    createTeam cannot hold up the competition.  Returns a dictionary from
+    module name to error (or None).
+    """
+    pending = [student_module.__name__ for student_module in student_modules]
+    running = {}
+    errors = {}
+    while pending or running:
+        while pending and len(running) < max(1, threads):
+            module_name = pending.pop(0)
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_validate_in_child,
+                    args=(module_name, sender), daemon=True)
+            process.start()
+            sender.close()
+            deadline = None if timeout is None else time.time() + timeout
+            running[receiver] = (module_name, process, deadline)
+
+        deadlines = [deadline for _, _, deadline in running.values() if deadline is not None]
+        wait_time = max(0, min(deadlines) - time.time()) if deadlines else None
+        for receiver in multiprocessing.connection.wait(list(running), wait_time):
+            module_name, process, _ = running.pop(receiver)
+            try:
+                errors[module_name] = receiver.recv()
+            except (EOFError, OSError):
+                # The child died without an answer, e.g. createTeam exited
+                errors[module_name] = StudentError.CreateTeamRuntime
+            receiver.close()
+            process.join(1)
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+        now = time.time()
+        for receiver, (module_name, process, deadline) in list(running.items()):
+            if deadline is not None and now >= deadline:
+                logging.warning("{} did not finish createTeam in {}s".format(module_name, timeout))
+                process.kill()
+                process.join()
+                receiver.close()
+                del running[receiver]
+                errors[module_name] = StudentError.CreateTeamTimeout
+    return errors
+
+
+def analyse_student_modules(student_modules, threads=1, timeout=None, cache_file=None):
     """
     Find out which modules work as expected.
 
@@ -988,15 +1528,19 @@ def analyse_student_modules(student_modules):
     - a list of agent factories contained in the modules that stick to the
       rules.
     - a list of ModuleErrors for modules not sticking to the rules.
+
+    Modules are validated in parallel (see validate_submissions), unless
+    neither they nor the framework changed since a run that used the same
+    cache_file.
     """
     email_addresses = set()
     agent_factories = {}
     disqualified_teams = {}
+    cache = ValidationCache(cache_file)
+    framework = framework_digest()
+    digests = {}
+    to_validate = []
     for student_module in student_modules:
-        module_name = student_module.__name__
-        team_name = '.'.join(module_name.split('.')[1:])
-        error = None
-
         if hasattr(student_module, "CONTACT"):
             student_contact = getattr(student_module, "CONTACT")
             if type(student_contact) == str:
@@ -1006,39 +1550,32 @@ def analyse_student_modules(student_modules):
                     if type(contact) == str:
                         email_addresses.update(contact.split(","))
 
-        if not hasattr(student_module, "createTeam"):
-            error = StudentError.NoCreateTeam
+        try:
+            digests[student_module.__name__] = framework + ":" + submission_digest(student_module)
+        except (OSError, TypeError):
+            digests[student_module.__name__] = None
+        if digests[student_module.__name__] not in cache:
+            to_validate.append(student_module)
+
+    logging.info("Validating {} of {} submissions ({} unchanged)".format(
+        len(to_validate), len(student_modules), len(student_modules) - len(to_validate)))
+    errors = validate_submissions(to_validate, threads, timeout)
+
+    for student_module in student_modules:
+        module_name = student_module.__name__
+        team_name = '.'.join(module_name.split('.')[1:])
+        digest = digests[module_name]
+        if module_name in errors:
+            error = errors[module_name]
+            if digest is not None:
+                cache.put(digest, error)
         else:
-            createTeam = getattr(student_module, "createTeam")
-            team_red = None
-            team_blue = None
-            try:
-                with silence_stdout():
-                    team_red = createTeam(0, 1, True)
-                    team_blue = createTeam(2, 3, False)
-            except:
-                arg_spec = inspect.getfullargspec(createTeam)
-                all_args = len(arg_spec.args)
-                nondefault_args = all_args - len(arg_spec.defaults)
-                if all_args < 3:
-                    error = StudentError.CreateTeamTooFewArgs
-                elif nondefault_args > 3:
-                    error = StudentError.CreateTeamTooManyNondefaults
-                else:
-                    error = StudentError.CreateTeamRuntime
-
-            if None in (team_red, team_blue) and error is not None:
-                error = StudentError.CreateTeamNoReturn
-            else:
-                try:
-                    if len(team_red) != 2 or len(team_blue) != 2:
-                        raise TypeError(StudentError.CreateTeamWrongReturn)
-                except:
-                    error = StudentError.CreateTeamWrongReturn
+            error = cache.get(digest)
         if error:
             disqualified_teams[team_name] = error
         else:
-            agent_factories[team_name] = createTeam
+            agent_factories[team_name] = getattr(student_module, "createTeam")
+    cache.save()
 
     return email_addresses, agent_factories, disqualified_teams
 
@@ -1188,89 +1725,401 @@ AI Capture the Flag Competition Bot"""))
     smtp.quit()
 
 
-def run_match(runner_id, args, output_dir, match_queue, results, is_done):
+def layout_key(args):
+    """
+    Names the layouts a competition plays on, for the results journal.
     """
-    Worker for multithreading, runs a single match at a time.
+    kind, value = args.layout_type
+    if kind == "random":
+        return "RANDOM{}".format("" if value is None else value)
+    return args.layout
 
-    This function will prepare everything to make a call to capture.runGames
-    for the matches in match_queue, a multiprocessing.Queue.  Results of
-    capture.runGames are put into results, another multiprocessing.Queue.
+
+class ResultsJournal:
     """
-    while not match_queue.empty():
-        try:
-            matchno = match_queue.qsize()
-            (red_name, red_factory), (blue_name, blue_factory) = match_queue.get(timeout=1)
-            logging.info("Playing match {}: {} vs {}".format(matchno, red_name, blue_name))
-            red_result = Result.WIN
-            blue_result = Result.WIN
-
-            if args.fixRandomSeed:
-                random.seed('cs188')
-
-            # Create agents, check on errors in this part.
-            red_agents = None
-            blue_agents = None
+    An append-only log of finished games, one JSON object per line.
+
+    Games are keyed by (red, blue, game index, layout), so a competition
+    can be resumed after a crash: see completed_matches.  Every append is
+    flushed to disk before it returns.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def entries(self):
+        """
+        Returns the journal's games as a dictionary from their key to the
+        recorded game.  Later entries replace earlier ones with the same key,
+        and a line cut short by a crash is skipped.
+        """
+        games = collections.OrderedDict()
+        if not os.path.exists(self.filename):
+            return games
+        with open(self.filename) as f:
+            for line in f:
+                try:
+                    game = json.loads(line)
+                except ValueError:
+                    logging.warning("Skipping damaged journal line: {!r}".format(line))
+                    continue
+                games[(game['red'], game['blue'], game['game'], game['layout'])] = game
+        return games
+
+    def append(self, results, layout):
+        """
+        Records the (red_name, blue_name, points, red_result, blue_result)
+        results of a match's games, in game order.
+        """
+        with open(self.filename, 'a+') as f:
+            # Start on a fresh line if a crash cut the last one short.
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                if f.read(1) != '\n':
+                    f.write('\n')
+            for index, (red, blue, points, red_result, blue_result) in enumerate(results):
+                f.write(json.dumps({
+                    'red': red, 'blue': blue, 'game': index, 'layout': layout,
+                    'points': points, 'red_result': red_result,
+                    'blue_result': blue_result,
+                    'time': datetime.datetime.now().isoformat(),
+                    }) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def completed_matches(self, layout, num_games):
+        """
+        Returns the games of every match that has all num_games games on
+        layout in the journal, as a dictionary from (red, blue) to the list
+        of games.
+        """
+        matches = collections.defaultdict(dict)
+        for (red, blue, index, game_layout), game in self.entries().items():
+            if game_layout == layout and index < num_games:
+                matches[red, blue][index] = game
+        return {teams: [games[i] for i in range(num_games)]
+                for teams, games in matches.items() if len(games) == num_games}
+
+
+class MatchTimes:
+    """
+    Keeps the average wall time of each team's games, to predict how long a
+    match will take.
+
+    Times are saved between runs, so a tournament can schedule its slowest
+    matches first from the start.  Teams without a history are assumed to
+    be average.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._times = {}
+        if filename and os.path.exists(filename):
             try:
-                with silence_stdout():
-                    red_agents = mute_agents(red_factory(0, 2, True,
-                        **args.agentArgs))
-            except:
-                red_result = Result.ERROR
+                with open(filename) as f:
+                    self._times = {team: tuple(times) for team, times in json.load(f).items()}
+            except (OSError, ValueError):
+                logging.warning("Ignoring unreadable match times in {}".format(filename))
+
+    def team_time(self, team):
+        """
+        Average seconds per game for team.
+        """
+        if team in self._times:
+            total, games = self._times[team]
+            return total / games
+        if not self._times:
+            return 1.0
+        return (sum(total for total, _ in self._times.values())
+                / sum(games for _, games in self._times.values()))
+
+    def expected(self, match):
+        """
+        Expected seconds per game of match, a ((red, _), (blue, _)) pairing.
+        """
+        (red_name, _), (blue_name, _) = match
+        return (self.team_time(red_name) + self.team_time(blue_name)) / 2
+
+    def update(self, red_name, blue_name, seconds, games):
+        for team in (red_name, blue_name):
+            total, count = self._times.get(team, (0.0, 0))
+            self._times[team] = (total + seconds, count + games)
+
+    def save(self):
+        if not self.filename:
+            return
+        with open(self.filename, 'w') as f:
+            json.dump(self._times, f, indent=1, sort_keys=True)
+
+
+def create_agents(args, factory, first_index, second_index, is_red, sandboxes):
+    """
+    Creates a team's agents with factory, in-process and muted or, with
+    --sandbox, in a worker process that is appended to sandboxes.
+    """
+    if not args.sandbox:
+        return mute_agents(factory(first_index, second_index, is_red,
+            **args.agentArgs))
+    # Both agents may use all of their time budget in every game
+    rules = capture.CaptureRules()
+    cpu_limit = args.numGames * 2 * (rules.getMaxStartupTime(first_index)
+            + rules.getMaxTotalTime(first_index))
+    team = sandbox.TeamSandbox(factory, first_index, second_index, is_red,
+            args.agentArgs, cpu_limit, args.sandbox_memory * 1024 * 1024)
+    sandboxes.append(team)
+    return team.agents
+
+
+def run_match(matchno, args, output_dir, match):
+    """
+    Plays a single match in its worker process (see run_matches).
+
+    This function will prepare everything to make a call to capture.runGames
+    for match, a ((red_name, red_factory), (blue_name, blue_factory)) pairing.
+    It returns the result of every game as a (red_name, blue_name, points,
+    red_result, blue_result) tuple, along with the match's wall time.
+    """
+    (red_name, red_factory), (blue_name, blue_factory) = match
+    start_time = time.time()
+    logging.info("Playing match {}: {} vs {}".format(matchno, red_name, blue_name))
+    red_result = Result.WIN
+    blue_result = Result.WIN
+
+    if args.fixRandomSeed:
+        random.seed('cs188')
+
+    # Create agents, check on errors in this part.
+    red_agents = None
+    blue_agents = None
+    sandboxes = []
+    try:
+        with silence_stdout():
+            red_agents = create_agents(args, red_factory, 0, 2, True, sandboxes)
+    except:
+        red_result = Result.ERROR
+    try:
+        with silence_stdout():
+            blue_agents = create_agents(args, blue_factory, 1, 3, False, sandboxes)
+    except:
+        blue_result = Result.ERROR
+
+    if Result.ERROR in (red_result, blue_result):
+        err_msg = "Match {}: An error occured during {}'s createTeam"
+        if red_result == Result.ERROR:
+            logging.error(err_msg.format(matchno, red_name))
+        if blue_result == Result.ERROR:
+            logging.error(err_msg.format(matchno, blue_name))
+        logging.info("{} vs {} ended in {}-{} with {} pts".format(
+            red_name, blue_name,
+            Result.get_name(red_result), Result.get_name(blue_result),
+            0))
+        results = [(red_name, blue_name, 0, red_result, blue_result)] * args.numGames
+        for team in sandboxes:
+            team.close()
+        return results, time.time() - start_time
+
+    # Play the game!
+    _args = update_arguments(args, red_name, red_agents, blue_name, blue_agents)
+    log_prefix = "{} ({} vs {}): ".format(matchno, red_name, blue_name)
+    results = []
+    with tempfile.TemporaryDirectory(prefix="pacman-{}-{}-{}-".format(matchno, red_name, blue_name)) as tmpdirname:
+        curdir = os.path.abspath(os.curdir)
+        with log_stdout(prefix=log_prefix):
+            with log_stderr(prefix=log_prefix):
+                os.chdir(tmpdirname)
+                try:
+                    games = capture.runGames(**_args)
+                finally:
+                    os.chdir(curdir)
+                    for team in sandboxes:
+                        team.close()
+        for name, team in zip((red_name, blue_name), sandboxes):
+            logging.info("{}: {} used {:.2f}s of CPU time".format(
+                log_prefix.strip(" :"), name, team.cpuTime))
+
+        points = [(game.state.data.score, game.agentCrashed or game.agentTimeout)
+                for game in games]
+
+        for point, error in points:
+            red_result, blue_result = Result.from_points(point, error)
+            logging.info("{} vs {} ended in {}-{} with {} pts".format(
+                red_name, blue_name,
+                Result.get_name(red_result), Result.get_name(blue_result),
+                0))
+            results.append((red_name, blue_name, point, red_result, blue_result))
+
+        # Move all replay-% files to results/red_name-blue_name-%d
+        match_name = os.path.join(output_dir, "{}-{}".format(red_name, blue_name))
+        replay_prefix = 'replay'
+        replay_files = filter(lambda s: s.startswith(replay_prefix + '-'),
+                os.listdir(tmpdirname))
+        for filename in replay_files:
+            new_name = match_name + filename[len(replay_prefix):]
+            shutil.move(os.path.join(tmpdirname, filename), os.path.join(curdir, new_name))
+    return results, time.time() - start_time
+
+
+def match_timeout(args):
+    """
+    How long a match may run before its worker is killed: --match-timeout
+    or, by default, every agent of every game using its whole time budget,
+    plus a minute per game for the framework.
+    """
+    timeout = getattr(args, "match_timeout", None)
+    if timeout:
+        return timeout
+    rules = capture.CaptureRules()
+    game_time = 60 + sum(rules.getMaxStartupTime(index) + rules.getMaxTotalTime(index)
+            for index in range(4))
+    return args.numGames * game_time
+
+
+def _run_match_in_child(connection, matchno, args, output_dir, match):
+    status = 1
+    try:
+        connection.send(run_match(matchno, args, output_dir, match))
+        connection.close()
+        status = 0
+    except BaseException:
+        logging.exception("Match {}: the match runner failed".format(matchno))
+    finally:
+        # Exit at once, as validation children do: nothing a team left
+        # running may keep the worker alive
+        os._exit(status)
+
+
+def run_matches(args, output_dir, matches, scoreboard, match_times, journal=None, report=None):
+    """
+    Plays all matches, each in its own worker process.
+
+    At most args.threads workers run at once, and no imported student code
+    or leaked state outlives its match.  Matches are handed out one at a
+    time, always the longest expected one first, so that short matches fill
+    in at the end instead of one long match running alone.  The loop waits
+    on the workers' pipes instead of polling.  A match whose worker raises,
+    dies (e.g. os._exit, a crash or the OOM killer) or runs past
+    match_timeout counts as an error for both teams in every game, like a
+    failing createTeam in run_match.
+    """
+    threads = max(1, args.threads)
+    timeout = match_timeout(args)
+    pending = list(enumerate(matches, 1))
+    running = {}
+
+    def record(results, seconds):
+        if journal is not None:
+            journal.append(results, layout_key(args))
+        for result in results:
+            scoreboard.add_result(*result)
+        if report is not None:
+            report.add_results(results)
+        if results and seconds is not None:
+            red_name, blue_name = results[0][:2]
+            match_times.update(red_name, blue_name, seconds, len(results))
+        logging.info("{} matches left to play".format(len(pending) + len(running)))
+
+    def failed(matchno, match, reason):
+        (red_name, _), (blue_name, _) = match
+        logging.error("Match {}: the match runner of {} vs {} failed: {}".format(
+            matchno, red_name, blue_name, reason))
+        record([(red_name, blue_name, 0, Result.ERROR, Result.ERROR)] * args.numGames, None)
+
+    while pending or running:
+        while pending and len(running) < threads:
+            # Expectations improve as matches finish, so pick lazily.
+            longest = max(range(len(pending)),
+                    key=lambda i: match_times.expected(pending[i][1]))
+            matchno, match = pending.pop(longest)
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_run_match_in_child,
+                    args=(sender, matchno, args, output_dir, match), daemon=True)
+            process.start()
+            sender.close()
+            running[receiver] = (matchno, match, process, time.time() + timeout)
+
+        wait_time = max(0, min(deadline for _, _, _, deadline in running.values()) - time.time())
+        for receiver in multiprocessing.connection.wait(list(running), wait_time):
+            matchno, match, process, _ = running.pop(receiver)
             try:
-                with silence_stdout():
-                    blue_agents = mute_agents(blue_factory(1, 3, False,
-                        **args.agentArgs))
-            except:
-                blue_result = Result.ERROR
-
-            if Result.ERROR in (red_result, blue_result):
-                err_msg = "Match {}: An error occured during {}'s createTeam"
-                if red_result == Result.ERROR:
-                    logging.error(err_msg.format(matchno, red_name))
-                if blue_result == Result.ERROR:
-                    logging.error(err_msg.format(matchno, blue_name))
-                logging.info("{} vs {} ended in {}-{} with {} pts".format(
-                    red_name, blue_name,
-                    Result.get_name(red_result), Result.get_name(blue_result),
-                    0))
-                for _ in range(args.numGames):
-                    results.put((red_name, blue_name, 0, red_result, blue_result))
-                continue
-
-            # Play the game!
-            _args = update_arguments(args, red_name, red_agents, blue_name, blue_agents)
-            log_prefix = "{} ({} vs {}): ".format(matchno, red_name, blue_name)
-            with tempfile.TemporaryDirectory(prefix="pacman-{}-{}-{}-".format(matchno, red_name, blue_name)) as tmpdirname:
-                curdir = os.path.abspath(os.curdir)
-                with log_stdout(prefix=log_prefix):
-                    with log_stderr(prefix=log_prefix):
-                        os.chdir(tmpdirname)
-                        games = capture.runGames(**_args)
-                        os.chdir(curdir)
-
-                # Update the global score card.
-                points = [(game.state.data.score, game.agentCrashed or game.agentTimeout)
-                        for game in games]
-
-                for point, error in points:
-                    red_result, blue_result = Result.from_points(point, error)
-                    logging.info("{} vs {} ended in {}-{} with {} pts".format(
-                        red_name, blue_name,
-                        Result.get_name(red_result), Result.get_name(blue_result),
-                        0))
-                    results.put((red_name, blue_name, point, red_result, blue_result))
-
-                # Move all replay-% files to results/red_name-blue_name-%d
-                match_name = os.path.join(output_dir, "{}-{}".format(red_name, blue_name))
-                replay_prefix = 'replay'
-                replay_files = filter(lambda s: s.startswith(replay_prefix + '-'),
-                        os.listdir(tmpdirname))
-                for filename in replay_files:
-                    new_name = match_name + filename[len(replay_prefix):]
-                    shutil.move(os.path.join(tmpdirname, filename), os.path.join(curdir, new_name))
-        except multiprocessing.queues.Empty:
-            break
-    is_done.put(runner_id)
+                outcome = receiver.recv()
+            except (EOFError, OSError):
+                outcome = None
+            receiver.close()
+            process.join(1)
+            if process.is_alive():
+                process.kill()
+                process.join()
+            if outcome is None:
+                failed(matchno, match, "its worker exited with code {}".format(process.exitcode))
+            else:
+                record(*outcome)
+
+        now = time.time()
+        for receiver, (matchno, match, process, deadline) in list(running.items()):
+            if now >= deadline:
+                process.kill()
+                process.join()
+                receiver.close()
+                del running[receiver]
+                failed(matchno, match, "it did not finish in {}s".format(timeout))
+
+
+def resume_from_journal(journal, matches, scoreboard, args, report=None):
+    """
+    Adds the journal's completed matches to scoreboard, and to report if
+    given, and returns the matches that still have to be played.
+    """
+    completed = journal.completed_matches(layout_key(args), args.numGames)
+    remaining = []
+    for match in matches:
+        (red_name, _), (blue_name, _) = match
+        games = completed.get((red_name, blue_name)) or completed.get((blue_name, red_name))
+        if games is None:
+            remaining.append(match)
+            continue
+        results = [(game['red'], game['blue'], game['points'],
+                game['red_result'], game['blue_result']) for game in games]
+        for result in results:
+            scoreboard.add_result(*result)
+        if report is not None:
+            report.add_results(results)
+    logging.info("Resuming: {} of {} matches were already played".format(
+        len(matches) - len(remaining), len(matches)))
+    return remaining
+
+
+def play_tournament(args, output_dir, scoreboard, match_times, journal, report=None):
+    """
+    Plays the matches of the tournament format in args.
+
+    A round robin is a single batch of matches.  Swiss and rated
+    tournaments are played round by round, each round's pairings made from
+    the results so far.  When resuming, matches in the journal are not
+    played again; pairings are deterministic apart from the home side, so
+    a resumed Swiss tournament finds the same matches in the journal.
+    """
+    if args.tournament_format == "round-robin":
+        matches = scoreboard.make_pairings()
+        if args.resume:
+            matches = resume_from_journal(journal, matches, scoreboard, args, report)
+        logging.info("A total of {} matches will be played. Counting down".format(len(matches)))
+        run_matches(args, output_dir, matches, scoreboard, match_times, journal, report)
+        return
+
+    rounds = args.rounds or default_rounds(args.tournament_format,
+            len(scoreboard.participants))
+    for round_number in range(1, rounds + 1):
+        if args.tournament_format == "swiss":
+            matches = scoreboard.make_swiss_pairings()
+        else:
+            matches = scoreboard.make_rated_pairings()
+        if args.resume:
+            matches = resume_from_journal(journal, matches, scoreboard, args, report)
+        logging.info("Round {} of {}: {} matches will be played".format(
+            round_number, rounds, len(matches)))
+        run_matches(args, output_dir, matches, scoreboard, match_times, journal, report)
+    if args.tournament_format == "rated":
+        for team, _ in scoreboard.ranking():
+            logging.info("{}: {!r}".format(team, scoreboard.ratings[team]))
+
 
 def run_competition(args):
     """
@@ -1282,7 +2131,7 @@ def run_competition(args):
     """
     logging.info("Starting.")
     args.timestamp_start = datetime.datetime.now()
-    scoreboard = Scoreboard()
+    scoreboard = Scoreboard(args.tournament_format)
     secrets = load_secrets(args.secrets)
 
     if not args.no_download:
@@ -1294,7 +2143,9 @@ def run_competition(args):
             for m in students._IMPORT_ERRORS}
     scoreboard.disqualify(disqualified_on_import)
     student_modules = get_student_modules(students)
-    email_addresses, agent_factories, disqualified_teams = analyse_student_modules(student_modules)
+    email_addresses, agent_factories, disqualified_teams = analyse_student_modules(
+            student_modules, max(1, args.threads), args.validation_timeout,
+            VALIDATION_CACHE_FILENAME)
     if not args.no_play:
         scoreboard.disqualify(disqualified_teams)
         scoreboard.register_participants(agent_factories)
@@ -1311,40 +2162,29 @@ def run_competition(args):
             os.mkdir("results")
         except OSError:
             pass
-        output_dir = args.timestamp_start.strftime(os.path.join("results",
-            TIMESTAMP_FMT))
+        if args.resume:
+            output_dir = args.resume
+        else:
+            output_dir = args.timestamp_start.strftime(os.path.join("results",
+                TIMESTAMP_FMT))
         try:
             os.mkdir(output_dir)
         except OSError:
             pass
 
-        matches = scoreboard.make_pairings()
-        match_runners = {}
-        results = multiprocessing.Queue()
-        is_done = multiprocessing.Queue()
+        journal = ResultsJournal(os.path.join(output_dir, JOURNAL_FILENAME))
+        match_times = MatchTimes(MATCH_TIMES_FILENAME)
         if not args.no_mail:
             logging.info("Emailing {} participants the results".format(len(email_addresses)))
-        logging.info("A total of {} matches will be played. Counting down".format(matches.qsize()))
-        for i in range(args.threads):
-            p = multiprocessing.Process(target=run_match,
-                    args=(i, args, output_dir, matches, results, is_done))
-            match_runners[i] = p
-            p.start()
-
-        while match_runners:
-            if not is_done.empty():
-                name = is_done.get(timeout=1)
-                match_runners[name].join()
-                del match_runners[name]
-            # Periodically move results to scoreboard, so that results is not overflowing.
-            while not results.empty():
-                scoreboard.add_result(*results.get())
-            time.sleep(0.1)
+        report = HtmlReport(scoreboard, os.path.join(output_dir, "report.html"),
+                os.path.join(output_dir, STANDINGS_FILENAME), secrets['course_name'],
+                args.timestamp_start, args.layout, args.report_interval)
+        report.write()
+        play_tournament(args, output_dir, scoreboard, match_times, journal, report)
+        match_times.save()
 
         args.timestamp_finish = datetime.datetime.now()
-        report_file = os.path.join(output_dir, "report.html")
-        generate_html_report(scoreboard, report_file, secrets['course_name'],
-                **vars(args))
+        report.finish(args.timestamp_finish)
         zip_name = zip_results(output_dir, remove_src=True)
     else:
         if not args.no_mail:
@@ -21,7 +21,16 @@ distancer = Distancer(gameState.data.layout)
 distancer.getDistance( (1,1), (10,10) )
 """
 
-import sys, time, random
+import sys, time, random, os, hashlib, weakref, collections
+from array import array
+import util
+import profiler
+
+try:
+  import numpy as np
+  _NUMPY_ENABLED = True
+except ImportError:
+  _NUMPY_ENABLED = False
 
 class Distancer:
   def __init__(self, layout, default = 10000):
@@ -39,30 +48,26 @@ class Distancer:
     """
     The getDistance function is the only one you'll need after you create the object.
     """
-    if self._distances == None:
+    if self._distances is None:
       return manhattanDistance(pos1, pos2)
     if isInt(pos1) and isInt(pos2):
-      return self.getDistanceOnGrid(pos1, pos2)
+      return self._distances.getDistance(pos1, pos2)
     pos1Grids = getGrids2D(pos1)
     pos2Grids = getGrids2D(pos2)
     bestDistance = self.default
     for pos1Snap, snap1Distance in pos1Grids:
       for pos2Snap, snap2Distance in pos2Grids:
-        gridDistance = self.getDistanceOnGrid(pos1Snap, pos2Snap)
+        gridDistance = self._distances.getDistance(pos1Snap, pos2Snap)
         distance = gridDistance + snap1Distance + snap2Distance
         if bestDistance > distance:
           bestDistance = distance
     return bestDistance
 
   def getDistanceOnGrid(self, pos1, pos2):
-    key = (pos1, pos2)
-    if key in self._distances:
-      return self._distances[key]
-    else:
-      raise Exception("Positions not in grid: " + str(key))
+    return self._distances.getDistance(pos1, pos2)
 
   def isReadyForMazeDistance(self):
-    return self._distances != None
+    return self._distances is not None
 
 def manhattanDistance(x, y ):
   return abs( x[0] - y[0] ) + abs( x[1] - y[1] )
@@ -90,6 +95,241 @@ def getGrids1D(x):
 
 distanceMap = {}
 
+# Stored for pairs of cells that cannot reach each other
+UNREACHABLE = 32767
+
+class MazeGraph:
+  """
+  The open cells of a wall grid as an adjacency array, for BFS queries.
+
+  Open cells get compact ids through cellIds, indexed by x * height + y (-1
+  for walls); cells[i] is the position of cell i and neighbors[i] lists the
+  ids of the open cells next to it.  Every query below visits each cell at
+  most once.
+  """
+  def __init__(self, walls):
+    self.width = walls.width
+    self.height = walls.height
+    self.cellIds = [-1] * (self.width * self.height)
+    self.cells = []
+    for x in range(self.width):
+      for y in range(self.height):
+        if not walls[x][y]:
+          self.cellIds[x * self.height + y] = len(self.cells)
+          self.cells.append((x, y))
+    self.numCells = len(self.cells)
+
+    self.neighbors = []
+    width, height, cellIds = self.width, self.height, self.cellIds
+    for x, y in self.cells:
+      adjacent = []
+      for nx, ny in ((x, y+1), (x, y-1), (x+1, y), (x-1, y)):
+        if 0 <= nx < width and 0 <= ny < height:
+          other = cellIds[nx * height + ny]
+          if other >= 0: adjacent.append(other)
+      self.neighbors.append(adjacent)
+
+  def cellId(self, pos):
+    x, y = pos
+    x, y = int(x), int(y)
+    if 0 <= x < self.width and 0 <= y < self.height:
+      return self.cellIds[x * self.height + y]
+    return -1
+
+  def levels(self, start):
+    """
+    Yields (depth, cellIds) for each BFS level around start, nearest first.
+    """
+    source = self.cellId(start)
+    if source < 0: return
+    neighbors = self.neighbors
+    seen = [False] * self.numCells
+    seen[source] = True
+    frontier = [source]
+    depth = 0
+    while frontier:
+      yield depth, frontier
+      nextFrontier = []
+      for node in frontier:
+        for other in neighbors[node]:
+          if not seen[other]:
+            seen[other] = True
+            nextFrontier.append(other)
+      frontier = nextFrontier
+      depth += 1
+
+  def nearestDistance(self, start, targets):
+    """
+    Maze distance from start to the closest position in targets (any
+    container of (x, y) tuples), or None if none of them can be reached.
+    """
+    cells = self.cells
+    for depth, level in self.levels(start):
+      for node in level:
+        if cells[node] in targets: return depth
+    return None
+
+  def distance(self, start, target):
+    return self.nearestDistance(start, (tuple(target),))
+
+class DistanceTable:
+  """
+  All-pairs maze distances for one wall grid.
+
+  Cells are numbered as in MazeGraph, and the distance between cells i and j
+  is matrix[i][j].  The matrix is an int16 NumPy array when NumPy is
+  available (memory-mapped when it comes from the on-disk cache) and an
+  array.array otherwise; lookups go through a flat memoryview so they return
+  plain ints.
+  """
+  def __init__(self, walls, matrix = None):
+    self.graph = MazeGraph(walls)
+    self.width = walls.width
+    self.height = walls.height
+    self.cellIds = self.graph.cellIds
+    self.cells = self.graph.cells
+    self.numCells = self.graph.numCells
+    if matrix is None:
+      matrix = self._computeMatrix()
+    self.matrix = matrix
+    if _NUMPY_ENABLED and isinstance(matrix, np.ndarray):
+      self._flat = memoryview(np.ascontiguousarray(matrix).reshape(-1))
+    else:
+      self._flat = memoryview(matrix)
+
+  def _computeMatrix(self):
+    "Runs a BFS from every open cell; all edges have unit cost."
+    n = self.numCells
+    neighbors = self.graph.neighbors
+    flat = array(_typecode(n), [UNREACHABLE]) * (n * n)
+    for source in range(n):
+      row = source * n
+      flat[row + source] = 0
+      frontier = [source]
+      depth = 0
+      while frontier:
+        depth += 1
+        nextFrontier = []
+        for node in frontier:
+          for other in neighbors[node]:
+            if flat[row + other] == UNREACHABLE:
+              flat[row + other] = depth
+              nextFrontier.append(other)
+        frontier = nextFrontier
+    if _NUMPY_ENABLED:
+      return np.frombuffer(flat, dtype=flat.typecode).reshape(n, n)
+    return flat
+
+  def cellId(self, pos):
+    return self.graph.cellId(pos)
+
+  def getDistance(self, pos1, pos2):
+    i = self.cellId(pos1)
+    j = self.cellId(pos2)
+    if i < 0 or j < 0:
+      raise Exception("Positions not in grid: " + str((pos1, pos2)))
+    return self._flat[i * self.numCells + j]
+
+  def __getitem__(self, key):
+    "Lets the table stand in for the old {(pos1, pos2): distance} dict."
+    return self.getDistance(*key)
+
+  def __contains__(self, key):
+    pos1, pos2 = key
+    return self.cellId(pos1) >= 0 and self.cellId(pos2) >= 0
+
+def _typecode(numCells):
+  return 'h' if numCells < UNREACHABLE else 'i'
+
+def wallsDigest(walls):
+  "A content hash of a wall grid, used to name its cache file."
+  text = '%d %d\n%s' % (walls.width, walls.height, str(walls))
+  return hashlib.sha1(text.encode('ascii')).hexdigest()
+
+def loadDistanceTable(walls):
+  """
+  Returns the DistanceTable for walls, memory-mapping it from the on-disk
+  cache when a previous run already computed it, and writing it there
+  otherwise.  Without NumPy, or without a writable cache directory, the
+  table is just computed in memory.
+  """
+  if not _NUMPY_ENABLED:
+    return DistanceTable(walls)
+  directory = util.getCacheDirectory('distances')
+  if directory is None:
+    return DistanceTable(walls)
+  path = os.path.join(directory, wallsDigest(walls) + '.npy')
+
+  if os.path.exists(path):
+    try:
+      matrix = np.load(path, mmap_mode='r')
+      table = DistanceTable(walls, matrix)
+      if matrix.shape == (table.numCells, table.numCells):
+        return table
+    except (OSError, ValueError):
+      pass
+
+  table = DistanceTable(walls)
+  try:
+    # Write under a temporary name so concurrent runs never see half a file
+    tmpPath = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmpPath, 'wb') as f:
+      np.save(f, table.matrix)
+    os.replace(tmpPath, path)
+  except OSError:
+    pass
+  return table
+
+# Shared per-layout objects, by Layout object and, for the few layouts seen
+# last, by layout text; a long run over random mazes keeps only those
+_SHARED_TEXTS = 8
+_tablesByLayout = weakref.WeakKeyDictionary()
+_tablesByText = collections.OrderedDict()
+_graphsByLayout = weakref.WeakKeyDictionary()
+_graphsByText = collections.OrderedDict()
+
+def _sharedForLayout(layout, byLayout, byText, build):
+  shared = byLayout.get(layout)
+  if shared is None:
+    key = tuple(layout.layoutText)
+    shared = byText.pop(key, None)
+    if shared is None:
+      shared = build(layout)
+    byText[key] = shared
+    if len(byText) > _SHARED_TEXTS:
+      byText.popitem(last=False)
+    byLayout[layout] = shared
+  return shared
+
+def _loadTable(layout):
+  table = distanceMap.get(layout.walls)
+  if table is None:
+    with profiler.phase('distances'):
+      table = loadDistanceTable(layout.walls)
+  return table
+
+def getDistancer(layout):
+  """
+  Returns a Distancer with maze distances already computed for layout.
+
+  Every caller gets its own Distancer, but callers asking about the same
+  layout share its read-only DistanceTable.  Repeat calls with the same
+  Layout object are a single dict lookup.  Copies of a layout
+  (GameState.deepCopy makes one per turn) are matched by their text, so
+  the wall grid is never rehashed once a layout has been seen.
+  """
+  distancer = Distancer(layout)
+  distancer._distances = _sharedForLayout(layout, _tablesByLayout, _tablesByText, _loadTable)
+  return distancer
+
+def getMazeGraph(layout):
+  """
+  Returns the shared MazeGraph of layout's walls, looked up like the
+  distance tables of getDistancer.
+  """
+  return _sharedForLayout(layout, _graphsByLayout, _graphsByText,
+                          lambda layout: MazeGraph(layout.walls))
+
 class DistanceCalculator:
   def __init__(self, layout, distancer, default = 10000):
     self.layout = layout
@@ -100,7 +340,8 @@ class DistanceCalculator:
     global distanceMap
 
     if self.layout.walls not in distanceMap:
-      distances = computeDistances(self.layout)
+      with profiler.phase('distances'):
+        distances = loadDistanceTable(self.layout.walls)
       distanceMap[self.layout.walls] = distances
     else:
       distances = distanceMap[self.layout.walls]
@@ -108,44 +349,12 @@ class DistanceCalculator:
     self.distancer._distances = distances
 
 def computeDistances(layout):
-    "Runs UCS to all other positions from each position"
+    "Returns all maze distances as a {(target, source): distance} dict"
+    table = loadDistanceTable(layout.walls)
     distances = {}
-    allNodes = layout.walls.asList(False)
-    for source in allNodes:
-        dist = {}
-        closed = {}
-        for node in allNodes:
-            dist[node] = sys.maxsize
-        import util
-        queue = util.PriorityQueue()
-        queue.push(source, 0)
-        dist[source] = 0
-        while not queue.isEmpty():
-            node = queue.pop()
-            if node in closed:
-                continue
-            closed[node] = True
-            nodeDist = dist[node]
-            adjacent = []
-            x, y = node
-            if not layout.isWall((x,y+1)):
-                adjacent.append((x,y+1))
-            if not layout.isWall((x,y-1)):
-                adjacent.append((x,y-1) )
-            if not layout.isWall((x+1,y)):
-                adjacent.append((x+1,y) )
-            if not layout.isWall((x-1,y)):
-                adjacent.append((x-1,y))
-            for other in adjacent:
-                if not other in dist:
-                    continue
-                oldDist = dist[other]
-                newDist = nodeDist+1
-                if newDist < oldDist:
-                    dist[other] = newDist
-                    queue.push(other, newDist)
-        for target in allNodes:
-            distances[(target, source)] = dist[target]
+    for source in table.cells:
+        for target in table.cells:
+            distances[(target, source)] = table.getDistance(target, source)
     return distances
 
 
@@ -154,4 +363,3 @@ def getDistanceOnGrid(distances, pos1, pos2):
     if key in distances:
       return distances[key]
     return 100000
-
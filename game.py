@@ -35,7 +35,15 @@ class Agent:
     following methods which will be called if they exist:
 
     def registerInitialState(self, state): # inspects the starting state
+
+    Every agent gets a private deep copy of the game state.  An agent that
+    only reads the states it is given may set copyObservations = False, and
+    is then handed the live state in fast simulation mode (see Game.run).
+    Outside that mode observationFunction still gets a deep copy, unless it
+    is marked with readOnlyObservation.
     """
+    copyObservations = True
+
     def __init__(self, index=0):
         self.index = index
 
@@ -46,6 +54,18 @@ class Agent:
         """
         raiseNotDefined()
 
+def readOnlyObservation(function):
+    """
+    Marks an observationFunction that never modifies the state it is given,
+    so Game.run may pass it the live state instead of a deep copy.  The
+    observation must not share anything an agent could reasonably modify:
+    capture's makeObservation gives it its own agent states and layout, and
+    shares only the food grid, which rules replace rather than modify in
+    place.  An agent class that overrides the method loses the mark.
+    """
+    function.readOnlyObservation = True
+    return function
+
 class Directions:
     NORTH = 'North'
     SOUTH = 'South'
@@ -274,6 +294,190 @@ class Grid:
                 bools.append(False)
         return bools
 
+class BitGrid(Grid):
+    """
+    A Grid of booleans stored as a single Python int.  Cell (x,y) lives in
+    bit x * height + y, the same cell order used by Grid.__hash__ and
+    packBits, so a BitGrid hashes like the equivalent Grid.
+
+    grid[x][y] reads and writes work as they do for Grid.  Copies share the
+    underlying int (ints are immutable, so writes simply rebind it), count()
+    is a popcount and the hash is cached until the next write.
+    """
+    def __init__(self, width, height, initialValue=False, bitRepresentation=None):
+        if initialValue not in [False, True]: raise Exception('Grids can only contain booleans')
+        self.CELLS_PER_INT = 30
+
+        self.width = width
+        self.height = height
+        self._mask = (1 << (width * height)) - 1
+        self.bits = self._mask if initialValue else 0
+        self._hash = None
+        self._columns = None
+        if bitRepresentation:
+            self._unpackBits(bitRepresentation)
+
+    def __getitem__(self, i):
+        # Column views are made on first use; food grids are copied far more
+        # often than all of their columns are read.
+        columns = self._columns
+        if columns is None:
+            columns = self._columns = [None] * self.width
+        column = columns[i]
+        if column is None:
+            column = columns[i] = _BitGridColumn(self, (i % self.width) * self.height)
+        return column
+
+    def __setitem__(self, key, item):
+        column = self[key]
+        for y in range(self.height):
+            column[y] = item[y]
+
+    def __len__(self):
+        return self.width
+
+    def __str__(self):
+        out = [[str(self[x][y])[0] for x in range(self.width)] for y in range(self.height)]
+        out.reverse()
+        return '\n'.join([''.join(x) for x in out])
+
+    def __eq__(self, other):
+        if other == None: return False
+        if isinstance(other, BitGrid):
+            return self.width == other.width and self.height == other.height and self.bits == other.bits
+        return self.data == other.data
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(self.bits)
+        return self._hash
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_columns'] = None
+        return state
+
+    def _set(self, index, value):
+        if value:
+            self.bits |= 1 << index
+        else:
+            self.bits &= ~(1 << index)
+        self._hash = None
+
+    @property
+    def data(self):
+        """
+        A list of lists copy of the cells, for code that reads Grid.data.
+        """
+        return [list(self[x]) for x in range(self.width)]
+
+    def copy(self):
+        g = BitGrid.__new__(BitGrid)
+        g.CELLS_PER_INT = self.CELLS_PER_INT
+        g.width = self.width
+        g.height = self.height
+        g._mask = self._mask
+        g.bits = self.bits
+        g._hash = self._hash
+        g._columns = None
+        return g
+
+    def deepCopy(self):
+        return self.copy()
+
+    def shallowCopy(self):
+        return self.copy()
+
+    def count(self, item =True ):
+        ones = bitCount(self.bits)
+        if item: return ones
+        return self.width * self.height - ones
+
+    def asList(self, key = True):
+        bits = self.bits if key else self._mask & ~self.bits
+        height = self.height
+        list = []
+        while bits:
+            low = bits & -bits
+            list.append(divmod(low.bit_length() - 1, height))
+            bits ^= low
+        return list
+
+    def packBits(self):
+        """
+        Returns an efficient int list representation
+
+        (width, height, bitPackedInts...)
+        """
+        bits = [self.width, self.height]
+        cells = self.width * self.height
+        for start in range(0, cells, self.CELLS_PER_INT):
+            size = min(self.CELLS_PER_INT, cells - start)
+            chunk = (self.bits >> start) & ((1 << size) - 1)
+            # packBits stores the first cell of each int in its highest bit
+            flipped = int(format(chunk, '0%db' % size)[::-1], 2)
+            bits.append(flipped << (self.CELLS_PER_INT - size))
+        if cells % self.CELLS_PER_INT == 0: bits.append(0)
+        return tuple(bits)
+
+    def _unpackBits(self, bits):
+        """
+        Fills in data from a bit-level representation
+        """
+        cells = self.width * self.height
+        value = 0
+        for i, packed in enumerate(bits):
+            start = i * self.CELLS_PER_INT
+            if start >= cells: break
+            if packed < 0: raise ValueError("must be a positive integer")
+            chunk = int(format(packed, '0%db' % self.CELLS_PER_INT)[::-1], 2)
+            value |= chunk << start
+        self.bits = value & self._mask
+        self._hash = None
+
+class _BitGridColumn:
+    """
+    The grid[x] view of a BitGrid, indexed by y.
+    """
+    __slots__ = ('_grid', '_offset')
+
+    def __init__(self, grid, offset):
+        self._grid = grid
+        self._offset = offset
+
+    def _index(self, y):
+        height = self._grid.height
+        if y < 0: y += height
+        if y < 0 or y >= height: raise IndexError('grid index out of range')
+        return self._offset + y
+
+    def __getitem__(self, y):
+        return (self._grid.bits >> self._index(y)) & 1 == 1
+
+    def __setitem__(self, y, value):
+        self._grid._set(self._index(y), value)
+
+    def __len__(self):
+        return self._grid.height
+
+    def __iter__(self):
+        column = self._grid.bits >> self._offset
+        for y in range(self._grid.height):
+            yield (column >> y) & 1 == 1
+
+    def count(self, item=True):
+        height = self._grid.height
+        ones = bitCount((self._grid.bits >> self._offset) & ((1 << height) - 1))
+        if item: return ones
+        return height - ones
+
+if hasattr(int, 'bit_count'):
+    def bitCount(n):
+        return n.bit_count()
+else:
+    def bitCount(n):
+        return bin(n).count('1')
+
 def reconstituteGrid(bitRep):
     if type(bitRep) is not type((1,2)):
         return bitRep
@@ -368,6 +572,53 @@ class Actions:
         return (x + dx, y + dy)
     getSuccessor = staticmethod(getSuccessor)
 
+class MoveTable:
+    """
+    The moves Actions.getPossibleActions allows on every cell of a wall
+    grid, computed once per layout (see Layout.getMoveTable).
+
+    Cells are numbered x * height + y.  masks[cell] has bit i set when
+    DIRECTIONS[i] leads to an open cell, neighbors[cell][i] is the number
+    of that cell (-1 for a wall) and actions[cell] lists the allowed
+    directions in the order getPossibleActions returns them.
+    """
+    DIRECTIONS = [direction for direction, vector in Actions._directionsAsList]
+
+    def __init__(self, walls):
+        self.walls = walls
+        self.width = width = walls.width
+        self.height = height = walls.height
+        self.masks = [0] * (width * height)
+        self.neighbors = [None] * (width * height)
+        self.actions = [()] * (width * height)
+        for x in range(width):
+            for y in range(height):
+                if walls[x][y]: continue
+                mask = 0
+                neighbors = []
+                for i, (dx, dy) in enumerate(vector for direction, vector in Actions._directionsAsList):
+                    nx, ny = x + dx, y + dy
+                    if 0 <= nx < width and 0 <= ny < height and not walls[nx][ny]:
+                        mask |= 1 << i
+                        neighbors.append(nx * height + ny)
+                    else:
+                        neighbors.append(-1)
+                cell = x * height + y
+                self.masks[cell] = mask
+                self.neighbors[cell] = tuple(neighbors)
+                self.actions[cell] = tuple(direction for i, direction in enumerate(self.DIRECTIONS) if mask >> i & 1)
+
+    def getPossibleActions(self, config):
+        """
+        Same as Actions.getPossibleActions(config, self.walls), as a new list.
+        """
+        x, y = config.pos
+        x_int, y_int = int(x), int(y)
+        if x_int != x or y_int != y:
+            # Scared ghosts move at half speed and can be between cells
+            return Actions.getPossibleActions(config, self.walls)
+        return list(self.actions[x_int * self.height + y_int])
+
 class GameStateData:
     """
 
@@ -377,9 +628,15 @@ class GameStateData:
         Generates a new data packet by copying information from its predecessor.
         """
         if prevState != None:
-            self.food = prevState.food.shallowCopy()
+            # The food grid and the agent states are shared with prevState.
+            # Rules copy the grid before changing it and change agent states
+            # through getWritableAgentState, so only what changes is copied.
+            self.food = prevState.food
+            self._foodCounts = prevState._foodCounts
+            self._foodPositions = prevState._foodPositions
             self.capsules = prevState.capsules[:]
-            self.agentStates = self.copyAgentStates( prevState.agentStates )
+            self.agentStates = prevState.agentStates[:]
+            self._writableAgents = 0
             self.layout = prevState.layout
             self._eaten = prevState._eaten
             self.score = prevState.score
@@ -395,6 +652,8 @@ class GameStateData:
     def deepCopy( self ):
         state = GameStateData( self )
         state.food = self.food.deepCopy()
+        state.agentStates = self.copyAgentStates( self.agentStates )
+        state._writableAgents = -1
         state.layout = self.layout.deepCopy()
         state._agentMoved = self._agentMoved
         state._foodEaten = self._foodEaten
@@ -402,6 +661,60 @@ class GameStateData:
         state._capsuleEaten = self._capsuleEaten
         return state
 
+    def getNumFood( self, side=None ):
+        """
+        Returns how much food is left: on the left (side 0, red in capture)
+        or right (side 1) half of the board, or in total.
+        """
+        if side is None: return self._foodCounts[0] + self._foodCounts[1]
+        return self._foodCounts[side]
+
+    def getFoodPositions( self ):
+        """
+        Returns a frozenset of the positions that still have food.
+        """
+        if self._foodPositions is None:
+            self._foodPositions = frozenset(self.food.asList())
+        return self._foodPositions
+
+    def setFood( self, position, value ):
+        """
+        Sets the food at position and keeps the food counts and positions in
+        step.  The food grid is shared with earlier states, so callers must
+        copy it before the first change.
+        """
+        x, y = position
+        if self.food[x][y] == value: return
+        self.food[x][y] = value
+        left, right = self._foodCounts
+        change = 1 if value else -1
+        if x < self.food.width // 2: left += change
+        else: right += change
+        self._foodCounts = (left, right)
+        if self._foodPositions is not None:
+            if value: self._foodPositions = self._foodPositions | {position}
+            else: self._foodPositions = self._foodPositions - {position}
+
+    def countFood( self ):
+        """
+        Recounts the food from the grid, for use after self.food is replaced.
+        """
+        halfway = self.food.width // 2
+        left = sum(self.food[x].count(True) for x in range(halfway))
+        self._foodCounts = (left, self.food.count() - left)
+        self._foodPositions = None
+
+    def getWritableAgentState( self, index ):
+        """
+        Returns the AgentState of agent index for the rules to modify.
+        Successors share unchanged AgentStates with their predecessor, so
+        the first call for an agent replaces its shared state with a copy.
+        """
+        if not self._writableAgents & (1 << index):
+            self.agentStates[index] = self.agentStates[index].copy()
+            self._writableAgents |= 1 << index
+        return self.agentStates[index]
+
     def copyAgentStates( self, agentStates ):
         copiedStates = []
         for agentState in agentStates:
@@ -489,9 +802,12 @@ class GameStateData:
         Creates an initial game state from a layout array (see layout.py).
         """
         self.food = layout.food.copy()
+        self.countFood()
         #self.capsules = []
         self.capsules = layout.capsules[:]
         self.layout = layout
+        # Build the move table before states copy the layout, so copies share it
+        layout.getMoveTable()
         self.score = 0
         self.scoreChange = 0
 
@@ -503,6 +819,7 @@ class GameStateData:
                 else: numGhosts += 1
             self.agentStates.append( AgentState( Configuration( pos, Directions.STOP), isPacman) )
         self._eaten = [False for a in self.agentStates]
+        self._writableAgents = -1
 
 try:
     import boinc
@@ -515,7 +832,7 @@ class Game:
     The Game manages the control flow, soliciting actions from agents.
     """
 
-    def __init__( self, agents, display, rules, startingIndex=0, muteAgents=False, catchExceptions=False ):
+    def __init__( self, agents, display, rules, startingIndex=0, muteAgents=False, catchExceptions=False, fast=False ):
         self.agentCrashed = False
         self.agents = agents
         self.display = display
@@ -524,10 +841,17 @@ class Game:
         self.gameOver = False
         self.muteAgents = muteAgents
         self.catchExceptions = catchExceptions
+        self.fast = fast
         self.moveHistory = []
+        # Optional replay.ReplayWriter that records the game as it is played
+        self.recorder = None
+        # Optional profiler.GameProfiler that times the phases of every turn
+        self.profiler = None
         self.totalAgentTimes = [0 for agent in agents]
         self.totalAgentTimeWarnings = [0 for agent in agents]
         self.agentTimeout = False
+        # Time each agent took per move (observation and action)
+        self.agentLatencies = [LatencyHistogram() for agent in agents]
         import io
         self.agentOutput = [io.StringIO() for agent in agents]
 
@@ -568,7 +892,25 @@ class Game:
         """
         Main control loop for game play.
         """
+        if self.fast and not self.catchExceptions and self.profiler is None:
+            return self.runFast()
+        self.timer = None
+        if self.catchExceptions:
+            # One timer enforces every time limit of the game
+            self.timer = MoveTimer()
+            self.timer.start()
+        try:
+            self._run(delay)
+        finally:
+            if self.timer is not None: self.timer.stop()
+
+    def _run( self, delay ):
+        timer = self.timer
+        profiler = self.profiler
+        clock = time.perf_counter
+        if profiler is not None: start_time = clock()
         self.display.initialize(self.state.data)
+        if profiler is not None: profiler.add('display', clock() - start_time)
         self.numMoves = 0
 
         ###self.display.initialize(self.state.makeObservation(1).data)
@@ -587,11 +929,8 @@ class Game:
                 self.mute(i)
                 if self.catchExceptions:
                     try:
-                        timed_func = TimeoutFunction(agent.registerInitialState, int(self.rules.getMaxStartupTime(i)))
                         try:
-                            start_time = time.time()
-                            timed_func(self.state.deepCopy())
-                            time_taken = time.time() - start_time
+                            time_taken = timer.call(self.rules.getMaxStartupTime(i), agent.registerInitialState, self.state.deepCopy())[1]
                             self.totalAgentTimes[i] += time_taken
                         except TimeoutFunctionException:
                             print("Agent %d ran out of time on startup!" % i, file=sys.stderr)
@@ -604,7 +943,10 @@ class Game:
                         self.unmute()
                         return
                 else:
+                    start_time = clock()
                     agent.registerInitialState(self.state.deepCopy())
+                    time_taken = clock() - start_time
+                if profiler is not None: profiler.add('startup', time_taken)
                 ## TODO: could this exceed the total time
                 self.unmute()
 
@@ -612,45 +954,50 @@ class Game:
         numAgents = len( self.agents )
 
         while not self.gameOver:
+            if profiler is not None: start_time = clock()
             time.sleep(delay)
+            if profiler is not None: profiler.add('delay', clock() - start_time)
             # Fetch the next agent
             agent = self.agents[agentIndex]
             move_time = 0
             skip_action = False
             # Generate an observation of the state
+            if profiler is not None: observe_start = clock()
             if 'observationFunction' in dir( agent ):
+                observed = self.state
+                if not getattr(agent.observationFunction, 'readOnlyObservation', False):
+                    observed = observed.deepCopy()
                 self.mute(agentIndex)
                 if self.catchExceptions:
                     try:
-                        timed_func = TimeoutFunction(agent.observationFunction, int(self.rules.getMoveTimeout(agentIndex)))
                         try:
-                            start_time = time.time()
-                            observation = timed_func(self.state.deepCopy())
+                            observation, move_time = timer.call(self.rules.getMoveTimeout(agentIndex), agent.observationFunction, observed)
                         except TimeoutFunctionException:
                             skip_action = True
-                        move_time += time.time() - start_time
                         self.unmute()
                     except Exception as data:
                         self._agentCrash(agentIndex, quiet=False)
                         self.unmute()
                         return
                 else:
-                    observation = agent.observationFunction(self.state.deepCopy())
+                    start_time = clock()
+                    observation = agent.observationFunction(observed)
+                    move_time = clock() - start_time
                 self.unmute()
             else:
                 observation = self.state.deepCopy()
+            if profiler is not None: profiler.add('observation', clock() - observe_start)
 
             # Solicit an action
             action = None
             self.mute(agentIndex)
             if self.catchExceptions:
                 try:
-                    timed_func = TimeoutFunction(agent.getAction, int(self.rules.getMoveTimeout(agentIndex)) - int(move_time))
                     try:
-                        start_time = time.time()
                         if skip_action:
                             raise TimeoutFunctionException()
-                        action = timed_func( observation )
+                        # The action gets what the observation left of the budget
+                        action, action_time = timer.call(self.rules.getMoveTimeout(agentIndex) - move_time, agent.getAction, observation)
                     except TimeoutFunctionException:
                         print("Agent %d timed out on a single move!" % agentIndex, file=sys.stderr)
                         self.agentTimeout = True
@@ -658,7 +1005,9 @@ class Game:
                         self.unmute()
                         return
 
-                    move_time += time.time() - start_time
+                    move_time += action_time
+                    if profiler is not None: profiler.add('agent', action_time)
+                    self.agentLatencies[agentIndex].add(move_time)
 
                     if move_time > self.rules.getMoveWarningTime(agentIndex):
                         self.totalAgentTimeWarnings[agentIndex] += 1
@@ -684,11 +1033,16 @@ class Game:
                     self.unmute()
                     return
             else:
+                start_time = clock()
                 action = agent.getAction(observation)
+                action_time = clock() - start_time
+                self.agentLatencies[agentIndex].add(move_time + action_time)
+                if profiler is not None: profiler.add('agent', action_time)
             self.unmute()
 
             # Execute the action
             self.moveHistory.append( (agentIndex, action) )
+            if profiler is not None: start_time = clock()
             if self.catchExceptions:
                 try:
                     self.state = self.state.generateSuccessor( agentIndex, action )
@@ -699,14 +1053,21 @@ class Game:
                     return
             else:
                 self.state = self.state.generateSuccessor( agentIndex, action )
+            if profiler is not None: profiler.add('successor', clock() - start_time)
+            if self.recorder is not None:
+                self.recorder.recordMove( agentIndex, action, self.state )
 
             # Change the display
+            if profiler is not None: start_time = clock()
             self.display.update( self.state.data )
             ###idx = agentIndex - agentIndex % 2 + 1
             ###self.display.update( self.state.makeObservation(idx).data )
+            if profiler is not None: profiler.add('display', clock() - start_time)
 
             # Allow for game specific conditions (winning, losing, etc.)
+            if profiler is not None: start_time = clock()
             self.rules.process(self.state, self)
+            if profiler is not None: profiler.add('rules', clock() - start_time)
             # Track progress
             if agentIndex == numAgents + 1: self.numMoves += 1
             # Next agent
@@ -720,11 +1081,66 @@ class Game:
             if "final" in dir( agent ) :
                 try:
                     self.mute(agentIndex)
+                    if profiler is not None: start_time = clock()
                     agent.final( self.state )
+                    if profiler is not None: profiler.add('final', clock() - start_time)
                     self.unmute()
                 except Exception as data:
                     if not self.catchExceptions: raise data
                     self._agentCrash(agentIndex)
                     self.unmute()
                     return
-        self.display.finish()
\ No newline at end of file
+        if profiler is not None: start_time = clock()
+        self.display.finish()
+        if profiler is not None: profiler.add('display', clock() - start_time)
+
+    def runFast( self ):
+        """
+        Headless control loop for training runs.
+
+        Plays the same game as run() but skips the display, delays, output
+        muting and time bookkeeping.  Game states are never modified once
+        generated, so agents that set copyObservations = False receive the
+        live state rather than a deep copy.  Timeouts need catchExceptions,
+        which always uses run(), and so does a game with a profiler.
+        """
+        self.numMoves = 0
+        agents = self.agents
+        for i, agent in enumerate(agents):
+            if not agent:
+                print("Agent %d failed to load" % i, file=sys.stderr)
+                self._agentCrash(i, quiet=True)
+                return
+            register = getattr(agent, 'registerInitialState', None)
+            if register is not None:
+                register(self.state.deepCopy())
+
+        # Resolve the per-agent hooks once instead of on every turn
+        observers = [getattr(agent, 'observationFunction', None) for agent in agents]
+        copies = [getattr(agent, 'copyObservations', True) for agent in agents]
+        getActions = [agent.getAction for agent in agents]
+        moveHistory = self.moveHistory
+        recorder = self.recorder
+        process = self.rules.process
+        agentIndex = self.startingIndex
+        numAgents = len( agents )
+
+        while not self.gameOver:
+            state = self.state
+            if copies[agentIndex]:
+                state = state.deepCopy()
+            observe = observers[agentIndex]
+            observation = observe(state) if observe is not None else state
+            action = getActions[agentIndex](observation)
+
+            moveHistory.append( (agentIndex, action) )
+            self.state = self.state.generateSuccessor( agentIndex, action )
+            if recorder is not None:
+                recorder.recordMove( agentIndex, action, self.state )
+            process(self.state, self)
+            agentIndex = ( agentIndex + 1 ) % numAgents
+
+        for agent in agents:
+            final = getattr(agent, 'final', None)
+            if final is not None:
+                final( self.state )
@@ -14,8 +14,14 @@
 
 from util import manhattanDistance
 from game import Grid
+from game import BitGrid
+from game import MoveTable
+import collections
+import hashlib
 import os
+import pickle
 import random
+import util
 
 VISIBILITY_MATRIX_CACHE = {}
 
@@ -28,18 +34,28 @@ class Layout:
         self.width = len(layoutText[0])
         self.height= len(layoutText)
         self.walls = Grid(self.width, self.height, False)
-        self.food = Grid(self.width, self.height, False)
+        self.food = BitGrid(self.width, self.height, False)
         self.capsules = []
         self.agentPositions = []
         self.numGhosts = 0
         self.processLayoutText(layoutText)
         self.layoutText = layoutText
-        self.totalFood = len(self.food.asList())
+        self.totalFood = self.food.count()
         # self.initializeVisibilityMatrix()
 
     def getNumGhosts(self):
         return self.numGhosts
 
+    def getMoveTable(self):
+        """
+        Returns the MoveTable of the walls, built on first use and shared by
+        copies of the layout made afterwards.
+        """
+        table = getattr(self, '_moveTable', None)
+        if table is None:
+            table = self._moveTable = MoveTable(self.walls)
+        return table
+
     def initializeVisibilityMatrix(self):
         global VISIBILITY_MATRIX_CACHE
         if reduce(str.__add__, self.layoutText) not in VISIBILITY_MATRIX_CACHE:
@@ -90,7 +106,15 @@ class Layout:
         return "\n".join(self.layoutText)
 
     def deepCopy(self):
-        return Layout(self.layoutText[:])
+        # Copy the parsed board rather than parsing layoutText again
+        layout = Layout.__new__(Layout)
+        layout.__dict__.update(self.__dict__)
+        layout.walls = self.walls.deepCopy()
+        layout.food = self.food.deepCopy()
+        layout.capsules = self.capsules[:]
+        layout.agentPositions = self.agentPositions[:]
+        layout.layoutText = self.layoutText[:]
+        return layout
 
     def processLayoutText(self, layoutText):
         """
@@ -129,6 +153,9 @@ class Layout:
             self.agentPositions.append( (int(layoutChar), (x,y)))
             self.numGhosts += 1
 def getLayout(name, back = 2):
+    layout = getRegistry().getLayout(name)
+    if layout is not None:
+        return layout
     if name.endswith('.lay'):
         layout = tryToLoad('layouts/' + name)
         if layout == None: layout = tryToLoad(name)
@@ -145,5 +172,168 @@ def getLayout(name, back = 2):
 def tryToLoad(fullname):
     if(not os.path.exists(fullname)): return None
     f = open(fullname)
-    try: return Layout([line.strip() for line in f])
+    try: return parseLayout([line.strip() for line in f])
     finally: f.close()
+
+# Directories of .lay files indexed by the LayoutRegistry, in order of priority
+LAYOUT_DIRECTORIES = ('layouts', 'layouts-1')
+
+class LayoutRegistry:
+    """
+    An index from layout names to the .lay files of LAYOUT_DIRECTORIES,
+    looked up once in the current directory, its parents (like getLayout)
+    and the directory of this module.
+    """
+    def __init__(self, directories=LAYOUT_DIRECTORIES, back=2):
+        roots = [os.path.abspath('.')]
+        for i in range(back):
+            roots.append(os.path.dirname(roots[-1]))
+        roots.append(os.path.dirname(os.path.abspath(__file__)))
+        self.paths = {}
+        self.loaded = {}
+        for root in roots:
+            for directory in directories:
+                directory = os.path.join(root, directory)
+                if not os.path.isdir(directory): continue
+                for filename in sorted(os.listdir(directory)):
+                    if filename.endswith('.lay'):
+                        self.paths.setdefault(filename[:-4], os.path.join(directory, filename))
+
+    def names(self):
+        return sorted(self.paths)
+
+    def getPath(self, name):
+        if name.endswith('.lay'): name = name[:-4]
+        return self.paths.get(name)
+
+    def getLayout(self, name):
+        path = self.getPath(name)
+        if path is None: return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        # Only read the file again when it changed since the last call
+        version = (stat.st_mtime_ns, stat.st_size)
+        loaded = self.loaded.get(path)
+        if loaded is None or loaded[0] != version:
+            loaded = (version, tryToLoad(path))
+            self.loaded[path] = loaded
+        return loaded[1]
+
+_registry = None
+
+def getRegistry():
+    "The LayoutRegistry used by getLayout, built on first use."
+    global _registry
+    if _registry is None:
+        _registry = LayoutRegistry()
+    return _registry
+
+def layoutDigest(layoutText):
+    "A content hash of a layout's lines, used to name its cache file."
+    return hashlib.sha1('\n'.join(layoutText).encode()).hexdigest()
+
+def _readCache(name):
+    directory = util.getCacheDirectory('layouts')
+    if directory is None: return None
+    try:
+        with open(os.path.join(directory, name), 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+
+def _writeCache(name, value):
+    directory = util.getCacheDirectory('layouts')
+    if directory is None: return
+    path = os.path.join(directory, name)
+    try:
+        # Write under a temporary name so concurrent runs never see half a file
+        tmpPath = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmpPath, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpPath, path)
+    except OSError:
+        pass
+
+# The layouts parsed or generated last, most recent at the end; a run over
+# many random mazes keeps only these in memory (the disk cache has the rest)
+MEMORY_CACHE_SIZE = 32
+_layoutsByDigest = collections.OrderedDict()
+_codeDigest = None
+
+def _remember(cache, key, value):
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > MEMORY_CACHE_SIZE:
+        cache.popitem(last=False)
+
+def parseLayout(layoutText):
+    """
+    Returns the Layout for layoutText, a list of lines.
+
+    The layouts parsed last are kept in memory, and all are pickled to the
+    on-disk cache under the hash of their text and of the code that parses
+    them, so a layout is parsed once and later loads, in this or another
+    process, skip processLayoutText.  Callers share the returned Layout and
+    must not modify it.
+    """
+    global _codeDigest
+    digest = layoutDigest(layoutText)
+    layout = _layoutsByDigest.get(digest)
+    if layout is not None:
+        _layoutsByDigest.move_to_end(digest)
+    else:
+        if _codeDigest is None:
+            # A change to Layout or the grids it builds would otherwise load
+            # pickles of the old classes' attributes
+            import game
+            code = hashlib.sha1()
+            for path in (__file__, game.__file__):
+                with open(path, 'rb') as f:
+                    code.update(f.read())
+            _codeDigest = code.hexdigest()[:16]
+        name = '%s-%s.pickle' % (_codeDigest, digest)
+        layout = _readCache(name)
+        if layout is None or layout.layoutText != layoutText:
+            layout = Layout(layoutText)
+            _writeCache(name, layout)
+        _remember(_layoutsByDigest, digest, layout)
+    return layout
+
+_randomLayouts = collections.OrderedDict()
+_generatorDigest = None
+
+def getRandomLayout(seed):
+    """
+    Returns the random capture maze for seed, as capture.randomLayout(seed)
+    generates it, from the cache when it was generated before.  Without a
+    seed the maze is random and not cached.
+
+    The maze generator seeds the global random generator, so the random
+    state it leaves behind is cached with the maze and restored on every
+    call: games play the same whether the maze came from the cache or not.
+    """
+    global _generatorDigest
+    import mazeGenerator
+    if not seed:
+        # A maze nobody can ask for again is not worth caching
+        return Layout(mazeGenerator.generateMaze(random.randint(0, 99999999)).split('\n'))
+    entry = _randomLayouts.get(seed)
+    if entry is not None:
+        _randomLayouts.move_to_end(seed)
+    else:
+        if _generatorDigest is None:
+            # A change to the generator makes different mazes for the same seed
+            with open(mazeGenerator.__file__, 'rb') as f:
+                _generatorDigest = hashlib.sha1(f.read()).hexdigest()[:16]
+        name = 'random-%s-%s.pickle' % (_generatorDigest, seed)
+        entry = _readCache(name)
+        if entry is None:
+            layoutText = mazeGenerator.generateMaze(seed).split('\n')
+            entry = (layoutText, random.getstate())
+            _writeCache(name, entry)
+        entry = (parseLayout(entry[0]), entry[1])
+        _remember(_randomLayouts, seed, entry)
+    random.setstate(entry[1])
+    return entry[0]
@@ -41,12 +41,13 @@ The keys are 'a', 's', 'd', and 'w' to move (or arrow keys).  Have fun!
 """
 # from RLAgents import RLAgent
 from game import GameStateData
+from game import Configuration
 from game import Game
 from game import Directions
 from game import Actions
 from util import nearestPoint
 from util import manhattanDistance
-import util, layout
+import util, layout, replay, profiler
 import sys, types, time, random, os
 
 ###################################################
@@ -113,7 +114,7 @@ class GameState:
         if agentIndex == 0:
             state.data.scoreChange += -TIME_PENALTY # Penalty for waiting around
         else:
-            GhostRules.decrementTimer( state.data.agentStates[agentIndex] )
+            GhostRules.decrementTimer( state.data.getWritableAgentState( agentIndex ) )
 
         # Resolve multi-agent effects
         GhostRules.checkDeath( state, agentIndex )
@@ -175,7 +176,7 @@ class GameState:
         return self.data.capsules
 
     def getNumFood( self ):
-        return self.data.food.count()
+        return self.data.getNumFood()
 
     def getFood(self):
         """
@@ -272,11 +273,11 @@ class ClassicGameRules:
     def __init__(self, timeout=30):
         self.timeout = timeout
 
-    def newGame( self, layout, pacmanAgent, ghostAgents, display, quiet = False, catchExceptions=False):
+    def newGame( self, layout, pacmanAgent, ghostAgents, display, quiet = False, catchExceptions=False, fast=False):
         agents = [pacmanAgent] + ghostAgents[:layout.getNumGhosts()]
         initState = GameState()
         initState.initialize( layout, len(ghostAgents) )
-        game = Game(agents, display, self, catchExceptions=catchExceptions)
+        game = Game(agents, display, self, catchExceptions=catchExceptions, fast=fast)
         game.state = initState
         self.initialState = initState.deepCopy()
         self.quiet = quiet
@@ -332,7 +333,7 @@ class PacmanRules:
         """
         Returns a list of possible actions.
         """
-        return Actions.getPossibleActions( state.getPacmanState().configuration, state.data.layout.walls )
+        return state.data.layout.getMoveTable().getPossibleActions( state.getPacmanState().configuration )
     getLegalActions = staticmethod( getLegalActions )
 
     def applyAction( state, action ):
@@ -343,7 +344,7 @@ class PacmanRules:
         if action not in legal:
             raise Exception("Illegal action " + str(action))
 
-        pacmanState = state.data.agentStates[0]
+        pacmanState = state.data.getWritableAgentState( 0 )
 
         # Update Configuration
         vector = Actions.directionToVector( action, PacmanRules.PACMAN_SPEED )
@@ -363,9 +364,8 @@ class PacmanRules:
         if state.data.food[x][y]:
             state.data.scoreChange += 10
             state.data.food = state.data.food.copy()
-            state.data.food[x][y] = False
+            state.data.setFood( position, False )
             state.data._foodEaten = position
-            # TODO: cache numFood?
             numFood = state.getNumFood()
             if numFood == 0 and not state.data._lose:
                 state.data.scoreChange += 500
@@ -376,7 +376,7 @@ class PacmanRules:
             state.data._capsuleEaten = position
             # Reset all ghosts' scared timers
             for index in range( 1, len( state.data.agentStates ) ):
-                state.data.agentStates[index].scaredTimer = SCARED_TIME
+                state.data.getWritableAgentState( index ).scaredTimer = SCARED_TIME
     consume = staticmethod( consume )
 
 class GhostRules:
@@ -390,7 +390,7 @@ class GhostRules:
         reach a dead end, but can turn 90 degrees at intersections.
         """
         conf = state.getGhostState( ghostIndex ).configuration
-        possibleActions = Actions.getPossibleActions( conf, state.data.layout.walls )
+        possibleActions = state.data.layout.getMoveTable().getPossibleActions( conf )
         reverse = Actions.reverseDirection( conf.direction )
         if Directions.STOP in possibleActions:
             possibleActions.remove( Directions.STOP )
@@ -405,7 +405,7 @@ class GhostRules:
         if action not in legal:
             raise Exception("Illegal ghost action " + str(action))
 
-        ghostState = state.data.agentStates[ghostIndex]
+        ghostState = state.data.getWritableAgentState( ghostIndex )
         speed = GhostRules.GHOST_SPEED
         if ghostState.scaredTimer > 0: speed /= 2.0
         vector = Actions.directionToVector( action, speed )
@@ -415,7 +415,9 @@ class GhostRules:
     def decrementTimer( ghostState):
         timer = ghostState.scaredTimer
         if timer == 1:
-            ghostState.configuration.pos = nearestPoint( ghostState.configuration.pos )
+            # Configurations may be shared with earlier states, so replace it
+            conf = ghostState.configuration
+            ghostState.configuration = Configuration( nearestPoint( conf.pos ), conf.direction )
         ghostState.scaredTimer = max( 0, timer - 1 )
     decrementTimer = staticmethod( decrementTimer )
 
@@ -437,6 +439,7 @@ class GhostRules:
     def collide( state, ghostState, agentIndex):
         if ghostState.scaredTimer > 0:
             state.data.scoreChange += 200
+            ghostState = state.data.getWritableAgentState( agentIndex )
             GhostRules.placeGhost(state, ghostState)
             ghostState.scaredTimer = 0
             # Added for first-person
@@ -524,6 +527,12 @@ def readCommand( argv ):
                       help='Turns on exception handling and timeouts during games', default=False)
     parser.add_option('--timeout', dest='timeout', type='int',
                       help=default('Maximum length of time an agent can spend computing in a single game'), default=30)
+    parser.add_option('--fast', action='store_true', dest='fast',
+                      help='Headless simulation for training runs: no graphics, no delays, no state copies for agents that do not need them; reports episodes per second', default=False)
+    parser.add_option('--profile', dest='profile', metavar='FILE',
+                      help='Times every phase of the games (agents, successors, observations, display, rules) and writes a JSON report to FILE', default=None)
+    parser.add_option('--profile-stats', dest='profileStats', metavar='FILE',
+                      help='With --profile, also writes a cProfile dump of the run (readable with pstats) to FILE', default=None)
 
     options, otherjunk = parser.parse_args(argv)
     if len(otherjunk) != 0:
@@ -557,7 +566,7 @@ def readCommand( argv ):
     args['ghosts'] = [ghostType( i+1 ) for i in range( options.numGhosts )]
 
     # Choose a display format
-    if options.quietGraphics:
+    if options.quietGraphics or options.fast:
         import textDisplay
         args['display'] = textDisplay.NullGraphics()
     elif options.textGraphics:
@@ -571,14 +580,14 @@ def readCommand( argv ):
     args['record'] = options.record
     args['catchExceptions'] = options.catchExceptions
     args['timeout'] = options.timeout
+    args['fast'] = options.fast
+    if options.profile or options.profileStats:
+        args['profiler'] = profiler.GameProfiler(options.profile, options.profileStats)
 
     # Special case: recorded games don't use the runGames method or args structure
     if options.gameToReplay != None:
         print('Replaying recorded game %s.' % options.gameToReplay)
-        import pickle
-        f = open(options.gameToReplay)
-        try: recorded = pickle.load(f)
-        finally: f.close()
+        recorded = loadRecordedGame(options.gameToReplay)
         recorded['display'] = args['display']
         replayGame(**recorded)
         sys.exit(0)
@@ -610,6 +619,18 @@ def loadAgent(pacman, nographics):
                 return getattr(module, pacman)
     raise Exception('The agent ' + pacman + ' is not specified in any *Agents.py.')
 
+def loadRecordedGame(filename):
+    """
+    Reads a game saved with -r: a replay file, or a pickle written by older
+    versions.
+    """
+    if replay.isReplay(filename):
+        recorded = replay.ReplayReader(filename)
+        return {'layout': recorded.layout, 'actions': recorded.actions}
+    import pickle
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
 def replayGame( layout, actions, display ):
     import pacmanAgents, ghostAgents
     rules = ClassicGameRules()
@@ -628,7 +649,7 @@ def replayGame( layout, actions, display ):
 
     display.finish()
 
-def runGames( layout, pacman, ghosts, display, numGames, record, numTraining = 0, catchExceptions=False, timeout=30 ):
+def runGames( layout, pacman, ghosts, display, numGames, record, numTraining = 0, catchExceptions=False, timeout=30, fast=False, profiler=None ):
     import __main__
     __main__.__dict__['_display'] = display
 
@@ -641,6 +662,8 @@ def runGames( layout, pacman, ghosts, display, numGames, record, numTraining = 0
     # ctr = classtracker.ClassTracker()
     # ctr.track_object(pacman)
 
+    startTime = time.time()
+    if profiler is not None: profiler.start()
     for i in range( numGames ):
         beQuiet = i < numTraining
         if beQuiet:
@@ -651,17 +674,20 @@ def runGames( layout, pacman, ghosts, display, numGames, record, numTraining = 0
         else:
             gameDisplay = display
             rules.quiet = False
-        game = rules.newGame( layout, pacman, ghosts, gameDisplay, beQuiet, catchExceptions)
-        game.run()
-        if not beQuiet: games.append(game)
-        
+        if profiler is not None: setupStart = time.perf_counter()
+        game = rules.newGame( layout, pacman, ghosts, gameDisplay, beQuiet, catchExceptions, fast)
+        if profiler is not None:
+            profiler.add('setup', time.perf_counter() - setupStart)
+            game.profiler = profiler
         if record:
-            import time, pickle
             fname = ('recorded-game-%d' % (i + 1)) +  '-'.join([str(t) for t in time.localtime()[1:6]])
-            f = open(fname, 'w')
-            components = {'layout': layout, 'actions': game.moveHistory}
-            pickle.dump(components, f)
-            f.close()
+            game.recorder = replay.ReplayWriter(fname, layout, {'game': 'pacman', 'numAgents': len(game.agents)})
+        try:
+            game.run()
+        finally:
+            if game.recorder is not None: game.recorder.close(game)
+        if profiler is not None: profiler.addGame(game)
+        if not beQuiet: games.append(game)
 
     if (numGames-numTraining) > 0:
         scores = [game.state.getScore() for game in games]
@@ -675,6 +701,10 @@ def runGames( layout, pacman, ghosts, display, numGames, record, numTraining = 0
             for item in scores:
                 fp.write("%s\n" % item)'''
 
+    if fast:
+        elapsed = time.time() - startTime
+        print('Simulated %d episodes in %.2fs (%.1f episodes/sec)' % (numGames, elapsed, numGames / max(elapsed, 1e-9)))
+    if profiler is not None: profiler.finish()
 
     return games
 
@@ -691,7 +721,4 @@ if __name__ == '__main__':
     """
     args = readCommand( sys.argv[1:] ) # Get game components based on input
     runGames( **args )
-
-    # import cProfile
-    # cProfile.run("runGames( **args )")
     pass
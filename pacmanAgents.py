@@ -22,6 +22,7 @@ import article_funcs as article
 
 class LeftTurnAgent(game.Agent):
     "An agent that turns left at every opportunity"
+    copyObservations = False
 
     def getAction(self, state):
         legal = state.getLegalPacmanActions()
@@ -35,6 +36,8 @@ class LeftTurnAgent(game.Agent):
         return Directions.STOP
 
 class GreedyAgent(game.Agent):
+    copyObservations = False
+
     def __init__(self, evalFn="scoreEvaluation"):
         self.evaluationFunction = util.lookup(evalFn, globals())
         assert self.evaluationFunction != None
@@ -57,6 +60,7 @@ def scoreEvaluation(state:GameState, action):
 
 import article_funcs as af
 class ReinforcementLearningAgent(game.Agent):
+    copyObservations = False
 
     def __init__(self, **args):
         super()
@@ -0,0 +1,154 @@
+# profiler.py
+# -----------
+# Per-phase timings of pacman.py and capture.py games, for --profile.
+
+"""
+Where the time of a run goes.
+
+A GameProfiler is handed to runGames, which sets it as the profiler of
+every Game.  The game loop then times each phase of a turn separately:
+
+    setup         creating the game (rules.newGame)
+    startup       agents' registerInitialState
+    distances     maze distance precomputation (timed within startup, but
+                  counted as framework rather than agent time)
+    observation   building the agent's observation (state copy and
+                  observationFunction, e.g. makeObservation)
+    agent         agents' getAction
+    successor     generateSuccessor
+    rules         rules.process (win, loss and time limit checks)
+    display       display updates
+    delay         sleeping between turns (capture.py's --delay-step; the
+                  frameTime of pacman.py displays counts as display)
+    final         agents' final
+
+Every phase is a util.LatencyHistogram aggregated over all games, as are
+the per-agent move latencies (observation plus action) that Game already
+keeps.  finish() writes them as a JSON report, along with the split
+between framework phases and agent code, and optionally a cProfile dump
+of the whole run that the pstats module can read.
+"""
+
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+from util import LatencyHistogram
+
+PHASES = ['setup', 'startup', 'distances', 'observation', 'agent',
+          'successor', 'rules', 'display', 'delay', 'final']
+
+# Phases spent in code the agents wrote.  distances runs within startup but
+# is framework code, so report() moves it from the agents' share
+AGENT_PHASES = ['startup', 'agent', 'final']
+FRAMEWORK_PHASES = ['setup', 'observation', 'successor', 'rules', 'display']
+
+# The profiler of the run in progress, for code that has no Game at hand
+_active = None
+
+
+class GameProfiler:
+    """
+    Collects phase timings over all the games of a run, from start() to
+    finish().  reportFile is where the JSON report goes (None to only
+    print the summary) and statsFile where the cProfile dump goes.
+    """
+    def __init__(self, reportFile=None, statsFile=None):
+        self.reportFile = reportFile
+        self.statsFile = statsFile
+        self.phases = dict((name, LatencyHistogram()) for name in PHASES)
+        self.agentLatencies = {}
+        self.numGames = 0
+        self.numMoves = 0
+        self.wallTime = 0.0
+        self.startTime = None
+        self.cProfile = None
+
+    def start(self):
+        global _active
+        _active = self
+        self.startTime = time.perf_counter()
+        if self.statsFile:
+            import cProfile
+            self.cProfile = cProfile.Profile()
+            self.cProfile.enable()
+
+    def add(self, phase, seconds):
+        self.phases[phase].add(seconds)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name].add(time.perf_counter() - start)
+
+    def addGame(self, game):
+        """
+        Adds the per-agent latencies and the length of a finished game.
+        """
+        self.numGames += 1
+        self.numMoves += len(game.moveHistory)
+        for index, latencies in enumerate(game.agentLatencies):
+            if index not in self.agentLatencies:
+                self.agentLatencies[index] = LatencyHistogram()
+            self.agentLatencies[index].merge(latencies)
+
+    def report(self):
+        total = lambda names: sum(self.phases[name].total for name in names)
+        distances = self.phases['distances'].total
+        phases = {}
+        for name in PHASES:
+            phases[name] = self.phases[name].asDict()
+            phases[name]['total'] = self.phases[name].total
+        return {
+            'games': self.numGames,
+            'moves': self.numMoves,
+            'wallTime': self.wallTime,
+            'frameworkTime': total(FRAMEWORK_PHASES) + distances,
+            'agentTime': total(AGENT_PHASES) - distances,
+            'phases': phases,
+            'agents': dict((str(index), latencies.asDict())
+                           for index, latencies in sorted(self.agentLatencies.items())),
+        }
+
+    def finish(self):
+        """
+        Stops profiling, prints a summary and writes the report files.
+        """
+        global _active
+        if _active is self: _active = None
+        if self.startTime is not None:
+            self.wallTime += time.perf_counter() - self.startTime
+            self.startTime = None
+        if self.cProfile is not None:
+            self.cProfile.disable()
+            self.cProfile.dump_stats(self.statsFile)
+            self.cProfile = None
+        print(self)
+        if self.reportFile:
+            with open(self.reportFile, 'w') as f:
+                json.dump(self.report(), f, indent=2)
+
+    def __str__(self):
+        lines = ['Profile of %d games, %d moves, %.2fs:' % (self.numGames, self.numMoves, self.wallTime)]
+        for name in PHASES:
+            histogram = self.phases[name]
+            if histogram.count == 0: continue
+            lines.append('  %-12s %8.3fs %5.1f%%  %d calls, mean %.3fms, max %.3fms' % (
+                name, histogram.total, 100.0 * histogram.total / max(self.wallTime, 1e-9),
+                histogram.count, histogram.mean() * 1000, histogram.max * 1000))
+        report = self.report()
+        lines.append('  framework %.3fs, agents %.3fs' % (report['frameworkTime'], report['agentTime']))
+        return '\n'.join(lines)
+
+
+def phase(name):
+    """
+    Times a block as the given phase of the run being profiled, if any.
+    """
+    if _active is None:
+        return nullcontext()
+    return _active.phase(name)
+
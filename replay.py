@@ -0,0 +1,325 @@
+# replay.py
+# ---------
+# Compact binary game recordings for pacman.py and capture.py.
+
+"""
+Replay files record a game as the layout it was played on plus the stream
+of moves, written while the game is being played.
+
+A file starts with a header:
+
+    MAGIC, version byte, varint length + JSON metadata,
+    20 byte SHA-1 of the layout text, varint length + zlib'ed layout text
+
+followed by records, each introduced by a varint:
+
+    0           checkpoint: varint move number, varint length, payload
+    1           end of the game: varint length, JSON result (version 2 on)
+    2 + code    a move, where code = agentIndex * 5 + direction
+
+Checkpoints hold the parts of the game state that moves change (agents,
+food, capsules, score and time left) every CHECKPOINT_INTERVAL moves, so a
+reader can jump to any move by restoring the checkpoint before it and
+replaying at most CHECKPOINT_INTERVAL moves.  Files cut short by a crash
+have no end record and are read up to their last complete record.
+"""
+
+import hashlib
+import json
+import struct
+import zlib
+
+from game import Configuration, Directions
+
+MAGIC = b'PACREPLAY'
+VERSION = 2
+
+CHECKPOINT_INTERVAL = 100
+
+DIRECTIONS = [Directions.NORTH, Directions.SOUTH, Directions.EAST,
+              Directions.WEST, Directions.STOP]
+DIRECTION_CODES = dict((direction, code) for code, direction in enumerate(DIRECTIONS))
+
+_CHECKPOINT = 0
+_END = 1
+_FIRST_MOVE = 2
+
+
+def isReplay(filename):
+    """
+    Tells whether filename is in this format rather than an old pickle.
+    """
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def layoutHash(layout):
+    """
+    The SHA-1 of a layout's text, which identifies the layout of a replay.
+    """
+    return hashlib.sha1('\n'.join(layout.layoutText).encode()).digest()
+
+
+def _writeVarint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _readVarint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+class ReplayWriter:
+    """
+    Streams a game to a replay file.  Pass it to Game as its recorder, or
+    call recordMove after every move, and close it when the game is over.
+    """
+    def __init__(self, filename, layout, metadata=None, checkpointInterval=CHECKPOINT_INTERVAL):
+        self.file = open(filename, 'wb')
+        self.interval = checkpointInterval
+        self.numMoves = 0
+        self.cells = openCells(layout)
+
+        header = bytearray(MAGIC)
+        header.append(VERSION)
+        info = json.dumps(metadata or {}).encode()
+        _writeVarint(header, len(info))
+        header += info
+        header += layoutHash(layout)
+        text = zlib.compress('\n'.join(layout.layoutText).encode(), 9)
+        _writeVarint(header, len(text))
+        header += text
+        self.file.write(header)
+
+    def recordMove(self, agentIndex, action, state):
+        """
+        Records that agentIndex played action, which led to state.
+        """
+        record = bytearray()
+        _writeVarint(record, _FIRST_MOVE + agentIndex * 5 + DIRECTION_CODES[action])
+        self.numMoves += 1
+        if self.numMoves % self.interval == 0:
+            payload = encodeState(state.data, self.cells)
+            _writeVarint(record, _CHECKPOINT)
+            _writeVarint(record, self.numMoves)
+            _writeVarint(record, len(payload))
+            record += payload
+        self.file.write(record)
+
+    def close(self, game=None):
+        """
+        Ends the replay, recording the final score of game and whether it
+        ended because an agent crashed or timed out.
+        """
+        if self.file.closed: return
+        result = {'moves': self.numMoves}
+        if game is not None:
+            result.update(score=game.state.data.score, crashed=game.agentCrashed,
+                          timeout=game.agentTimeout)
+        info = json.dumps(result).encode()
+        record = bytearray([_END])
+        _writeVarint(record, len(info))
+        record += info
+        self.file.write(record)
+        self.file.close()
+
+
+class ReplayReader:
+    """
+    Reads a replay file.  The whole game is available as layout, metadata
+    and actions (a list of (agentIndex, action) pairs, like
+    Game.moveHistory), and stateAt jumps to the state after any move.
+    result holds what ReplayWriter.close recorded, and complete is False for
+    a game that was cut short.  The file's content can be passed as data
+    instead of being read from filename.
+    """
+    def __init__(self, filename, data=None):
+        import layout
+        if data is None:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        self.data = data
+        if not data.startswith(MAGIC):
+            raise ValueError('%s is not a replay file' % filename)
+        offset = len(MAGIC)
+        self.version = version = data[offset]
+        if version > VERSION:
+            raise ValueError('%s has replay format version %d, newer than %d' % (filename, version, VERSION))
+        length, offset = _readVarint(data, offset + 1)
+        self.metadata = json.loads(data[offset:offset + length].decode())
+        offset += length
+        self.layoutHash = data[offset:offset + 20]
+        length, offset = _readVarint(data, offset + 20)
+        text = zlib.decompress(data[offset:offset + length]).decode()
+        self.layout = layout.Layout(text.split('\n'))
+        if layoutHash(self.layout) != self.layoutHash:
+            raise ValueError('%s has a damaged layout' % filename)
+        self.cells = openCells(self.layout)
+        self.complete = False
+        self.result = {}
+        self.actions, self.checkpoints = self._readMoves(offset + length)
+
+    def _readMoves(self, offset):
+        data = self.data
+        actions = []
+        checkpoints = []
+        end = len(data)
+        try:
+            while offset < end:
+                start = offset
+                value, offset = _readVarint(data, offset)
+                if value == _END:
+                    if self.version >= 2:
+                        length, offset = _readVarint(data, offset)
+                        self.result = json.loads(data[offset:offset + length].decode())
+                    self.complete = True
+                    break
+                elif value == _CHECKPOINT:
+                    moveNumber, offset = _readVarint(data, offset)
+                    length, offset = _readVarint(data, offset)
+                    if offset + length > end: break
+                    checkpoints.append((moveNumber, start))
+                    offset += length
+                else:
+                    agentIndex, code = divmod(value - _FIRST_MOVE, 5)
+                    actions.append((agentIndex, DIRECTIONS[code]))
+        except IndexError:
+            # The file ends in the middle of a record
+            pass
+        return actions, checkpoints
+
+    def checkpointBefore(self, moveNumber):
+        """
+        Returns the last checkpoint at or before moveNumber as a pair of the
+        move it was taken after and its offset, or None.
+        """
+        best = None
+        for checkpoint in self.checkpoints:
+            if checkpoint[0] > moveNumber: break
+            best = checkpoint
+        return best
+
+    def stateAt(self, initialState, moveNumber, process=None):
+        """
+        Returns the game state after the first moveNumber moves, given the
+        state the game started from.  Only the moves after the closest
+        checkpoint are replayed; process, if given, is called with every
+        state those moves generate (e.g. rules.process).
+        """
+        state = initialState
+        first = 0
+        checkpoint = self.checkpointBefore(moveNumber)
+        if checkpoint is not None:
+            first = checkpoint[0]
+            state = self.restore(initialState, checkpoint)
+        for agentIndex, action in self.actions[first:moveNumber]:
+            state = state.generateSuccessor(agentIndex, action)
+            if process is not None:
+                process(state)
+        return state
+
+    def restore(self, initialState, checkpoint):
+        """
+        Returns a copy of initialState with the game state saved by one of
+        the checkpoints.
+        """
+        state = initialState.deepCopy()
+        offset = _readVarint(self.data, _readVarint(self.data, checkpoint[1])[1])[1]
+        length, offset = _readVarint(self.data, offset)
+        decodeState(state.data, self.cells, self.data[offset:offset + length])
+        return state
+
+
+def openCells(layout):
+    walls = layout.walls
+    return [(x, y) for x in range(layout.width) for y in range(layout.height) if not walls[x][y]]
+
+
+def encodeState(data, cells):
+    """
+    Packs the parts of a GameStateData that change during a game.
+    """
+    out = bytearray(struct.pack('<d', data.score))
+    timeleft = getattr(data, 'timeleft', None)
+    _writeVarint(out, 0 if timeleft is None else timeleft + 1)
+    _writeVarint(out, len(data.agentStates))
+    for agentState in data.agentStates:
+        configuration = agentState.configuration
+        out.append((configuration is not None) << 1 | bool(agentState.isPacman))
+        if configuration is not None:
+            x, y = configuration.pos
+            _writeVarint(out, int(x * 2))
+            _writeVarint(out, int(y * 2))
+            out.append(DIRECTION_CODES[configuration.direction])
+        _writeVarint(out, agentState.scaredTimer)
+        _writeVarint(out, agentState.numCarrying)
+        _writeVarint(out, agentState.numReturned)
+    food = data.food
+    bits = 0
+    for i, (x, y) in enumerate(cells):
+        if food[x][y]:
+            bits |= 1 << i
+    out += bits.to_bytes((len(cells) + 7) // 8, 'little')
+    _writeVarint(out, len(data.capsules))
+    for x, y in data.capsules:
+        _writeVarint(out, x)
+        _writeVarint(out, y)
+    return bytes(out)
+
+
+def decodeState(data, cells, payload):
+    """
+    Overwrites a GameStateData with a checkpoint made by encodeState, and
+    returns the offset in payload where the checkpoint ends.
+    """
+    data.score = struct.unpack_from('<d', payload)[0]
+    if data.score == int(data.score):
+        data.score = int(data.score)
+    timeleft, offset = _readVarint(payload, 8)
+    if timeleft:
+        data.timeleft = timeleft - 1
+    numAgents, offset = _readVarint(payload, offset)
+    for index in range(numAgents):
+        flags = payload[offset]
+        offset += 1
+        agentState = data.getWritableAgentState(index)
+        agentState.isPacman = bool(flags & 1)
+        if flags & 2:
+            x, offset = _readVarint(payload, offset)
+            y, offset = _readVarint(payload, offset)
+            direction = DIRECTIONS[payload[offset]]
+            offset += 1
+            x, y = x / 2.0, y / 2.0
+            if x == int(x): x = int(x)
+            if y == int(y): y = int(y)
+            agentState.configuration = Configuration((x, y), direction)
+        else:
+            agentState.configuration = None
+        agentState.scaredTimer, offset = _readVarint(payload, offset)
+        agentState.numCarrying, offset = _readVarint(payload, offset)
+        agentState.numReturned, offset = _readVarint(payload, offset)
+    size = (len(cells) + 7) // 8
+    bits = int.from_bytes(payload[offset:offset + size], 'little')
+    offset += size
+    food = data.food.copy()
+    for i, (x, y) in enumerate(cells):
+        food[x][y] = bool(bits >> i & 1)
+    data.food = food
+    data.countFood()
+    numCapsules, offset = _readVarint(payload, offset)
+    capsules = []
+    for i in range(numCapsules):
+        x, offset = _readVarint(payload, offset)
+        y, offset = _readVarint(payload, offset)
+        capsules.append((x, y))
+    data.capsules = capsules
+    return offset
@@ -0,0 +1,291 @@
+# sandbox.py
+# ----------
+# Runs a capture team's agents in a separate, resource limited process.
+
+"""
+Out-of-process agents for capture.py.
+
+A TeamSandbox forks a worker process that creates a team with its
+createTeam function and plays its agents.  The game keeps running in the
+parent process with RemoteAgent stand-ins, which send every observation
+(capture.GameState.makeObservation, computed in the parent so hidden
+opponents never reach the worker) over a socket and read back the action.
+The worker has its own CPU and address space limits (RLIMIT_CPU and
+RLIMIT_AS), its output is discarded, and whatever happens to it only
+crashes the stand-ins of its own team.
+
+Messages are length prefixed binary frames:
+
+    request:    type byte, agent index byte, uint32 length, payload
+    response:   status byte, action byte, double CPU seconds, uint32 length,
+                payload (the traceback when status is ERROR)
+
+Game states are packed with replay.encodeState followed by the sonar
+readings (int16 each); the layout is sent as text with every INIT.  Needs
+os.fork, so it is only available on POSIX systems.
+"""
+
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+import traceback
+
+import replay
+from game import Agent
+from game import readOnlyObservation
+
+try:
+    import resource
+    _RESOURCE_ENABLED = True
+except ImportError:
+    _RESOURCE_ENABLED = False
+
+AVAILABLE = hasattr(os, 'fork')
+
+# Request types
+_CREATE = 0
+_INIT = 1
+_ACTION = 2
+_FINAL = 3
+
+# Response statuses
+_OK = 0
+_ERROR = 1
+
+_REQUEST = struct.Struct('<BBI')
+_RESPONSE = struct.Struct('<BBdI')
+_NO_ACTION = 255
+
+# The parent ends of every worker's socket, which a new worker closes so it
+# cannot talk to the other workers
+_parentSockets = set()
+
+
+class AgentProcessError(Exception):
+    """
+    An agent failed in its worker process, or the process died.
+    """
+    pass
+
+
+def _receive(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return bytes(data)
+
+
+def _encodeObservation(state, cells):
+    payload = replay.encodeState(state.data, cells)
+    distances = state.agentDistances or []
+    return payload + struct.pack('<B%dh' % len(distances), len(distances), *distances)
+
+
+class TeamSandbox:
+    """
+    A worker process playing the agents that factory(firstIndex, secondIndex,
+    isRed, **agentArgs) creates; agents holds their RemoteAgent stand-ins.
+
+    cpuLimit (seconds) and memoryLimit (bytes) cap the whole worker, whose
+    CPU time so far is in cpuTime.  Creating the team happens in the
+    worker, and an AgentProcessError is raised when it fails.
+    """
+    def __init__(self, factory, firstIndex, secondIndex, isRed, agentArgs=None,
+                 cpuLimit=None, memoryLimit=None, startupTimeout=60):
+        if not AVAILABLE:
+            raise AgentProcessError('Agent sandboxes need os.fork')
+        self.factory = factory
+        self.indices = [firstIndex, secondIndex]
+        self.isRed = isRed
+        self.agentArgs = agentArgs or {}
+        self.cpuLimit = cpuLimit
+        self.memoryLimit = memoryLimit
+        self.startupTimeout = startupTimeout
+        self.cpuTime = 0.0
+        self._cpuTimeBefore = 0.0
+        self.sock = None
+        self.pid = None
+        self.layoutText = None
+        self.agents = [RemoteAgent(self, index) for index in self.indices]
+        self._start()
+
+    def _start(self):
+        parentSocket, childSocket = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                for other in _parentSockets: other.close()
+                parentSocket.close()
+                _serve(childSocket, self)
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        childSocket.close()
+        _parentSockets.add(parentSocket)
+        self.sock = parentSocket
+        self.pid = pid
+        self.sock.settimeout(self.startupTimeout)
+        try:
+            self._request(_CREATE, 0, b'')
+        except BaseException:
+            # A team that fails to build leaves no worker behind to leak
+            self.close()
+            raise
+        finally:
+            if self.sock is not None: self.sock.settimeout(None)
+
+    def _request(self, kind, index, payload):
+        if self.sock is None:
+            # The worker was stopped after an interrupted request; a fresh
+            # one recreates the team
+            self._cpuTimeBefore = self.cpuTime
+            self._start()
+        try:
+            self.sock.sendall(_REQUEST.pack(kind, index, len(payload)) + payload)
+            status, action, cpuTime, length = _RESPONSE.unpack(_receive(self.sock, _RESPONSE.size))
+            message = _receive(self.sock, length)
+        except (EOFError, OSError):
+            self.close()
+            raise AgentProcessError('The agent process of %s died' % self._teamName())
+        except BaseException:
+            # Most likely a timeout: the worker is still busy and its answer
+            # would be read as the answer to the next request
+            self.close()
+            raise
+        self.cpuTime = self._cpuTimeBefore + cpuTime
+        if status == _ERROR:
+            raise AgentProcessError(message.decode('utf-8', 'replace'))
+        return action
+
+    def _teamName(self):
+        return 'the %s team' % ('red' if self.isRed else 'blue')
+
+    def _statePayload(self, state):
+        layoutText = state.data.layout.layoutText
+        if layoutText != self.layoutText:
+            self.layoutText = layoutText
+            self.cells = replay.openCells(state.data.layout)
+        return _encodeObservation(state, self.cells)
+
+    def registerInitialState(self, index, state):
+        # Every game may have another layout, so it travels with the INIT
+        text = ('\n'.join(state.data.layout.layoutText)).encode()
+        payload = self._statePayload(state)
+        info = struct.pack('<IHI', len(text), state.getNumAgents(), state.data.timeleft)
+        self._request(_INIT, index, info + text + payload)
+
+    def getAction(self, index, observation):
+        action = self._request(_ACTION, index, self._statePayload(observation))
+        return replay.DIRECTIONS[action]
+
+    def final(self, index, state):
+        self._request(_FINAL, index, self._statePayload(state))
+
+    def close(self):
+        """
+        Stops the worker process.
+        """
+        if self.sock is not None:
+            _parentSockets.discard(self.sock)
+            self.sock.close()
+            self.sock = None
+        if self.pid is not None:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+                os.waitpid(self.pid, 0)
+            except OSError:
+                pass
+            self.pid = None
+
+
+class RemoteAgent(Agent):
+    """
+    Stands in for an agent playing in a TeamSandbox.
+    """
+    copyObservations = False
+
+    def __init__(self, sandbox, index):
+        Agent.__init__(self, index)
+        self.sandbox = sandbox
+
+    def registerInitialState(self, state):
+        self.sandbox.registerInitialState(self.index, state)
+
+    @readOnlyObservation
+    def observationFunction(self, state):
+        return state.makeObservation(self.index)
+
+    def getAction(self, observation):
+        return self.sandbox.getAction(self.index, observation)
+
+    def final(self, state):
+        self.sandbox.final(self.index, state)
+
+
+def _limitResources(sandbox):
+    if not _RESOURCE_ENABLED: return
+    if sandbox.cpuLimit is not None:
+        seconds = int(sandbox.cpuLimit) + 1
+        resource.setrlimit(resource.RLIMIT_CPU, (seconds, seconds + 5))
+    if sandbox.memoryLimit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (sandbox.memoryLimit, sandbox.memoryLimit))
+
+
+def _serve(sock, sandbox):
+    """
+    The worker's main loop: answers requests until the parent goes away.
+    """
+    signal.signal(signal.SIGALRM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    devnull = open(os.devnull, 'w')
+    sys.stdout = sys.stderr = devnull
+    _limitResources(sandbox)
+
+    import capture, layout
+    agents = {}
+    initial = None
+    cells = None
+
+    def decode(payload):
+        state = initial.deepCopy()
+        offset = replay.decodeState(state.data, cells, payload)
+        count = payload[offset]
+        state.agentDistances = list(struct.unpack_from('<%dh' % count, payload, offset + 1))
+        return state
+
+    while True:
+        try:
+            kind, index, length = _REQUEST.unpack(_receive(sock, _REQUEST.size))
+            payload = _receive(sock, length)
+        except (EOFError, OSError):
+            return
+        status, action, message = _OK, _NO_ACTION, b''
+        try:
+            if kind == _CREATE:
+                team = sandbox.factory(sandbox.indices[0], sandbox.indices[1], sandbox.isRed, **sandbox.agentArgs)
+                agents = dict(zip(sandbox.indices, team))
+            elif kind == _INIT:
+                textLength, numAgents, timeleft = struct.unpack_from('<IHI', payload)
+                start = struct.calcsize('<IHI')
+                text = payload[start:start + textLength].decode()
+                initial = capture.GameState()
+                initial.initialize(layout.parseLayout(text.split('\n')), numAgents)
+                initial.data.timeleft = timeleft
+                cells = replay.openCells(initial.data.layout)
+                agents[index].registerInitialState(decode(payload[start + textLength:]))
+            elif kind == _ACTION:
+                action = replay.DIRECTION_CODES[agents[index].getAction(decode(payload))]
+            elif kind == _FINAL:
+                final = getattr(agents[index], 'final', None)
+                if final is not None: final(decode(payload))
+        except Exception:
+            status, message = _ERROR, traceback.format_exc().encode()
+        sock.sendall(_RESPONSE.pack(status, action, time.process_time(), len(message)) + message)
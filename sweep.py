@@ -0,0 +1,213 @@
+# sweep.py
+# --------
+# Runs pacman.py configurations over a parameter grid in a process pool and
+# writes one result row per episode.
+
+"""
+Hyperparameter sweeps for pacman.py agents.
+
+Every configuration of the grid is played by its own worker process with the
+headless --fast engine, and each episode becomes one row of the output:
+
+    config, <grid parameters>, episode, training, score, win, steps, wall_time
+
+USAGE:      python sweep.py [options] NAME=VALUES [NAME=VALUES ...]
+EXAMPLES:   python sweep.py -o benchmark-episodes.csv \\
+                pacman=RLAgent_final fixRandomSeed=4 timeout=10 \\
+                numTraining/numGames=100/600,1000/1500,5000/5500 \\
+                learning_rate=0.001,0.01,0.1 \\
+                layout=smallClassic,mediumClassic,originalClassic
+
+NAME is a pacman.py long option (layout, pacman, ghosts, numghosts,
+numGames, numTraining, fixRandomSeed, timeout); any other name is passed to
+the agent through --agentArgs.  VALUES is a comma separated list, and names
+joined by '/' vary together instead of being crossed with each other.
+"""
+
+import argparse
+import contextlib
+import csv
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+
+PACMAN_OPTIONS = ('layout', 'pacman', 'ghosts', 'numghosts', 'numGames',
+                  'numTraining', 'fixRandomSeed', 'timeout')
+
+RESULT_FIELDS = ['episode', 'training', 'score', 'win', 'steps', 'wall_time']
+
+
+def parseGrid(specs):
+    """
+    Turns NAME=VALUES arguments into a list of axes.  Each axis is a tuple
+    of parameter names and a list of value tuples for those names.
+    """
+    axes = []
+    for spec in specs:
+        if '=' not in spec:
+            raise ValueError('Grid parameters look like NAME=VALUES, got %r' % spec)
+        names, values = spec.split('=', 1)
+        names = tuple(names.split('/'))
+        choices = []
+        for value in values.split(','):
+            parts = tuple(value.split('/'))
+            if len(parts) != len(names):
+                raise ValueError('%r needs %d values separated by "/", got %r'
+                                 % ('/'.join(names), len(names), value))
+            choices.append(parts)
+        axes.append((names, choices))
+    return axes
+
+
+def expandGrid(axes):
+    """
+    Yields one {name: value} dictionary per point of the grid.
+    """
+    for point in itertools.product(*[choices for names, choices in axes]):
+        config = {}
+        for (names, choices), values in zip(axes, point):
+            config.update(zip(names, values))
+        yield config
+
+
+def commandLine(config):
+    """
+    The pacman.py arguments that play the given configuration.
+    """
+    argv = ['--fast']
+    agentArgs = []
+    for name, value in config.items():
+        if name in PACMAN_OPTIONS:
+            argv += ['--' + name, value]
+        else:
+            agentArgs.append('%s=%s' % (name, value))
+    if agentArgs:
+        argv += ['--agentArgs', ','.join(agentArgs)]
+    return argv
+
+
+def runConfiguration(job):
+    """
+    Plays every episode of one configuration and returns its result rows.
+    Agents keep learning from one episode to the next, so the episodes of a
+    configuration run in order inside a single worker.
+    """
+    index, config = job
+    import pacman, textDisplay
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        args = pacman.readCommand(commandLine(config))
+        rules = pacman.ClassicGameRules(args['timeout'])
+        numTraining = args.get('numTraining', 0)
+        rows = []
+        for episode in range(args['numGames']):
+            start = time.perf_counter()
+            game = rules.newGame(args['layout'], args['pacman'], args['ghosts'],
+                                 textDisplay.NullGraphics(), True,
+                                 args['catchExceptions'], fast=True)
+            game.run()
+            row = dict(config)
+            row.update({
+                'config': index,
+                'episode': episode,
+                'training': episode < numTraining,
+                'score': game.state.getScore(),
+                'win': game.state.isWin(),
+                'steps': sum(1 for agentIndex, action in game.moveHistory if agentIndex == 0),
+                'wall_time': time.perf_counter() - start,
+            })
+            rows.append(row)
+    return rows
+
+
+class CsvWriter:
+    """
+    Streams rows to a CSV file as configurations finish.
+    """
+    def __init__(self, path, fields):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.DictWriter(self.file, fields)
+        self.writer.writeheader()
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """
+    Collects rows and writes them as a Parquet file (needs pandas).
+    """
+    def __init__(self, path, fields):
+        import pandas
+        self.pandas = pandas
+        self.path = path
+        self.fields = fields
+        self.rows = []
+
+    def write(self, rows):
+        self.rows.extend(rows)
+
+    def close(self):
+        self.pandas.DataFrame(self.rows, columns=self.fields).to_parquet(self.path, index=False)
+
+
+def runSweep(axes, output, processes=None):
+    """
+    Runs every configuration of the grid and writes the episode rows to
+    output (.parquet for Parquet, CSV otherwise).  Returns the number of
+    episodes played.
+    """
+    configs = list(expandGrid(axes))
+    names = [name for axisNames, choices in axes for name in axisNames]
+    fields = ['config'] + names + RESULT_FIELDS
+    if output.endswith('.parquet'):
+        writer = ParquetWriter(output, fields)
+    else:
+        writer = CsvWriter(output, fields)
+
+    start = time.time()
+    episodes = 0
+    try:
+        # A fresh process per configuration keeps module level state (random
+        # seeds, caches, agent globals) from leaking between configurations.
+        with multiprocessing.Pool(processes, maxtasksperchild=1) as pool:
+            results = pool.imap_unordered(runConfiguration, enumerate(configs))
+            for done, rows in enumerate(results, 1):
+                writer.write(rows)
+                episodes += len(rows)
+                print('Finished %d/%d configurations' % (done, len(configs)), file=sys.stderr)
+    finally:
+        writer.close()
+
+    elapsed = time.time() - start
+    print('Simulated %d episodes of %d configurations in %.2fs (%.1f episodes/sec)'
+          % (episodes, len(configs), elapsed, episodes / max(elapsed, 1e-9)))
+    return episodes
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('grid', nargs='+', metavar='NAME=VALUES',
+                        help='a grid axis; see above')
+    parser.add_argument('-o', '--output', default='sweep.csv',
+                        help='where to write the per-episode results (.csv or .parquet)')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='number of worker processes (default: all cores)')
+    options = parser.parse_args(argv)
+
+    try:
+        axes = parseGrid(options.grid)
+    except ValueError as e:
+        parser.error(str(e))
+    runSweep(axes, options.output, options.processes)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
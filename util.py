@@ -14,7 +14,7 @@
 
 import sys
 import inspect
-import heapq, random
+import heapq, random, bisect
 #import cStringIO
 import io
 
@@ -592,6 +592,24 @@ def pause():
     print("<Press enter/return to continue>")
     input()
 
+def getCacheDirectory(*subdirs):
+    """
+    Returns (and creates) a directory for on-disk caches shared between runs.
+
+    Defaults to ~/.cache/pacman; set PACMAN_CACHE_DIR to move it.  Returns
+    None if the directory cannot be created, in which case callers should
+    simply not cache.
+    """
+    import os
+    root = os.environ.get('PACMAN_CACHE_DIR',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'pacman'))
+    path = os.path.join(root, *subdirs)
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        return None
+    return path
+
 
 # code to handle timeouts
 #
@@ -638,6 +656,121 @@ class TimeoutFunction:
 
 
 
+class MoveTimer:
+    """
+    Enforces time limits on agent calls during a game.
+
+    Unlike TimeoutFunction, which installs a signal handler and a whole
+    second alarm around every call, start() installs one handler and one
+    interval timer firing every `tick` seconds for the whole game.  call()
+    only sets a deadline, measured with time.perf_counter, that the next
+    tick after it checks; limits are floats, so budgets are not truncated
+    to seconds.  Without SIGALRM (or outside the main thread), call()
+    checks the time taken after the function returns instead.
+    """
+    TICK = 0.005
+
+    def __init__(self, tick=TICK):
+        self.tick = tick
+        self.deadline = None
+        self.running = False
+        self.oldHandler = None
+
+    def start(self):
+        if not hasattr(signal, 'setitimer'): return
+        try:
+            self.oldHandler = signal.signal(signal.SIGALRM, self._checkDeadline)
+        except ValueError:
+            # Signal handlers can only be installed by the main thread
+            return
+        signal.setitimer(signal.ITIMER_REAL, self.tick, self.tick)
+        self.running = True
+
+    def stop(self):
+        if not self.running: return
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, self.oldHandler)
+        self.running = False
+
+    def _checkDeadline(self, signum, frame):
+        deadline = self.deadline
+        if deadline is not None and time.perf_counter() >= deadline:
+            self.deadline = None
+            raise TimeoutFunctionException()
+
+    def call(self, limit, function, *args):
+        """
+        Returns function(*args) and the seconds it took, or raises
+        TimeoutFunctionException if it takes longer than limit seconds.
+        """
+        start = time.perf_counter()
+        self.deadline = start + limit
+        try:
+            result = function(*args)
+        finally:
+            self.deadline = None
+        elapsed = time.perf_counter() - start
+        if elapsed > limit:
+            raise TimeoutFunctionException()
+        return result, elapsed
+
+
+class LatencyHistogram:
+    """
+    Counts durations in logarithmic buckets: bucket i holds the durations
+    up to BOUNDS[i] seconds, and the last one everything longer.
+    """
+    BOUNDS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+              0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max: self.max = seconds
+
+    def merge(self, other):
+        """
+        Adds the durations counted by another histogram to this one.
+        """
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        """
+        The upper bound of the bucket holding the given fraction of the
+        durations (the maximum for the last bucket).
+        """
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= target and seen > 0:
+                return min(bound, self.max)
+        return self.max
+
+    def asDict(self):
+        return {'count': self.count, 'mean': self.mean(), 'max': self.max,
+                'p50': self.percentile(0.5), 'p99': self.percentile(0.99),
+                'bounds': self.BOUNDS, 'counts': self.counts}
+
+    def __str__(self):
+        return '%d moves, mean %.2fms, p50 <= %.2fms, p99 <= %.2fms, max %.2fms' % (
+            self.count, self.mean() * 1000, self.percentile(0.5) * 1000,
+            self.percentile(0.99) * 1000, self.max * 1000)
+
+
 _ORIGINAL_STDOUT = None
 _ORIGINAL_STDERR = None
 _MUTED = False
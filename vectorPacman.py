@@ -0,0 +1,311 @@
+# vectorPacman.py
+# ---------------
+# Batched version of the classic Pacman rules in pacman.py.
+
+"""
+VectorPacman plays K classic Pacman games on the same layout at once.  The
+games live in NumPy arrays instead of GameState objects, and a single call
+to step() advances every game by one round: Pacman's move followed by each
+ghost's move, exactly as PacmanRules and GhostRules would play it.
+
+Ghosts follow the RandomGhost or DirectionalGhost policies from
+ghostAgents.py, sampled from a NumPy random generator.
+
+Example:
+    env = VectorPacman(layout.getLayout('smallClassic'), 64, seed=1)
+    while not env.done.all():
+        legal = env.getLegalPacmanActions()
+        rewards, done = env.step(myBatchedPolicy(env, legal))
+    env.reset(done)
+
+Positions of ghosts are stored in half-steps (twice the board coordinate)
+because scared ghosts move at half speed.  getState(i) rebuilds an ordinary
+pacman.GameState for game i, for example to reuse the feature functions in
+Agents.py.
+"""
+
+import numpy as np
+
+from game import Directions, Configuration, BitGrid
+from pacman import GameState, SCARED_TIME, COLLISION_TOLERANCE, TIME_PENALTY
+
+# Action indexes, in the order of Actions._directions
+DIRECTIONS = [Directions.NORTH, Directions.SOUTH, Directions.EAST, Directions.WEST, Directions.STOP]
+ACTION_INDEX = dict((direction, i) for i, direction in enumerate(DIRECTIONS))
+STOP = ACTION_INDEX[Directions.STOP]
+
+_DX = np.array([0, 0, 1, -1, 0])
+_DY = np.array([1, -1, 0, 0, 0])
+_REVERSE = np.array([ACTION_INDEX[d] for d in
+                     [Directions.SOUTH, Directions.NORTH, Directions.WEST, Directions.EAST, Directions.STOP]])
+
+GHOST_TYPES = ('RandomGhost', 'DirectionalGhost')
+
+
+class VectorPacman:
+    """
+    K independent games of classic Pacman stepped together.
+
+    Public arrays (K is the number of games, G the number of ghosts):
+      pacman        (K, 2) Pacman's board position
+      pacmanDir     (K,)   index of Pacman's last direction
+      ghosts        (K, G, 2) ghost positions, in half-steps
+      ghostDir      (K, G) index of each ghost's direction
+      scaredTimers  (K, G)
+      food          (K, W, H) food bitmaps and numFood (K,) their counts
+      capsules      (K, W, H)
+      score, win, lose, done (K,)
+      lastActions   (K, 1 + G) the action index every agent took in the
+                    last step, or -1 if it did not move
+    """
+
+    def __init__(self, layout, numGames, numGhosts=4, ghost='RandomGhost',
+                 prob_attack=0.8, prob_scaredFlee=0.8, seed=None):
+        if ghost not in GHOST_TYPES:
+            raise Exception('Unknown ghost type %s (expected one of %s)' % (ghost, ', '.join(GHOST_TYPES)))
+        self.layout = layout
+        self.numGames = numGames
+        self.directional = ghost == 'DirectionalGhost'
+        self.prob_attack = prob_attack
+        self.prob_scaredFlee = prob_scaredFlee
+        self.random = np.random.default_rng(seed)
+
+        walls = np.array(layout.walls.data, dtype=bool)
+        self.walls = walls
+        width, height = walls.shape
+
+        # legal[x, y, a]: whether action a leads to an open cell from (x, y)
+        padded = np.pad(walls, 1, constant_values=True)
+        self.legal = np.empty((width, height, len(DIRECTIONS)), dtype=bool)
+        for a in range(len(DIRECTIONS)):
+            self.legal[:, :, a] = ~padded[1 + _DX[a]:1 + _DX[a] + width, 1 + _DY[a]:1 + _DY[a] + height]
+
+        # Reuse GameState.initialize so the starting agents match pacman.py
+        start = GameState()
+        start.initialize(layout, numGhosts)
+        agentStates = start.data.agentStates
+        self.numGhosts = len(agentStates) - 1
+        self._pacmanStart = np.array(agentStates[0].start.pos, dtype=int)
+        self._ghostStart = 2 * np.array([s.start.pos for s in agentStates[1:]], dtype=int).reshape(-1, 2)
+        self._food = np.array(layout.food.data, dtype=bool)
+        self._capsules = np.zeros_like(walls)
+        for x, y in layout.capsules:
+            self._capsules[x, y] = True
+        # Ghosts and Pacman collide within COLLISION_TOLERANCE, in half-steps
+        self._collision = int(2 * COLLISION_TOLERANCE)
+
+        K, G = numGames, self.numGhosts
+        self.pacman = np.empty((K, 2), dtype=int)
+        self.pacmanDir = np.empty(K, dtype=int)
+        self.ghosts = np.empty((K, G, 2), dtype=int)
+        self.ghostDir = np.empty((K, G), dtype=int)
+        self.scaredTimers = np.empty((K, G), dtype=int)
+        self.food = np.empty((K,) + walls.shape, dtype=bool)
+        self.numFood = np.empty(K, dtype=int)
+        self.capsules = np.empty((K,) + walls.shape, dtype=bool)
+        self.score = np.empty(K, dtype=int)
+        self.win = np.empty(K, dtype=bool)
+        self.lose = np.empty(K, dtype=bool)
+        self.lastActions = np.full((K, 1 + G), -1, dtype=int)
+        self.reset()
+
+    @property
+    def done(self):
+        return self.win | self.lose
+
+    def reset(self, games=None):
+        """
+        Restarts the given games (all of them by default).  games may be a
+        boolean mask, such as the done flags returned by step, or indexes.
+        """
+        k = np.arange(self.numGames) if games is None else self._indexes(games)
+        self.pacman[k] = self._pacmanStart
+        self.pacmanDir[k] = STOP
+        self.ghosts[k] = self._ghostStart
+        self.ghostDir[k] = STOP
+        self.scaredTimers[k] = 0
+        self.food[k] = self._food
+        self.numFood[k] = self._food.sum()
+        self.capsules[k] = self._capsules
+        self.score[k] = 0
+        self.win[k] = False
+        self.lose[k] = False
+        self.lastActions[k] = -1
+
+    def getLegalPacmanActions(self):
+        """
+        A (K, 5) boolean mask of Pacman's legal action indexes.  Finished
+        games have no legal actions.
+        """
+        legal = self.legal[self.pacman[:, 0], self.pacman[:, 1]].copy()
+        legal[self.done] = False
+        return legal
+
+    def step(self, actions):
+        """
+        Plays one round of every unfinished game: Pacman takes actions[i] (an
+        index into DIRECTIONS) in game i, then each ghost moves.  Returns the
+        score change of every game and the done flags.  Finished games are
+        left alone until they are reset.
+        """
+        actions = np.asarray(actions, dtype=int)
+        rewards = np.zeros(self.numGames, dtype=int)
+        self.lastActions[:] = -1
+
+        k = np.nonzero(~self.done)[0]
+        self._movePacman(k, actions[k], rewards)
+        for g in range(self.numGhosts):
+            k = k[~self.done[k]]
+            if len(k) == 0: break
+            self._moveGhost(k, g, rewards)
+
+        self.score += rewards
+        return rewards, self.done
+
+    def getState(self, i):
+        """
+        Builds a pacman.GameState equal to game i.
+        """
+        state = GameState()
+        state.initialize(self.layout, self.numGhosts)
+        data = state.data
+        width, height = self.walls.shape
+        data.food = BitGrid(width, height)
+        for x, y in np.argwhere(self.food[i]):
+            data.food[int(x)][int(y)] = True
+        data.countFood()
+        data.capsules = [c for c in self.layout.capsules if self.capsules[i][c]]
+        pacman = data.agentStates[0]
+        pacman.configuration = Configuration(tuple(int(v) for v in self.pacman[i]), DIRECTIONS[self.pacmanDir[i]])
+        for g in range(self.numGhosts):
+            ghost = data.agentStates[g + 1]
+            position = tuple(int(v) // 2 if v % 2 == 0 else v / 2.0 for v in self.ghosts[i, g])
+            ghost.configuration = Configuration(position, DIRECTIONS[self.ghostDir[i, g]])
+            ghost.scaredTimer = int(self.scaredTimers[i, g])
+        data.score = int(self.score[i])
+        data._win = bool(self.win[i])
+        data._lose = bool(self.lose[i])
+        return state
+
+    def _indexes(self, games):
+        games = np.asarray(games)
+        if games.dtype == bool: return np.nonzero(games)[0]
+        return games
+
+    def _movePacman(self, k, actions, rewards):
+        "PacmanRules.applyAction and GhostRules.checkDeath for games k"
+        x, y = self.pacman[k, 0], self.pacman[k, 1]
+        illegal = ~self.legal[x, y, actions]
+        if illegal.any():
+            raise Exception("Illegal action " + DIRECTIONS[actions[illegal][0]])
+        x = x + _DX[actions]
+        y = y + _DY[actions]
+        self.pacman[k, 0] = x
+        self.pacman[k, 1] = y
+        moved = actions != STOP
+        self.pacmanDir[k[moved]] = actions[moved]
+        self.lastActions[k, 0] = actions
+        rewards[k] -= TIME_PENALTY
+
+        # Eat food
+        ate = self.food[k, x, y]
+        e = k[ate]
+        self.food[e, x[ate], y[ate]] = False
+        self.numFood[e] -= 1
+        rewards[e] += 10
+        cleared = e[self.numFood[e] == 0]
+        rewards[cleared] += 500
+        self.win[cleared] = True
+
+        # Eat capsule
+        ate = self.capsules[k, x, y]
+        e = k[ate]
+        self.capsules[e, x[ate], y[ate]] = False
+        self.scaredTimers[e] = SCARED_TIME
+
+        for g in range(self.numGhosts):
+            self._checkDeath(k, g, rewards)
+
+    def _moveGhost(self, k, g, rewards):
+        "Ghost g chooses and applies its action in games k"
+        actions = self._sampleGhostActions(k, g)
+        scared = self.scaredTimers[k, g] > 0
+        speed = np.where(scared, 1, 2)
+        self.ghosts[k, g, 0] += _DX[actions] * speed
+        self.ghosts[k, g, 1] += _DY[actions] * speed
+        moved = actions != STOP
+        self.ghostDir[k[moved], g] = actions[moved]
+        self.lastActions[k, g + 1] = actions
+
+        # GhostRules.decrementTimer
+        ending = k[self.scaredTimers[k, g] == 1]
+        self.ghosts[ending, g] = 2 * ((self.ghosts[ending, g] + 1) // 2)
+        self.scaredTimers[k, g] = np.maximum(0, self.scaredTimers[k, g] - 1)
+
+        self._checkDeath(k, g, rewards)
+
+    def _ghostLegalActions(self, k, g):
+        "GhostRules.getLegalActions as a (len(k), 5) mask"
+        x, y = self.ghosts[k, g, 0], self.ghosts[k, g, 1]
+        direction = self.ghostDir[k, g]
+        legal = np.zeros((len(k), len(DIRECTIONS)), dtype=bool)
+
+        # In between grid points ghosts must continue straight
+        between = (x % 2 == 1) | (y % 2 == 1)
+        legal[np.nonzero(between)[0], direction[between]] = True
+
+        onGrid = np.nonzero(~between)[0]
+        possible = self.legal[x[onGrid] // 2, y[onGrid] // 2]
+        possible[:, STOP] = False
+        reverse = _REVERSE[direction[onGrid]]
+        canTurn = possible.sum(1) > 1
+        possible[np.nonzero(canTurn)[0], reverse[canTurn]] = False
+        legal[onGrid] = possible
+        return legal
+
+    def _sampleGhostActions(self, k, g):
+        "Samples RandomGhost or DirectionalGhost actions for ghost g in games k"
+        probs = self._ghostDistribution(k, g)
+        cumulative = probs.cumsum(1)
+        choice = self.random.random(len(k))[:, None] * cumulative[:, -1:]
+        actions = (cumulative <= choice).sum(1)
+        # A ghost with nowhere to go stands still, like GhostAgent does
+        return np.where(cumulative[:, -1] == 0, STOP, np.minimum(actions, STOP))
+
+    def _ghostDistribution(self, k, g):
+        "GhostAgent.getDistribution as (len(k), 5) action probabilities"
+        legal = self._ghostLegalActions(k, g)
+        numLegal = legal.sum(1)
+        probs = legal / np.maximum(numLegal, 1)[:, None]
+
+        if self.directional:
+            scared = self.scaredTimers[k, g] > 0
+            speed = np.where(scared, 1, 2)[:, None]
+            newX = self.ghosts[k, g, 0][:, None] + _DX * speed
+            newY = self.ghosts[k, g, 1][:, None] + _DY * speed
+            distances = abs(newX - 2 * self.pacman[k, 0][:, None]) + abs(newY - 2 * self.pacman[k, 1][:, None])
+            nearest = np.where(legal, distances, np.iinfo(int).max).min(1)
+            farthest = np.where(legal, distances, -1).max(1)
+            bestScore = np.where(scared, farthest, nearest)
+            best = legal & (distances == bestScore[:, None])
+            bestProb = np.where(scared, self.prob_scaredFlee, self.prob_attack)
+            probs = (best * (bestProb / np.maximum(best.sum(1), 1))[:, None]
+                     + probs * (1 - bestProb)[:, None])
+        return probs
+
+    def _checkDeath(self, k, g, rewards):
+        "GhostRules.checkDeath and collide for ghost g in games k"
+        distance = (abs(self.ghosts[k, g, 0] - 2 * self.pacman[k, 0])
+                    + abs(self.ghosts[k, g, 1] - 2 * self.pacman[k, 1]))
+        hit = k[distance <= self._collision]
+        scared = self.scaredTimers[hit, g] > 0
+
+        eaten = hit[scared]
+        rewards[eaten] += 200
+        self.ghosts[eaten, g] = self._ghostStart[g]
+        self.ghostDir[eaten, g] = STOP
+        self.scaredTimers[eaten, g] = 0
+
+        caught = hit[~scared & ~self.win[hit]]
+        rewards[caught] -= 500
+        self.lose[caught] = True